@@ -1,111 +1,96 @@
 #!/usr/bin/env python
 #
 # Example code for calling the analysis functions.
-
-from SEM_Image_Analysis_Milled_Line_Detect import sem_image_analysis_milled_line_detect
-from SEM_Image_Analysis_Depo_Line_Detect import sem_image_analysis_depo_line_detect
-
-# Milled examples
-filename = "Example_Data/Milled_Images/Gilsocarbon/40Cup.tif"
-
-sem_image_analysis_milled_line_detect(verbose=True,
-                                      filename=filename,
-                                      img_width=17.0,
-                                      crop_top=400,
-                                      crop_bottom=500,
-                                      crop_left=500,
-                                      crop_right=100,
-                                      total_width_cols=1500)
-
-filename = "Example_Data/Milled_Images/Gilsocarbon/600C up_003.tif"
-
-sem_image_analysis_milled_line_detect(verbose=True,
-                                      filename=filename,
-                                      img_width=17.0,
-                                      crop_top=400,
-                                      crop_bottom=500,
-                                      crop_left=500,
-                                      crop_right=100,
-                                      total_width_cols=1500)
-
-
-filename = "Example_Data/Milled_Images/Copper/100CR.tif"
-
-sem_image_analysis_milled_line_detect(verbose=True,
-                                      filename=filename,         # filename
-                                      img_width=25.0,            # Real image width in microns
-                                      crop_top=1000,             # pixels to crop from the top
-                                      crop_bottom=1100,          # pixels to crop from the bottom
-                                      crop_left=100,             # pixels to crop from the left
-                                      crop_right=100,            # pixels to crop from the right
-                                      total_width_cols=4000)     # image width about centre to use for horizontal line
-
-filename = "Example_Data/Milled_Images/Copper/350C R.tif"
-
-sem_image_analysis_milled_line_detect(verbose=True,
-                                      filename=filename,         # filename
-                                      img_width=25.0,            # Real image width in microns
-                                      crop_top=1200,             # pixels to crop from the top
-                                      crop_bottom=1100,          # pixels to crop from the bottom
-                                      crop_left=100,             # pixels to crop from the left
-                                      crop_right=100,            # pixels to crop from the right
-                                      total_width_cols=4000)     # image width about centre to use for horizontal line
-
-
-# Deposited examples
-filename = "Example_Data/Deposited_Images/Copper/01.tif"
-
-sem_image_analysis_depo_line_detect(verbose=True,
-                                    filename=filename,         # filename
-                                    img_width=18.0,            # Real image width in microns
-                                    crop_top=200,             # pixels to crop from the top
-                                    crop_bottom=300,          # pixels to crop from the bottom
-                                    crop_left=10,             # pixels to crop from the left
-                                    crop_right=10,            # pixels to crop from the right
-                                    total_width_cols=1500)     # image width about centre to use for horizontal line
-
-filename = "Example_Data/Deposited_Images/Copper/02.tif"
-
-sem_image_analysis_depo_line_detect(verbose=True,
-                                    filename=filename,         # filename
-                                    img_width=18.0,            # Real image width in microns
-                                    crop_top=200,             # pixels to crop from the top
-                                    crop_bottom=450,          # pixels to crop from the bottom
-                                    crop_left=10,             # pixels to crop from the left
-                                    crop_right=10,            # pixels to crop from the right
-                                    total_width_cols=1500)     # image width about centre to use for horizontal line
-
-
-filename = "Example_Data/Deposited_Images/Copper_Graphite/01_001.tif"
-
-sem_image_analysis_depo_line_detect(verbose=True,
-                                    filename=filename,         # filename
-                                    img_width=24.0,            # Real image width in microns
-                                    crop_top=50,             # pixels to crop from the top
-                                    crop_bottom=150,          # pixels to crop from the bottom
-                                    crop_left=100,             # pixels to crop from the left
-                                    crop_right=10,            # pixels to crop from the right
-                                    total_width_cols=1500)     # image width about centre to use for horizontal line
-
-
-filename = "Example_Data/Deposited_Images/Gilsocarbon/10 kv w dep_063.tif"
-
-sem_image_analysis_depo_line_detect(verbose=True,
-                                    filename=filename,         # filename
-                                    img_width=7.5,            # Real image width in microns
-                                    crop_top=50,             # pixels to crop from the top
-                                    crop_bottom=150,          # pixels to crop from the bottom
-                                    crop_left=100,             # pixels to crop from the left
-                                    crop_right=10,            # pixels to crop from the right
-                                    total_width_cols=1500)     # image width about centre to use for horizontal line
-
-filename = "Example_Data/Deposited_Images/Gilsocarbon/10 kv w dep_068.tif"
-
-sem_image_analysis_depo_line_detect(verbose=True,
-                                    filename=filename,         # filename
-                                    img_width=7.5,            # Real image width in microns
-                                    crop_top=50,             # pixels to crop from the top
-                                    crop_bottom=150,          # pixels to crop from the bottom
-                                    crop_left=100,             # pixels to crop from the left
-                                    crop_right=10,            # pixels to crop from the right
-                                    total_width_cols=1500)     # image width about centre to use for horizontal line
+# The example images are analysed in parallel by the batch runner (one worker per core).
+# The same list could be given to SEM_Image_Analysis_Batch.py as a csv/json manifest.
+
+from SEM_Image_Analysis_Batch import sem_image_analysis_batch
+
+images = [
+    # Milled examples
+    {'detector': 'milled',
+     'filename': "Example_Data/Milled_Images/Gilsocarbon/40Cup.tif",
+     'img_width': 17.0,
+     'crop_top': 400,
+     'crop_bottom': 500,
+     'crop_left': 500,
+     'crop_right': 100,
+     'total_width_cols': 1500},
+
+    {'detector': 'milled',
+     'filename': "Example_Data/Milled_Images/Gilsocarbon/600C up_003.tif",
+     'img_width': 17.0,
+     'crop_top': 400,
+     'crop_bottom': 500,
+     'crop_left': 500,
+     'crop_right': 100,
+     'total_width_cols': 1500},
+
+    {'detector': 'milled',
+     'filename': "Example_Data/Milled_Images/Copper/100CR.tif",   # filename
+     'img_width': 25.0,            # Real image width in microns
+     'crop_top': 1000,             # pixels to crop from the top
+     'crop_bottom': 1100,          # pixels to crop from the bottom
+     'crop_left': 100,             # pixels to crop from the left
+     'crop_right': 100,            # pixels to crop from the right
+     'total_width_cols': 4000},    # image width about centre to use for horizontal line
+
+    {'detector': 'milled',
+     'filename': "Example_Data/Milled_Images/Copper/350C R.tif",  # filename
+     'img_width': 25.0,            # Real image width in microns
+     'crop_top': 1200,             # pixels to crop from the top
+     'crop_bottom': 1100,          # pixels to crop from the bottom
+     'crop_left': 100,             # pixels to crop from the left
+     'crop_right': 100,            # pixels to crop from the right
+     'total_width_cols': 4000},    # image width about centre to use for horizontal line
+
+    # Deposited examples
+    {'detector': 'depo',
+     'filename': "Example_Data/Deposited_Images/Copper/01.tif",   # filename
+     'img_width': 18.0,            # Real image width in microns
+     'crop_top': 200,              # pixels to crop from the top
+     'crop_bottom': 300,           # pixels to crop from the bottom
+     'crop_left': 10,              # pixels to crop from the left
+     'crop_right': 10,             # pixels to crop from the right
+     'total_width_cols': 1500},    # image width about centre to use for horizontal line
+
+    {'detector': 'depo',
+     'filename': "Example_Data/Deposited_Images/Copper/02.tif",
+     'img_width': 18.0,
+     'crop_top': 200,
+     'crop_bottom': 450,
+     'crop_left': 10,
+     'crop_right': 10,
+     'total_width_cols': 1500},
+
+    {'detector': 'depo',
+     'filename': "Example_Data/Deposited_Images/Copper_Graphite/01_001.tif",
+     'img_width': 24.0,
+     'crop_top': 50,
+     'crop_bottom': 150,
+     'crop_left': 100,
+     'crop_right': 10,
+     'total_width_cols': 1500},
+
+    {'detector': 'depo',
+     'filename': "Example_Data/Deposited_Images/Gilsocarbon/10 kv w dep_063.tif",
+     'img_width': 7.5,
+     'crop_top': 50,
+     'crop_bottom': 150,
+     'crop_left': 100,
+     'crop_right': 10,
+     'total_width_cols': 1500},
+
+    {'detector': 'depo',
+     'filename': "Example_Data/Deposited_Images/Gilsocarbon/10 kv w dep_068.tif",
+     'img_width': 7.5,
+     'crop_top': 50,
+     'crop_bottom': 150,
+     'crop_left': 100,
+     'crop_right': 10,
+     'total_width_cols': 1500},
+]
+
+if __name__ == '__main__':
+    # n_jobs=0 uses every core
+    sem_image_analysis_batch(images=images, n_jobs=0)
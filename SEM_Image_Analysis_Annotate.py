@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+# Annotation of the detected marks, for the milled / deposited line detectors.
+# The annotations (crop lines, detected lines, arrows and distance labels) are first described as a list of
+# shapes in full image pixel coordinates.  They can then be:
+#   - drawn on a colour copy of the image, at full resolution or on a preview downscaled by an integer factor
+#     (drawn at preview scale, so no full resolution colour copy is made), and written as TIFF, PNG, JPEG or WebP
+#   - written as a vector overlay (SVG and json of the shape coordinates), to composite onto the original later
+#
+# Shapes are dicts:  {'type': 'line' | 'arrow' | 'circle' | 'text', 'colour': (b, g, r), 'thickness': pixels, ...}
+#   line / arrow:  'start', 'end' (x, y)   (arrows are double ended, 'tip_length' as a fraction of the length)
+#   circle:        'centre' (x, y), 'radius'
+#   text:          'text', 'origin' (x, y) bottom left, 'font_scale' (OpenCV Hershey simplex font)
+
+# Imports
+import json
+import math
+import cv2
+
+# Image formats the annotated image can be written as, with the OpenCV write flags
+# (the same as annotated_formats in the detectors)
+image_formats = {'tif': [],
+                 'png': [cv2.IMWRITE_PNG_COMPRESSION, 3],
+                 'jpg': [cv2.IMWRITE_JPEG_QUALITY],
+                 'webp': [cv2.IMWRITE_WEBP_QUALITY]}
+
+
+def line(start, end, colour, thickness):
+    return {'type': 'line', 'start': (int(start[0]), int(start[1])), 'end': (int(end[0]), int(end[1])),
+            'colour': colour, 'thickness': thickness}
+
+
+def arrow(start, end, colour, thickness, tip_length=0.04):
+    return {'type': 'arrow', 'start': (int(start[0]), int(start[1])), 'end': (int(end[0]), int(end[1])),
+            'colour': colour, 'thickness': thickness, 'tip_length': tip_length}
+
+
+def circle(centre, radius, colour, thickness):
+    return {'type': 'circle', 'centre': (int(centre[0]), int(centre[1])), 'radius': radius,
+            'colour': colour, 'thickness': thickness}
+
+
+def text(label, origin, font_scale, colour, thickness):
+    return {'type': 'text', 'text': label, 'origin': (int(origin[0]), int(origin[1])), 'font_scale': font_scale,
+            'colour': colour, 'thickness': thickness}
+
+
+# The annotations of a detector run, in full image pixels.
+# h_pix / v_pix are the horizontal / vertical spike positions in the cropped image.
+def detector_shapes(img_width, img_height, crop_top, crop_bottom, crop_left, crop_right, cropped_width,
+                    cropped_height, total_width_cols, vertical_crop_extra, real_width, length_factor, h_pix, v_pix):
+    img_centre_x = cropped_width / 2.0
+    img_centre_y = cropped_height / 2.0
+    half_total_width_cols = int(total_width_cols / 2.0)
+    spike1_pix, spike2_pix = h_pix
+    vspike_min = min(v_pix)
+    vspike_max = max(v_pix)
+
+    shapes = [
+        # crop lines
+        line((0, img_height - crop_bottom), (img_width, img_height - crop_bottom), (0, 0, 255), 5),
+        line((0, crop_top), (img_width, crop_top), (0, 0, 255), 5),
+        line((crop_left, 0), (crop_left, img_height), (0, 0, 255), 5),
+        line((img_width - crop_right, 0), (img_width - crop_right, img_height), (0, 0, 255), 5),
+        # circle in the centre of the cropped region
+        circle((img_centre_x + crop_left, img_centre_y + crop_top), 10, (0, 255, 0), 3),
+        # the input width
+        arrow((0, img_height - 0.5 * crop_bottom), (img_width, img_height - 0.5 * crop_bottom), (255, 0, 255), 6),
+        text(str(real_width) + " microns", (img_centre_x - 100, img_height - 0.5 * crop_bottom - 15), 3,
+             (255, 0, 255), 10),
+        # region considered in finding the horizontal lines
+        line((crop_left + int(img_centre_x - half_total_width_cols), 0),
+             (crop_left + int(img_centre_x - half_total_width_cols), img_height), (0, 255, 0), 2),
+        line((crop_left + int(img_centre_x + half_total_width_cols), 0),
+             (crop_left + int(img_centre_x + half_total_width_cols), img_height), (0, 255, 0), 2),
+        # detected horizontal lines and their distance
+        line((0, spike1_pix + crop_top), (img_width, spike1_pix + crop_top), (0, 255, 255), 3),
+        line((0, spike2_pix + crop_top), (img_width, spike2_pix + crop_top), (0, 255, 255), 3),
+        arrow((img_width * 0.75, spike1_pix + crop_top), (img_width * 0.75, spike2_pix + crop_top), (0, 255, 255), 6),
+        text(str(round(abs(spike2_pix - spike1_pix) / length_factor, 3)) + " microns",
+             (img_width * 0.75 + 10, img_centre_y + crop_top), 3, (0, 255, 255), 10),
+        # region considered in finding the vertical lines
+        line((0, int(min(spike1_pix, spike2_pix) + vertical_crop_extra + crop_top)),
+             (img_width, int(min(spike1_pix, spike2_pix) + vertical_crop_extra + crop_top)), (0, 255, 0), 2),
+        line((0, int(max(spike1_pix, spike2_pix) - vertical_crop_extra + crop_top)),
+             (img_width, int(max(spike1_pix, spike2_pix) - vertical_crop_extra + crop_top)), (0, 255, 0), 2),
+        # detected vertical lines and their distance
+        line((vspike_min + crop_left, 0), (vspike_min + crop_left, img_height), (255, 100, 0), 3),
+        line((vspike_max + crop_left, 0), (vspike_max + crop_left, img_height), (255, 100, 0), 3),
+        arrow((vspike_min + crop_left, img_height - crop_bottom - 50),
+              (vspike_max + crop_left, img_height - crop_bottom - 50), (255, 100, 0), 6),
+        text(str(round(abs(v_pix[1] - v_pix[0]) / length_factor, 3)) + " microns",
+             (img_centre_x - 100, img_height - crop_bottom - 70), 3, (255, 100, 0), 10)]
+    return shapes
+
+
+# Draw the shapes on a colour image that is the full image downscaled by factor
+def draw_shapes(image, shapes, factor=1):
+    def point(xy):
+        return (int(round(xy[0] / float(factor))), int(round(xy[1] / float(factor))))
+
+    def width(pixels):
+        return max(1, int(round(pixels / float(factor))))
+
+    for shape in shapes:
+        if shape['type'] == 'line':
+            cv2.line(image, point(shape['start']), point(shape['end']), shape['colour'], width(shape['thickness']))
+        elif shape['type'] == 'arrow':
+            # double ended arrow
+            cv2.arrowedLine(image, point(shape['start']), point(shape['end']), shape['colour'],
+                            width(shape['thickness']), tipLength=shape['tip_length'])
+            cv2.arrowedLine(image, point(shape['end']), point(shape['start']), shape['colour'],
+                            width(shape['thickness']), tipLength=shape['tip_length'])
+        elif shape['type'] == 'circle':
+            cv2.circle(image, point(shape['centre']), width(shape['radius']), shape['colour'],
+                       width(shape['thickness']))
+        elif shape['type'] == 'text':
+            cv2.putText(image, shape['text'], point(shape['origin']), cv2.FONT_HERSHEY_SIMPLEX,
+                        shape['font_scale'] / float(factor), shape['colour'], width(shape['thickness']))
+    return image
+
+
+# Colour copy of a grayscale image (the full image, or a preview downscaled by factor) with the shapes drawn on
+def annotated_image(imgdata, shapes, factor=1):
+    return draw_shapes(cv2.cvtColor(imgdata, cv2.COLOR_GRAY2BGR), shapes, factor)
+
+
+# Write an image in one of image_formats, returns the filename (prefix + extension).
+# With save_output the encoded image is handed to save_output(filename, data) instead of written.
+def write_image(prefix, image, image_format='tif', quality=90, save_output=None):
+    flags = list(image_formats[image_format])
+    if image_format in ('jpg', 'webp'):
+        flags.append(int(quality))
+    filename = prefix + "." + image_format
+    if save_output is None:
+        cv2.imwrite(filename, image, flags)
+    else:
+        save_output(filename, cv2.imencode("." + image_format, image, flags)[1].tobytes())
+    return filename
+
+
+# Arrow head of an arrow from start to end, as drawn by cv2.arrowedLine: two strokes at 45 degrees
+def arrow_head(start, end, tip_length):
+    angle = math.atan2(start[1] - end[1], start[0] - end[0])
+    length = tip_length * math.hypot(end[0] - start[0], end[1] - start[1])
+    return [(end[0] + length * math.cos(angle + math.pi / 4), end[1] + length * math.sin(angle + math.pi / 4)),
+            end,
+            (end[0] + length * math.cos(angle - math.pi / 4), end[1] + length * math.sin(angle - math.pi / 4))]
+
+
+# SVG colour of a (b, g, r) colour
+def svg_colour(colour):
+    return "#%02x%02x%02x" % (colour[2], colour[1], colour[0])
+
+
+# Write the shapes as an SVG the size of the full image, and as json.  Returns the two filenames.
+# With save_output the files are handed to save_output(filename, data) instead of written.
+def write_overlay(prefix, shapes, img_width, img_height, save_output=None):
+    svg = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" viewBox="0 0 %d %d">'
+           % (img_width, img_height, img_width, img_height)]
+    for shape in shapes:
+        style = 'stroke="%s" stroke-width="%d" fill="none"' % (svg_colour(shape['colour']), shape['thickness'])
+        if shape['type'] in ('line', 'arrow'):
+            svg.append('<line x1="%d" y1="%d" x2="%d" y2="%d" %s/>' % (shape['start'] + shape['end'] + (style,)))
+        if shape['type'] == 'arrow':
+            for start, end in [(shape['start'], shape['end']), (shape['end'], shape['start'])]:
+                points = " ".join("%.1f,%.1f" % xy for xy in arrow_head(start, end, shape['tip_length']))
+                svg.append('<polyline points="%s" %s/>' % (points, style))
+        elif shape['type'] == 'circle':
+            svg.append('<circle cx="%d" cy="%d" r="%d" %s/>' % (shape['centre'] + (shape['radius'], style)))
+        elif shape['type'] == 'text':
+            # same width as the OpenCV text
+            (text_width, text_height), baseline = cv2.getTextSize(shape['text'], cv2.FONT_HERSHEY_SIMPLEX,
+                                                                  shape['font_scale'], shape['thickness'])
+            svg.append('<text x="%d" y="%d" font-family="sans-serif" font-weight="bold" font-size="%d" '
+                       'textLength="%d" fill="%s">%s</text>'
+                       % (shape['origin'] + (round(text_height * 1.4), text_width, svg_colour(shape['colour']),
+                                             shape['text'])))
+    svg.append('</svg>')
+
+    overlay = {'img_width': img_width, 'img_height': img_height, 'shapes': shapes}
+    files = [(prefix + "overlay.svg", "\n".join(svg) + "\n"),
+             (prefix + "overlay.json", json.dumps(overlay))]
+    for filename, contents in files:
+        if save_output is None:
+            with open(filename, 'w') as f:
+                f.write(contents)
+        else:
+            save_output(filename, contents.encode())
+    return [filename for filename, contents in files]
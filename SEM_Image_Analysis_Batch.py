@@ -0,0 +1,442 @@
+#!/usr/bin/env python
+
+# This Script runs the milled / deposited line detectors over a batch of images.
+# The images are spread across a pool of worker processes, so a large batch can use every core.
+# A failure on one image is reported and the batch carries on with the rest.
+# At the end the aggregate throughput (images / second) is printed.
+
+# Usage:
+# SEM_Image_Analysis_Batch.py  manifest.csv|manifest.json  [--jobs N]
+# SEM_Image_Analysis_Batch.py  --glob "Images/*.tif"  --detector milled  --img_width 17.0  [--crop_top 400 ...]  [--jobs N]
+# Add  --outputs numbers  to only measure the marks, without writing the plots and annotated image.
+# Add  --cache folder  to keep the results, re-runs then skip images already analysed with the same parameters.
+# Add  --store results.db  to append every result to an SQLite results store (see SEM_Image_Analysis_Store.py).
+# Add  --pipeline  to read, analyse and write the images in overlapping stages (see SEM_Image_Analysis_Pipeline.py).
+
+# Imports
+import io
+import sys
+import os
+import csv
+import json
+import glob
+import time
+import argparse
+import traceback
+import contextlib
+import concurrent.futures
+
+from SEM_Image_Analysis_Milled_Line_Detect import sem_image_analysis_milled_line_detect
+from SEM_Image_Analysis_Depo_Line_Detect import sem_image_analysis_depo_line_detect
+from SEM_Image_Analysis_Cache import ResultCache, file_hash
+from SEM_Image_Analysis_Store import ResultStore
+
+
+# Detector functions that can be selected per image
+detectors = {'milled': sem_image_analysis_milled_line_detect,
+             'depo': sem_image_analysis_depo_line_detect}
+
+
+# Convert an outputs value to a set, from either a list (json) or a string such as "plots,annotated" (csv)
+def parse_outputs(value):
+    if isinstance(value, str):
+        value = value.replace(';', ',').replace(' ', ',').split(',')
+    return set(output for output in value if output)
+
+
+# Convert a yes / no value from json (true / false) or csv ("1", "true", "yes", ...)
+def parse_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'y', 'on')
+    return bool(value)
+
+
+# Per-image parameters accepted in a manifest, and the type to convert them to
+image_param_types = {'img_width': float,
+                     'crop_top': int,
+                     'crop_bottom': int,
+                     'crop_left': int,
+                     'crop_right': int,
+                     'total_width_cols': int,
+                     'vertical_crop_extra': int,
+                     'peak_width_max': int,
+                     'peak_dist_max': int,
+                     'outputs': parse_outputs,
+                     'smoothing': str,
+                     'streaming': parse_bool,
+                     'strip_rows': int,
+                     'pyramid': int,
+                     'all_marks': parse_bool,
+                     'mark_min_fraction': float,
+                     'annotated_format': str,
+                     'annotated_quality': int,
+                     'preview_factor': int,
+                     'deskew': parse_bool,
+                     'max_skew': float,
+                     'bands': int,
+                     'min_confidence': float}
+
+# Keys a manifest image entry may have besides the image parameters
+manifest_keys = {'filename', 'detector', 'output_prefix'}
+
+
+# Convert the parameters of one image entry to the types the detectors expect.
+# Empty values (blank csv cells) are dropped so the detector defaults are used.
+def convert_image_params(entry):
+    params = {}
+    for key, value in entry.items():
+        if value is None or value == '':
+            continue
+        if key in image_param_types:
+            params[key] = image_param_types[key](value)
+        else:
+            params[key] = value
+    return params
+
+
+# Read a csv or json manifest and return a list of image entries.
+# csv:  a header row naming the columns (filename, detector, img_width, crop_top, ...), then one row per image.
+# json: either a list of image objects, or {"defaults": {...}, "images": [...]}.
+# Relative filenames are taken relative to the manifest location.
+# Raises ValueError naming the row for an entry without a filename, or with unknown (e.g. misspelled) keys.
+def read_manifest(manifest_filename):
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_filename))
+    defaults = {}
+
+    if manifest_filename.lower().endswith('.json'):
+        with open(manifest_filename) as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            defaults = data.get('defaults', {})
+            entries = data.get('images', [])
+        else:
+            entries = data
+        # json images are numbered from 1
+        first_row = 1
+        row_name = "image "
+    else:
+        with open(manifest_filename, newline='') as f:
+            entries = [row for row in csv.DictReader(f)]
+        # the csv line number (after the header)
+        first_row = 2
+        row_name = "row "
+
+    known_keys = set(image_param_types) | manifest_keys
+    unknown = sorted(set(defaults) - known_keys)
+    if unknown:
+        raise ValueError("manifest " + manifest_filename + ", defaults: unknown parameter(s) " + ", ".join(unknown))
+
+    images = []
+    for i, entry in enumerate(entries):
+        row = row_name + str(first_row + i)
+        # (a csv row with more cells than the header has them under None)
+        unknown = sorted(str(key) for key in entry if key not in known_keys and entry[key] not in (None, ''))
+        if unknown:
+            raise ValueError("manifest " + manifest_filename + ", " + row + ": unknown parameter(s) " +
+                             ", ".join(unknown))
+        image = convert_image_params(defaults)
+        try:
+            image.update(convert_image_params(entry))
+        except (ValueError, TypeError) as e:
+            raise ValueError("manifest " + manifest_filename + ", " + row + ": " + str(e))
+        if not image.get('filename'):
+            raise ValueError("manifest " + manifest_filename + ", " + row + ": no filename")
+        if not os.path.isabs(image['filename']):
+            image['filename'] = os.path.join(manifest_dir, image['filename'])
+        images.append(image)
+    return images
+
+
+# Build image entries for every file matching a glob pattern, all sharing the same parameters
+def images_from_glob(pattern, **params):
+    return [dict(params, filename=filename) for filename in sorted(glob.glob(pattern, recursive=True))]
+
+
+# Analyse a single image entry.  Runs in a worker process.
+# Never raises, the outcome is returned as a status record.
+# On success record['result'] holds the detector result (LineDetectResult.as_dict()).
+# Frames the detector flagged as low confidence (see min_confidence) have the status 'flagged', with the result.
+# With a cache_dir, results already in the cache are returned without analysing the image again.
+# With hash_file, record['file_hash'] holds the sha256 of the image file (for the results store).
+# The detectors report a bad option by printing "ERROR:  ..." and exiting, so what they print is captured (and
+# printed once they return) to give the reason in the record.
+def analyse_image(image, cache_dir=None, cache_max_bytes=None, hash_file=False):
+    params = dict(image)
+    filename = params.get('filename', '')
+    detector = params.pop('detector', 'milled')
+    record = {'filename': filename, 'detector': detector, 'status': 'ok', 'error': '', 'seconds': 0.0,
+              'result': None, 'cached': False, 'file_hash': None}
+
+    start = time.perf_counter()
+    output = io.StringIO()
+    try:
+        if detector not in detectors:
+            raise ValueError("unknown detector '" + str(detector) + "' (expected one of: " +
+                             ", ".join(sorted(detectors)) + ")")
+        # The detectors exit when the file is missing, so check here to keep the worker alive
+        if not os.path.isfile(filename):
+            raise IOError("the file " + filename + " does not exist")
+        if hash_file:
+            record['file_hash'] = file_hash(filename)
+        with contextlib.redirect_stdout(output):
+            if cache_dir is not None:
+                result, record['cached'] = ResultCache(cache_dir, cache_max_bytes).run(detector, detectors[detector],
+                                                                                       **params)
+                record['result'] = result.as_dict()
+            else:
+                record['result'] = detectors[detector](**params).as_dict()
+        if record['result'].get('flagged'):
+            record['status'] = 'flagged'
+            score = record['result']['confidence']['score']
+            record['error'] = ("low confidence in the marks (" + str(round(score, 3)) + " below " +
+                               str(params.get('min_confidence')) + "), not rendered")
+    except (Exception, SystemExit) as e:
+        record['status'] = 'failed'
+        record['error'] = "".join(traceback.format_exception_only(type(e), e)).strip()
+        if isinstance(e, SystemExit):
+            errors = [line for line in output.getvalue().splitlines() if line.startswith("ERROR:")]
+            if errors:
+                record['error'] = errors[-1][len("ERROR:"):].strip()
+    record['seconds'] = time.perf_counter() - start
+    sys.stdout.write(output.getvalue())
+
+    return record
+
+
+# Status record (see analyse_image) for an image whose worker process died while analysing it
+def crashed_record(image):
+    return {'filename': image.get('filename', ''), 'detector': image.get('detector', 'milled'), 'status': 'failed',
+            'error': "the worker process died while analysing the image (crashed, or killed when out of memory)",
+            'seconds': 0.0, 'result': None, 'cached': False, 'file_hash': None}
+
+
+# Analyse each image in a worker process of its own, up to n_jobs at once, so an image that kills its worker only
+# fails itself (when workers share a pool, one dying breaks the pool and every image still in it).
+# args are passed on to analyse_image.  Yields (image, status record) as each image finishes.
+def analyse_isolated(images, n_jobs, *args):
+    waiting = list(images)
+    running = {}
+    try:
+        while waiting or running:
+            while waiting and len(running) < n_jobs:
+                image = waiting.pop(0)
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+                running[executor.submit(analyse_image, image, *args)] = (image, executor)
+            done = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED).done
+            for future in done:
+                image, executor = running.pop(future)
+                executor.shutdown()
+                try:
+                    record = future.result()
+                except concurrent.futures.process.BrokenProcessPool:
+                    record = crashed_record(image)
+                yield image, record
+    finally:
+        for image, executor in running.values():
+            executor.shutdown(cancel_futures=True)
+
+
+# Batch runner function
+def sem_image_analysis_batch(**kwargs):
+    # Default parameters
+    verbose = kwargs.get('verbose', True)
+    # list of image entries, each a dict of detector keyword args plus 'detector' ('milled' or 'depo')
+    images = kwargs.get('images', [])
+    # number of worker processes (0 or None uses every core)
+    n_jobs = kwargs.get('n_jobs', 1)
+    # Append the per-stage time / memory of each image to this file as json lines (None to not instrument)
+    instrument_file = kwargs.get('instrument_file', None)
+    # Result cache folder (None for no cache) and its size limit in bytes
+    cache_dir = kwargs.get('cache_dir', None)
+    cache_max_bytes = kwargs.get('cache_max_bytes', 2 * 1024 ** 3)
+    # Results store (SQLite database) every result is appended to (None for no store),
+    # and the number of results written per transaction
+    store_filename = kwargs.get('store', None)
+    store_batch_size = kwargs.get('store_batch_size', 100)
+
+    if not n_jobs:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = max(1, min(n_jobs, len(images)))
+
+    if instrument_file is not None:
+        images = [dict(image, instrument_file=instrument_file) for image in images]
+
+    records = []
+    # the file hashes are computed by the workers, the results are written here
+    store = ResultStore(store_filename, store_batch_size) if store_filename is not None else None
+    hash_file = store is not None
+
+    def finish(record, image):
+        records.append(record)
+        if store is not None:
+            store.add(record, image)
+        if verbose:
+            print_record(record, len(records), len(images))
+
+    start = time.perf_counter()
+    try:
+        if n_jobs == 1:
+            for image in images:
+                finish(analyse_image(image, cache_dir, cache_max_bytes, hash_file), image)
+        else:
+            # images that were not finished when a worker died (which breaks the pool)
+            crashed = []
+            with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = {executor.submit(analyse_image, image, cache_dir, cache_max_bytes, hash_file): i
+                           for i, image in enumerate(images)}
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        record = future.result()
+                    except concurrent.futures.process.BrokenProcessPool:
+                        crashed.append(futures[future])
+                        continue
+                    finish(record, images[futures[future]])
+            # the image that killed the worker is among them, so each is retried in a worker of its own
+            if crashed and verbose:
+                print(">  A worker process died, retrying the " + str(len(crashed)) +
+                      " unfinished image(s) one per worker")
+            crashed = [images[i] for i in sorted(crashed)]
+            for image, record in analyse_isolated(crashed, n_jobs, cache_dir, cache_max_bytes, hash_file):
+                finish(record, image)
+    finally:
+        if store is not None:
+            store.close()
+    elapsed = time.perf_counter() - start
+
+    if verbose:
+        print_summary(records, elapsed, n_jobs)
+        if instrument_file is not None:
+            print_stage_summary(records)
+
+    return records
+
+
+# Print a one line report for a finished image
+def print_record(record, n_done, n_total):
+    status = 'cached' if record.get('cached') else record['status']
+    line = ("[" + str(n_done) + "/" + str(n_total) + "]  " + status.upper().ljust(7) + " " +
+            str(round(record['seconds'], 2)) + " s  " + record['filename'])
+    if record['result'] is not None:
+        line += ("\n      horizontal: " + str(round(record['result']['horizontal_distance'], 3)) + " microns" +
+                 "   vertical: " + str(round(record['result']['vertical_distance'], 3)) + " microns")
+    if record['status'] != 'ok':
+        line += "\n      " + record['error']
+    print(line)
+
+
+# Print the aggregate results of a batch
+def print_summary(records, elapsed, n_jobs):
+    n_ok = sum(1 for record in records if record['status'] == 'ok')
+    n_flagged = sum(1 for record in records if record['status'] == 'flagged')
+    n_failed = len(records) - n_ok - n_flagged
+    print("\n>  Analysed " + str(len(records)) + " images with " + str(n_jobs) + " worker(s) in " +
+          str(round(elapsed, 2)) + " s")
+    n_cached = sum(1 for record in records if record.get('cached'))
+    print(">  Succeeded: " + str(n_ok) + " (" + str(n_cached) + " from the cache)   Flagged: " + str(n_flagged) +
+          "   Failed: " + str(n_failed))
+    if elapsed > 0:
+        print(">  Throughput: " + str(round(len(records) / elapsed, 3)) + " images/second")
+
+
+# Print the total and mean time of each detector stage over the batch, slowest first
+def print_stage_summary(records):
+    totals = {}
+    counts = {}
+    for record in records:
+        if record['result'] is None:
+            continue
+        for name, stage in record['result']['instrumentation'].get('stages', {}).items():
+            totals[name] = totals.get(name, 0.0) + stage['seconds']
+            counts[name] = counts.get(name, 0) + 1
+    if not totals:
+        return
+    print("\n>  Time per stage (total / mean per image):")
+    for name in sorted(totals, key=totals.get, reverse=True):
+        print("     " + name.ljust(20) + str(round(totals[name], 3)).rjust(10) + " s" +
+              str(round(1000.0 * totals[name] / counts[name], 2)).rjust(10) + " ms")
+
+
+# If we are running this script interactively, call the function safely
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Run the SEM line detectors over a batch of images.")
+    parser.add_argument('manifest', nargs='?',
+                        help="csv or json manifest listing the images and their parameters")
+    parser.add_argument('--glob', dest='pattern',
+                        help="analyse every image matching this pattern (quote it), instead of a manifest")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="number of worker processes, 0 uses every core (default 1)")
+    parser.add_argument('--instrument', metavar='FILE',
+                        help="append the time / memory of each detector stage to FILE (json lines), and summarise")
+    parser.add_argument('--cache', help="result cache folder, images already analysed are not analysed again")
+    parser.add_argument('--cache_size', type=float, default=2.0, help="result cache size limit in GB (default 2)")
+    parser.add_argument('--store', help="append every result to this SQLite results store")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="read, analyse and write the images in overlapping stages (not with --cache)")
+    parser.add_argument('--prefetch_threads', type=int, default=2,
+                        help="with --pipeline, threads reading and decoding images (default 2)")
+    parser.add_argument('--prefetch_depth', type=int,
+                        help="with --pipeline, images read ahead of the workers (default twice the workers)")
+    parser.add_argument('--writer_threads', type=int, default=2,
+                        help="with --pipeline, threads writing the output files (default 2)")
+    parser.add_argument('--write_depth', type=int, default=16,
+                        help="with --pipeline, output files waiting to be written before new images wait (default 16)")
+    parser.add_argument('--detector', choices=sorted(detectors),
+                        help="detector to use for images that do not set one (default milled)")
+    for param, param_type in image_param_types.items():
+        parser.add_argument('--' + param, type=param_type,
+                            help="default " + param + " for images that do not set one")
+    args = parser.parse_args()
+
+    if (args.manifest is None) == (args.pattern is None):
+        parser.print_usage()
+        print("\nERROR:  Give either a manifest file or a --glob pattern\n")
+        sys.exit()
+
+    # Parameters given on the commandline apply to every image that does not set its own
+    cli_params = {param: getattr(args, param) for param in image_param_types if getattr(args, param) is not None}
+    if args.detector is not None:
+        cli_params['detector'] = args.detector
+
+    if args.manifest is not None:
+        if not os.path.isfile(args.manifest):
+            print("ERROR:  The manifest you entered: " + args.manifest + " does not exist.")
+            sys.exit()
+        try:
+            batch_images = [dict(cli_params, **image) for image in read_manifest(args.manifest)]
+        except ValueError as e:
+            print("ERROR:  " + str(e))
+            sys.exit()
+    else:
+        batch_images = images_from_glob(args.pattern, **cli_params)
+
+    if len(batch_images) == 0:
+        print("ERROR:  No images to analyse.")
+        sys.exit()
+
+    if args.pipeline:
+        if args.cache is not None:
+            print("ERROR:  The result cache cannot be used with --pipeline.")
+            sys.exit()
+        from SEM_Image_Analysis_Pipeline import sem_image_analysis_pipeline
+        batch_records = sem_image_analysis_pipeline(images=batch_images,
+                                                    n_jobs=args.jobs,
+                                                    prefetch_threads=args.prefetch_threads,
+                                                    prefetch_depth=args.prefetch_depth,
+                                                    writer_threads=args.writer_threads,
+                                                    write_depth=args.write_depth,
+                                                    instrument_file=args.instrument,
+                                                    store=args.store,
+                                                    verbose=True)
+    else:
+        batch_records = sem_image_analysis_batch(images=batch_images,
+                                                 n_jobs=args.jobs,
+                                                 instrument_file=args.instrument,
+                                                 cache_dir=args.cache,
+                                                 cache_max_bytes=int(args.cache_size * 1024 ** 3),
+                                                 store=args.store,
+                                                 verbose=True)
+
+    # Non-zero exit status if any image failed (flagged frames were still measured)
+    if any(record['status'] == 'failed' for record in batch_records):
+        sys.exit(1)
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+
+# Benchmark for the milled / deposited line detectors.
+# Synthetic grayscale SEM-like frames are generated with fiducial lines at known positions, noise,
+# a databar along the bottom and an illumination gradient.  Both detectors are timed on each frame size,
+# and the images/second, the time spent in each stage (from the detectors' instrument option),
+# the peak memory (RSS) and the error of the detected line positions (pixels) are reported.
+# Each run is appended to a results file (one json record per line) and compared with the previous
+# run of the same case, so regressions between versions show up.
+# The import time of the modules run per image from the command line is checked against a budget, as is that
+# they do not import the slow packages (scipy, matplotlib, OpenCV) until they are needed.
+
+# Usage:
+# SEM_Image_Analysis_Benchmark.py  [--sizes 1024,2048,4096]  [--repeat 3]  [--results benchmark_results.jsonl]
+# SEM_Image_Analysis_Benchmark.py  --imports_only      (exit status 1 if an import is over budget)
+
+# Imports
+import sys
+import os
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import concurrent.futures
+import cv2
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak RSS is then not reported
+    resource = None
+
+from SEM_Image_Analysis_Milled_Line_Detect import sem_image_analysis_milled_line_detect
+from SEM_Image_Analysis_Depo_Line_Detect import sem_image_analysis_depo_line_detect
+
+# Detector functions, and the polarity of the vertical marks they look for
+detectors = {'milled': sem_image_analysis_milled_line_detect,
+             'depo': sem_image_analysis_depo_line_detect}
+vertical_polarity = {'milled': 'dark', 'depo': 'bright'}
+
+# Import time budget in milliseconds (in a fresh interpreter, including numpy and tifffile) of the modules
+# run per image from the command line, and the packages they only import when needed
+import_budget = {'SEM_Image_Analysis_Milled_Line_Detect': 300,
+                 'SEM_Image_Analysis_Depo_Line_Detect': 300,
+                 'SEM_Image_Analysis_Batch': 350}
+lazy_packages = ['scipy', 'matplotlib', 'cv2']
+
+
+# Generate a synthetic SEM frame (uint8) with two horizontal and two vertical fiducial lines.
+# Horizontal lines are bright, vertical lines are bright or dark (vertical='bright' / 'dark').
+# Returns (image, truth, params): truth holds the line centres in full image pixels,
+# params the detector keyword args (crops etc.) that suit the frame.
+def make_synthetic_image(width=2048, height=None, vertical='dark', noise=10.0, gradient=20.0,
+                         line_contrast=60.0, seed=0):
+    if height is None:
+        height = int(width * 0.75)
+    rng = np.random.default_rng(seed)
+    scale = width / 2048.0
+
+    # illumination gradient (brighter towards the top right) + noise
+    yy = np.linspace(-1.0, 1.0, height)[:, None]
+    xx = np.linspace(-1.0, 1.0, width)[None, :]
+    image = 120.0 + gradient * (0.5 * xx - 0.5 * yy)
+    image = image + rng.normal(0.0, noise, (height, width))
+
+    # line positions, slightly randomised
+    h_rows = [int(height * (0.30 + rng.uniform(-0.03, 0.03))), int(height * (0.70 + rng.uniform(-0.03, 0.03)))]
+    v_cols = [int(width * (0.25 + rng.uniform(-0.03, 0.03))), int(width * (0.75 + rng.uniform(-0.03, 0.03)))]
+    sigma = max(2.0, 3.0 * scale)
+
+    rows = np.arange(height)[:, None]
+    for row in h_rows:
+        image = image + line_contrast * np.exp(-0.5 * ((rows - row) / sigma) ** 2)
+    cols = np.arange(width)[None, :]
+    sign = -1.0 if vertical == 'dark' else 1.0
+    for col in v_cols:
+        image = image + sign * line_contrast * np.exp(-0.5 * ((cols - col) / sigma) ** 2)
+
+    # databar along the bottom (dark band with a bright label block)
+    databar = int(height * 0.08)
+    image[height - databar:, :] = 20.0
+    image[height - int(databar * 0.7):height - int(databar * 0.3), int(width * 0.05):int(width * 0.3)] = 230.0
+
+    image = np.clip(image, 0, 255).astype(np.uint8)
+
+    params = {'crop_top': int(height * 0.05),
+              'crop_bottom': databar + int(height * 0.02),
+              'crop_left': int(width * 0.03),
+              'crop_right': int(width * 0.03),
+              'total_width_cols': int(width * 0.5),
+              'vertical_crop_extra': int(50 * scale),
+              'peak_width_max': int(800 * scale),
+              'peak_dist_max': int(width * 0.3),
+              'img_width': 20.0}
+    truth = {'horizontal': sorted(h_rows), 'vertical': sorted(v_cols)}
+    return image, truth, params
+
+
+# Write an image as an uncompressed TIFF (like most SEM software)
+def write_tiff(filename, image):
+    cv2.imwrite(filename, image, [cv2.IMWRITE_TIFF_COMPRESSION, 1])
+
+
+# Mean absolute error (pixels) between detected and true line positions, matched in order
+def position_error(detected, truth):
+    return float(np.mean(np.abs(np.sort(np.asarray(detected)) - np.asarray(truth))))
+
+
+# Peak resident memory of this process in bytes (None if not available)
+def peak_rss():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+# Time one function call, return (seconds, return value)
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    value = function(*args, **kwargs)
+    return time.perf_counter() - start, value
+
+
+# Run one benchmark case: one detector on one frame size.  Runs in a fresh process so the peak RSS
+# belongs to this case only.
+def run_case(detector_name, width, repeat, work_dir):
+    image, truth, params = make_synthetic_image(width, vertical=vertical_polarity[detector_name], seed=width)
+    filename = os.path.join(work_dir, detector_name + "_" + str(width) + ".tif")
+    write_tiff(filename, image)
+    del image
+    detector = detectors[detector_name]
+    prefix = os.path.join(work_dir, detector_name + "_" + str(width) + "_")
+
+    numbers_times = []
+    full_times = []
+    stage_times = {}
+    result = None
+    for i in range(repeat):
+        seconds, result = timed(detector, filename=filename, output_prefix=prefix, outputs={'numbers'}, **params)
+        numbers_times.append(seconds)
+        # full run with the stage times recorded (no memory tracing, it would slow the run down)
+        seconds, full_result = timed(detector, filename=filename, output_prefix=prefix,
+                                     outputs={'plots', 'annotated'}, instrument=True, instrument_memory=False,
+                                     **params)
+        full_times.append(seconds)
+        for name, stage in full_result.instrumentation['stages'].items():
+            stage_times.setdefault(name, []).append(stage['seconds'])
+
+    # medians of the repeats
+    numbers = float(np.median(numbers_times))
+    full = float(np.median(full_times))
+    stages = {name: float(np.median(values)) for name, values in stage_times.items()}
+
+    return {'detector': detector_name,
+            'width': width,
+            'height': int(width * 0.75),
+            'repeat': repeat,
+            'seconds_numbers': numbers,
+            'seconds_full': full,
+            'images_per_second_numbers': 1.0 / numbers if numbers > 0 else None,
+            'images_per_second_full': 1.0 / full if full > 0 else None,
+            'stages': stages,
+            'peak_rss': peak_rss(),
+            'horizontal_error_pix': position_error(result.horizontal_spike_pix_image, truth['horizontal']),
+            'vertical_error_pix': position_error(result.vertical_spike_pix_image, truth['vertical'])}
+
+
+# Import time of a module in a fresh interpreter in milliseconds (best of repeat, from python -X importtime),
+# and the lazy packages the import pulled in
+def import_time(module, repeat=5):
+    code = ("import sys, " + module + "\n" +
+            "print(','.join(name for name in " + repr(lazy_packages) + " if name in sys.modules))")
+    best = None
+    imported = []
+    for i in range(repeat):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+                                 cwd=os.path.dirname(os.path.abspath(__file__)))
+        # the last line is the module itself:  import time: self [us] | cumulative [us] | name
+        lines = [line for line in process.stderr.splitlines() if line.startswith('import time:')]
+        milliseconds = int(lines[-1].split('|')[1]) / 1000.0
+        best = milliseconds if best is None else min(best, milliseconds)
+        imported = [name for name in process.stdout.strip().split(',') if name]
+    return best, imported
+
+
+# Check the import time of each module in import_budget, returns {module: record}
+def import_report(repeat=5):
+    report = {}
+    for module, budget in import_budget.items():
+        milliseconds, imported = import_time(module, repeat)
+        report[module] = {'milliseconds': milliseconds,
+                          'budget_milliseconds': budget,
+                          'lazy_imported': imported,
+                          'ok': milliseconds <= budget and not imported}
+    return report
+
+
+# Print the import times against the budget
+def print_imports(report):
+    for module, record in report.items():
+        line = ("import " + module.ljust(40) + str(round(record['milliseconds'])).rjust(5) + " ms   (budget " +
+                str(record['budget_milliseconds']) + " ms)")
+        if record['lazy_imported']:
+            line += "   imports " + ", ".join(record['lazy_imported']) + " at import time"
+        print(line + ("" if record['ok'] else "   OVER BUDGET"))
+
+
+# Describe the code / machine being benchmarked
+def run_info():
+    info = {'time': time.strftime("%Y-%m-%d %H:%M:%S"),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'commit': None}
+    try:
+        info['commit'] = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                                 cwd=os.path.dirname(os.path.abspath(__file__)),
+                                                 stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return info
+
+
+# Last stored record of each case, from a results file
+def previous_cases(results_filename):
+    previous = {}
+    if results_filename is None or not os.path.isfile(results_filename):
+        return previous
+    with open(results_filename) as f:
+        for line in f:
+            if line.strip():
+                run = json.loads(line)
+                for case in run['cases']:
+                    previous[(case['detector'], case['width'])] = case
+    return previous
+
+
+# Benchmark function
+def sem_image_analysis_benchmark(**kwargs):
+    # Default parameters
+    verbose = kwargs.get('verbose', True)
+    # Frame widths in pixels (height is 0.75 x width)
+    sizes = kwargs.get('sizes', [1024, 2048, 4096])
+    detector_names = kwargs.get('detectors', ['milled', 'depo'])
+    # Number of timed repeats per case (the median is reported)
+    repeat = kwargs.get('repeat', 3)
+    # Results file, each run is appended as one json record (None to not store)
+    results_filename = kwargs.get('results', 'benchmark_results.jsonl')
+
+    imports = import_report()
+    if verbose:
+        print_imports(imports)
+
+    previous = previous_cases(results_filename)
+    work_dir = tempfile.mkdtemp(prefix='sem_benchmark_')
+    cases = []
+    try:
+        for width in sizes:
+            for detector_name in detector_names:
+                # fresh process per case, so the peak RSS is for that case only
+                with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+                    case = executor.submit(run_case, detector_name, width, repeat, work_dir).result()
+                cases.append(case)
+                if verbose:
+                    print_case(case, previous.get((detector_name, width)))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    run = {'info': run_info(), 'imports': imports, 'cases': cases}
+    if results_filename is not None:
+        with open(results_filename, 'a') as f:
+            f.write(json.dumps(run) + "\n")
+    return run
+
+
+# Print one case, with the change since the previous stored run
+def print_case(case, previous=None):
+    line = (case['detector'].ljust(7) + str(case['width']).rjust(6) + " px   " +
+            "numbers: " + str(round(case['images_per_second_numbers'], 2)).rjust(7) + " img/s   " +
+            "full: " + str(round(case['images_per_second_full'], 2)).rjust(6) + " img/s   " +
+            "error h/v: " + str(round(case['horizontal_error_pix'], 1)) + " / " +
+            str(round(case['vertical_error_pix'], 1)) + " px")
+    if case['peak_rss'] is not None:
+        line += "   peak RSS: " + str(round(case['peak_rss'] / 1024.0 ** 2)) + " MB"
+    if previous is not None and previous.get('images_per_second_numbers'):
+        change = case['images_per_second_numbers'] / previous['images_per_second_numbers'] - 1.0
+        line += "   (" + ("+" if change >= 0 else "") + str(round(100 * change)) + "% vs previous)"
+    print(line)
+    print("        stages [s]: " + "  ".join(name + " " + str(round(seconds, 4))
+                                          for name, seconds in case['stages'].items()))
+
+
+# If we are running this script interactively, call the function safely
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark the SEM line detectors on synthetic images.")
+    parser.add_argument('--sizes', default='1024,2048,4096',
+                        help="comma separated frame widths in pixels, e.g. 1024,4096,16384 (default 1024,2048,4096)")
+    parser.add_argument('--detectors', default='milled,depo', help="comma separated detectors (default milled,depo)")
+    parser.add_argument('--repeat', type=int, default=3, help="timed repeats per case (default 3)")
+    parser.add_argument('--results', default='benchmark_results.jsonl',
+                        help="file the results are appended to (default benchmark_results.jsonl)")
+    parser.add_argument('--imports_only', action='store_true',
+                        help="only check the import times against the budget (exit status 1 if over)")
+    args = parser.parse_args()
+
+    if args.imports_only:
+        import_records = import_report()
+        print_imports(import_records)
+        sys.exit(0 if all(record['ok'] for record in import_records.values()) else 1)
+
+    sem_image_analysis_benchmark(sizes=[int(size) for size in args.sizes.split(',')],
+                                 detectors=args.detectors.split(','),
+                                 repeat=args.repeat,
+                                 results=args.results)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+# On-disk result cache for the line detectors.
+# Results are keyed by a hash of the image file contents plus the detector and its full parameter set,
+# so re-running a batch only analyses images (or parameters) that have not been seen before.
+# A cache hit returns the stored result, with output_files pointing at the stored plots / annotated image,
+# and instrumentation {'cache_hit': True} (the stages timed when the entry was stored are not replayed).
+#
+# Layout:  cache_dir/<key[:2]>/<key>/result.json  (+ the output files written by the detector)
+# Each entry is written to a temporary folder inside the cache then renamed into place, so several
+# processes can share a cache.  When the cache grows beyond max_bytes the least recently used entries are removed.
+# Each process counts the cache size once, then adds the entries it stores; the cache is only scanned again
+# (and trimmed) when that running total passes max_bytes.
+
+# Imports
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+from SEM_Image_Analysis_Common import LineDetectResult, append_json_line
+
+# Change this when the detectors change in a way that makes stored results invalid
+cache_version = 1
+
+# Detector keyword args that do not change the result
+ignored_params = {'verbose', 'filename', 'output_prefix', 'instrument', 'instrument_memory', 'instrument_file',
+                  'streaming', 'strip_rows'}
+
+# Running total size in bytes of each cache folder used by this process
+cache_sizes = {}
+
+
+# sha256 of the file contents
+def file_hash(filename, block_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+
+# Make parameter values json-able, in a stable form (sets -> sorted lists)
+def normalise_param(value):
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    if isinstance(value, (list, tuple)):
+        return [normalise_param(v) for v in value]
+    return value
+
+
+class ResultCache(object):
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    # Cache key for an image file analysed with a detector and its keyword args
+    def key(self, detector_name, params):
+        key_params = {name: normalise_param(value) for name, value in params.items() if name not in ignored_params}
+        key_data = json.dumps({'version': cache_version,
+                               'image': file_hash(params['filename']),
+                               'detector': detector_name,
+                               'params': key_params}, sort_keys=True)
+        return hashlib.sha256(key_data.encode()).hexdigest()
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    # Return the stored result for a key, or None
+    def get(self, key, filename=None):
+        entry = self.entry_dir(key)
+        result_file = os.path.join(entry, 'result.json')
+        try:
+            with open(result_file) as f:
+                stored = json.load(f)
+            # mark as recently used
+            os.utime(result_file, None)
+        except (IOError, OSError, ValueError):
+            return None
+        result = LineDetectResult(**stored)
+        result.output_files = [os.path.join(entry, name) for name in stored['output_files']]
+        if filename is not None:
+            result.filename = filename
+        return result
+
+    # Run a detector through the cache, returns (result, hit)
+    def run(self, detector_name, detector, **params):
+        key = self.key(detector_name, params)
+        result = self.get(key, params['filename'])
+        if result is not None:
+            result.instrumentation = {'cache_hit': True}
+            if params.get('instrument_file') is not None:
+                append_json_line(params['instrument_file'], {'filename': params['filename'],
+                                                             'detector': detector_name,
+                                                             'instrumentation': result.instrumentation})
+            return result, True
+
+        # Analyse into a private temporary folder, then move it into place
+        sub_dir = os.path.join(self.cache_dir, key[:2])
+        os.makedirs(sub_dir, exist_ok=True)
+        temp_dir = tempfile.mkdtemp(prefix='.tmp_', dir=sub_dir)
+        added = 0
+        try:
+            name = os.path.splitext(os.path.basename(params['filename']))[0]
+            result = detector(output_prefix=os.path.join(temp_dir, name + "_"), **params)
+            stored = result.as_dict()
+            stored['output_files'] = [os.path.basename(path) for path in result.output_files]
+            with open(os.path.join(temp_dir, 'result.json'), 'w') as f:
+                json.dump(stored, f)
+            size = sum(f.stat().st_size for f in os.scandir(temp_dir) if f.is_file())
+            try:
+                os.rename(temp_dir, self.entry_dir(key))
+                added = size
+            except OSError:
+                # another process stored the same entry first, use theirs
+                shutil.rmtree(temp_dir, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+
+        result = self.get(key, params['filename'])
+        self.evict(keep=self.entry_dir(key), added=added)
+        return result, False
+
+    # List the cache entries as (last used, size in bytes, folder)
+    def entries(self):
+        entries = []
+        for sub in os.scandir(self.cache_dir):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.startswith('.tmp_') or not entry.is_dir():
+                    continue
+                try:
+                    last_used = os.stat(os.path.join(entry.path, 'result.json')).st_mtime
+                    size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+                except OSError:
+                    continue
+                entries.append((last_used, size, entry.path))
+        return entries
+
+    # Add the size of a new entry to the running total, and once that passes max_bytes remove the least recently
+    # used entries (except keep) until the cache fits.  The cache is scanned on first use and when trimming.
+    def evict(self, keep=None, added=0):
+        if self.max_bytes is None:
+            return
+        folder = os.path.abspath(self.cache_dir)
+        if folder in cache_sizes:
+            cache_sizes[folder] += added
+            if cache_sizes[folder] <= self.max_bytes:
+                return
+        entries = sorted(self.entries())
+        total = sum(size for last_used, size, path in entries)
+        for last_used, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+        cache_sizes[folder] = total
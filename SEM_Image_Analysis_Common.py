@@ -0,0 +1,798 @@
+#!/usr/bin/env python
+
+# Common code shared by the milled and deposited line detectors.
+
+# Imports
+# scipy, OpenCV and matplotlib are slow to import, so they are only imported where (and when) they are needed
+import json
+import time
+import functools
+import tracemalloc
+import numpy as np
+
+# Profile smoothing methods: 'kernel' applies the precomputed combined kernel in one pass,
+# 'savgol' runs savgol_filter repeatedly (the original method, kept to check the numbers against).
+smoothing_methods = {'kernel', 'savgol'}
+
+# Savitzky-Golay smoothing of the profiles: (window size, polynomial order, passes)
+horizontal_smoothing = (9, 2, 10)
+vertical_smoothing = (21, 2, 10)
+
+# Backends that sum the image profiles (see profile_sums).  Unless one is chosen, images with at least
+# opencv_min_pixels pixels are summed with OpenCV and smaller ones with numpy (importing OpenCV takes longer than
+# it saves on a normal sized image).
+profile_backends = {'numpy', 'opencv'}
+opencv_min_pixels = 2 ** 26
+
+# Skew estimation (see estimate_skew): the image is downsampled to about skew_pixels pixels, the angle searched for
+# in coarse then fine steps (degrees).  Skews under skew_min_angle degrees are not corrected (it would only blur).
+skew_pixels = 2 ** 20
+skew_coarse_step = 0.25
+skew_fine_step = 0.025
+skew_min_angle = 0.05
+
+# Confidence of the detected marks (see spike_confidence): spikes this many times the noise of their profile are
+# fully confident
+confidence_prominence = 10.0
+
+
+# Result of one call of a line detector.
+# Spike positions are given both in the cropped image coordinates (as used in the plots)
+# and in the full image coordinates (as drawn on the annotated image).
+# spike1 / spike2 are kept in the order the detector found them (spike1 is not always the upper / left one).
+class LineDetectResult(object):
+
+    def __init__(self, **kwargs):
+        self.filename = kwargs.get('filename', '')
+        # 'milled' or 'depo'
+        self.detector = kwargs.get('detector', '')
+        # Image size in pixels, and the real width supplied in microns
+        self.img_width = kwargs.get('img_width', 0)
+        self.img_height = kwargs.get('img_height', 0)
+        self.real_width = kwargs.get('real_width', 0.0)
+        # Pixels / micron
+        self.length_factor = kwargs.get('length_factor', 0.0)
+        # Initial crop
+        self.crop_top = kwargs.get('crop_top', 0)
+        self.crop_bottom = kwargs.get('crop_bottom', 0)
+        self.crop_left = kwargs.get('crop_left', 0)
+        self.crop_right = kwargs.get('crop_right', 0)
+
+        # Horizontal marks (rows), pixel positions from the top of the cropped image
+        self.horizontal_spike_pix = kwargs.get('horizontal_spike_pix', (0, 0))
+        # Spike strength (height of the spike above / below the neighbouring extrema) and gray level at the spike
+        self.horizontal_spike_strength = kwargs.get('horizontal_spike_strength', (0.0, 0.0))
+        self.horizontal_spike_level = kwargs.get('horizontal_spike_level', (0.0, 0.0))
+        # Distance between the horizontal marks in microns
+        self.horizontal_distance = kwargs.get('horizontal_distance', 0.0)
+
+        # Vertical marks (columns), pixel positions from the left of the cropped image
+        self.vertical_spike_pix = kwargs.get('vertical_spike_pix', (0, 0))
+        self.vertical_spike_strength = kwargs.get('vertical_spike_strength', (0.0, 0.0))
+        self.vertical_spike_level = kwargs.get('vertical_spike_level', (0.0, 0.0))
+        # Distance between the vertical marks in microns
+        self.vertical_distance = kwargs.get('vertical_distance', 0.0)
+
+        # Every qualifying mark (detector option all_marks), None unless asked for.  See mark_table.
+        self.horizontal_marks = kwargs.get('horizontal_marks', None)
+        self.vertical_marks = kwargs.get('vertical_marks', None)
+
+        # Frame number within a stack (see SEM_Image_Analysis_Stack.py), None for a single image
+        self.frame = kwargs.get('frame', None)
+
+        # Skew of the lines in degrees (clockwise as displayed, see estimate_skew), None unless deskewing was asked
+        # for.  The spike positions are then those in the cropped region rotated by this angle to straighten it.
+        self.skew_angle = kwargs.get('skew_angle', None)
+
+        # Distance between the horizontal marks in adjacent bands across the whole width (detector option bands),
+        # None unless asked for.  See thickness_map.
+        self.thickness_map = kwargs.get('thickness_map', None)
+
+        # Confidence of the marks (see spike_confidence): {'score': lower of the two, 'horizontal': {...},
+        # 'vertical': {...}}, and whether the score was below the detector's min_confidence (the frame is then
+        # flagged, and no plots or annotations are written)
+        self.confidence = kwargs.get('confidence', None)
+        self.flagged = kwargs.get('flagged', False)
+
+        # Files written by the detector
+        self.output_files = kwargs.get('output_files', [])
+
+        # Measurements of the run itself, e.g. {'profile_bytes_saved': ...}
+        self.instrumentation = kwargs.get('instrumentation', {})
+
+    # Horizontal spike positions in the full image (rows from the top of the original image)
+    @property
+    def horizontal_spike_pix_image(self):
+        return tuple(pix + self.crop_top for pix in self.horizontal_spike_pix)
+
+    # Vertical spike positions in the full image (columns from the left of the original image)
+    @property
+    def vertical_spike_pix_image(self):
+        return tuple(pix + self.crop_left for pix in self.vertical_spike_pix)
+
+    # Plain python types only, so the result can be pickled, or written as json / csv
+    def as_dict(self):
+        return {'filename': str(self.filename),
+                'detector': str(self.detector),
+                'img_width': int(self.img_width),
+                'img_height': int(self.img_height),
+                'real_width': float(self.real_width),
+                'length_factor': float(self.length_factor),
+                'crop_top': int(self.crop_top),
+                'crop_bottom': int(self.crop_bottom),
+                'crop_left': int(self.crop_left),
+                'crop_right': int(self.crop_right),
+                'horizontal_spike_pix': [int(v) for v in self.horizontal_spike_pix],
+                'horizontal_spike_pix_image': [int(v) for v in self.horizontal_spike_pix_image],
+                'horizontal_spike_strength': [float(v) for v in self.horizontal_spike_strength],
+                'horizontal_spike_level': [float(v) for v in self.horizontal_spike_level],
+                'horizontal_distance': float(self.horizontal_distance),
+                'vertical_spike_pix': [int(v) for v in self.vertical_spike_pix],
+                'vertical_spike_pix_image': [int(v) for v in self.vertical_spike_pix_image],
+                'vertical_spike_strength': [float(v) for v in self.vertical_spike_strength],
+                'vertical_spike_level': [float(v) for v in self.vertical_spike_level],
+                'vertical_distance': float(self.vertical_distance),
+                'horizontal_marks': self.horizontal_marks,
+                'vertical_marks': self.vertical_marks,
+                'frame': self.frame,
+                'skew_angle': None if self.skew_angle is None else float(self.skew_angle),
+                'thickness_map': self.thickness_map,
+                'confidence': self.confidence,
+                'flagged': bool(self.flagged),
+                'output_files': [str(v) for v in self.output_files],
+                'instrumentation': dict(self.instrumentation)}
+
+    def to_json(self):
+        return json.dumps(self.as_dict())
+
+    def __repr__(self):
+        return ("LineDetectResult(filename=" + repr(self.filename) +
+                ", horizontal_distance=" + str(self.horizontal_distance) +
+                ", vertical_distance=" + str(self.vertical_distance) + ")")
+
+
+# Records the wall time and allocated bytes of the named stages of a detector run.
+# Stages run one after the other: start('name') ends the previous stage, stop() ends the last one.
+# When not enabled the calls do nothing, so the detectors can always call them.
+# Allocated bytes are the peak memory traced by tracemalloc during the stage, above the level at its start
+# (numpy arrays are traced, OpenCV's own buffers are not).  tracemalloc slows allocation down, so memory
+# tracing can be switched off to only record times.
+class StageTimer(object):
+
+    def __init__(self, enabled=False, trace_memory=True):
+        self.enabled = enabled
+        self.trace_memory = enabled and trace_memory and hasattr(tracemalloc, 'reset_peak')
+        self.stages = {}
+        self.current = None
+        self.start_time = 0.0
+        self.start_bytes = 0
+        self.started_tracing = False
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+
+    def start(self, name):
+        if not self.enabled:
+            return
+        self.stop()
+        self.current = name
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            self.start_bytes = tracemalloc.get_traced_memory()[0]
+        self.start_time = time.perf_counter()
+
+    def stop(self):
+        if not self.enabled or self.current is None:
+            return
+        seconds = time.perf_counter() - self.start_time
+        stage = self.stages.setdefault(self.current, {'seconds': 0.0, 'bytes': None})
+        stage['seconds'] += seconds
+        if self.trace_memory:
+            allocated = tracemalloc.get_traced_memory()[1] - self.start_bytes
+            stage['bytes'] = max(stage['bytes'] or 0, allocated)
+        self.current = None
+
+    # End the last stage (and tracemalloc if we started it), return {name: {'seconds': s, 'bytes': b}}
+    def finish(self):
+        self.stop()
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+        return self.stages
+
+
+# Append one json record per line to a file (single write per record, so several processes can share the file)
+def append_json_line(filename, record):
+    with open(filename, 'a') as f:
+        f.write(json.dumps(record) + "\n")
+
+
+# Indices of the local minima and maxima of a profile (in order)
+def find_extrema(profile):
+    return np.diff(np.sign(np.diff(profile))).nonzero()[0] + 1
+
+
+# Columns (start, stop) of the band of total_width_cols columns centred in an image width columns wide,
+# exactly as the detectors slice imgdata[:, int(centre - half):int(centre + half)] (so also for odd or
+# too large widths, where the slice wraps or is clipped).
+def band_columns(width, total_width_cols):
+    half_total_width_cols = int(total_width_cols / 2.0)
+    centre = width / 2.0
+    start, stop, step = slice(int(centre - half_total_width_cols), int(centre + half_total_width_cols)).indices(width)
+    return start, max(start, stop)
+
+
+# Rows (start, stop) between the two horizontal spikes less vertical_crop_extra either side,
+# exactly as the detectors slice imgdata[int(min + extra):int(max - extra), :].
+def vertical_crop_rows(height, spike_pix, vertical_crop_extra):
+    start, stop, step = slice(int(min(spike_pix) + vertical_crop_extra),
+                              int(max(spike_pix) - vertical_crop_extra)).indices(height)
+    return start, max(start, stop)
+
+
+# Cumulative sums along each row of an integer image, with a leading column of zeros:
+# integral[:, j] is the sum of the first j pixels of each row.  Any band of columns start:stop is then
+# summed per row as integral[:, stop] - integral[:, start], without touching the image again.
+def column_integral(imgdata):
+    bound = int(np.iinfo(imgdata.dtype).max) * imgdata.shape[1] if imgdata.dtype.kind in 'ui' else None
+    dtype = np.int32 if bound is not None and bound < 2 ** 31 else np.int64
+    integral = np.zeros((imgdata.shape[0], imgdata.shape[1] + 1), dtype=dtype)
+    np.cumsum(imgdata, axis=1, dtype=dtype, out=integral[:, 1:])
+    return integral
+
+
+# Average gray level of each row over the columns start:stop, from a column integral.
+# Same values as average_profile(imgdata[:, start:stop], 1).
+def band_profile(integral, start, stop):
+    return (integral[:, stop] - integral[:, start]) / float(stop - start)
+
+
+# The two horizontal marks found separately in each of bands adjacent bands of columns across the whole width
+# of the cropped image, as the detectors find them in the central band: a map of the distance between the marks
+# (the layer thickness) along x.  The row profiles of all the bands are summed in one pass over the image and
+# smoothed together, so the cost is close to that of the single central band.
+# Returns a dict of lists with one entry per band: 'band_columns' [start, stop] in the cropped image,
+# 'spike_pix', 'spike_strength', and 'thickness' in microns (None where a mark was not found),
+# plus the 'mean_thickness' and 'thickness_range' (max - min) over the bands where both marks were found.
+def thickness_map(imgdata, bands, polarity, peak_width_max, peak_dist_max, length_factor, smoothing='kernel'):
+    edges = np.linspace(0, imgdata.shape[1], bands + 1).astype(int)
+    sums = np.add.reduceat(imgdata, edges[:-1], axis=1, dtype=np.int64 if imgdata.dtype.kind in 'ui' else None)
+    profiles = sums / np.diff(edges).astype(np.float64)
+    profiles = smooth_profiles(profiles.T, *horizontal_smoothing, method=smoothing)
+
+    band_map = {'band_columns': [], 'spike_pix': [], 'spike_strength': [], 'thickness': []}
+    for band, profile in enumerate(profiles):
+        pix, strength, level = select_spikes(profile, find_extrema(profile), polarity, peak_width_max, peak_dist_max)
+        band_map['band_columns'].append([int(edges[band]), int(edges[band + 1])])
+        band_map['spike_pix'].append([int(v) for v in pix])
+        band_map['spike_strength'].append([float(v) for v in strength])
+        # a mark that is not found has strength 0
+        found = strength[0] != 0 and strength[1] != 0
+        band_map['thickness'].append(abs(int(pix[1]) - int(pix[0])) / length_factor if found else None)
+    thickness = [value for value in band_map['thickness'] if value is not None]
+    band_map['mean_thickness'] = float(np.mean(thickness)) if thickness else None
+    band_map['thickness_range'] = float(max(thickness) - min(thickness)) if thickness else None
+    return band_map
+
+
+# Mean of each row_factor x column_factor block of an image (the rows / columns left over are dropped)
+def block_mean(imgdata, row_factor, column_factor):
+    height = imgdata.shape[0] // row_factor
+    width = imgdata.shape[1] // column_factor
+    blocks = imgdata[:height * row_factor, :width * column_factor].reshape(height, row_factor, width, column_factor)
+    return blocks.mean(axis=(1, 3))
+
+
+# Sharpness of the projection of an image onto the direction across lines at angle degrees: the mean value along
+# each line (in one pixel bins), then the energy of its gradient.  Highest when the projection lines are parallel
+# to the lines in the image (a Radon transform sample, scored by how sharp the projection is).
+# values, along and across are the flattened pixel values and coordinates along / across the projection lines.
+def projection_sharpness(values, along, across, angle):
+    bins = np.rint(across - along * np.tan(np.radians(angle))).astype(np.intp)
+    bins -= bins.min()
+    counts = np.bincount(bins)
+    profile = np.bincount(bins, values)
+    # the bins at the ends of the projection only cover a corner of the image, so are noisy
+    full = counts >= counts.max() / 2
+    profile = profile[full] / counts[full]
+    return float(np.sum(np.diff(profile) ** 2))
+
+
+# Angle (degrees) of the lines in an image, within +-max_skew degrees of horizontal / vertical.
+# Positive when the lines are turned clockwise as displayed (rows further right are lower).
+# The horizontal and vertical lines turn together, the angle that makes both the row and the column projections
+# the sharpest is searched for in coarse then fine steps.  The image is first downsampled to about skew_pixels
+# pixels, then averaged in blocks along the lines (as long as a line moves under a pixel in a block at max_skew),
+# so the projections stay sharp across the lines: the angle is resolved to about 1 / width radians.
+def estimate_skew(imgdata, max_skew=5.0):
+    factor = max(1, int(np.ceil(np.sqrt(imgdata.size / float(skew_pixels)))))
+    block = max(1, int(1.0 / np.tan(np.radians(max_skew))))
+    projections = []
+    for row_factor, column_factor in ((factor, factor * block), (factor * block, factor)):
+        small = block_mean(imgdata, row_factor, column_factor)
+        if small.shape[0] < 3 or small.shape[1] < 3:
+            return 0.0
+        rows, columns = np.indices(small.shape, dtype=np.float64)
+        # in downsampled pixels from the centre (a whole pixel, so the bins at angle 0 are exactly the rows /
+        # columns), the blocks are block pixels long
+        rows = (rows.ravel() - small.shape[0] // 2) * (row_factor // factor)
+        columns = (columns.ravel() - small.shape[1] // 2) * (column_factor // factor)
+        if column_factor > row_factor:
+            # rows: lines y = y0 + x tan(angle)
+            projections.append((small.ravel(), columns, rows))
+        else:
+            # columns: lines x = x0 - y tan(angle)
+            projections.append((small.ravel(), -rows, columns))
+    zero = [projection_sharpness(values, along, across, 0.0) or 1.0 for values, along, across in projections]
+
+    def sharpness(angle):
+        return sum(projection_sharpness(values, along, across, angle) / scale
+                   for (values, along, across), scale in zip(projections, zero))
+
+    # every coarse step over the whole range, then fine steps within a coarse step of the best angle
+    angles = np.arange(-max_skew, max_skew + skew_coarse_step / 2.0, skew_coarse_step)
+    best = angles[int(np.argmax([sharpness(angle) for angle in angles]))]
+    angles = best + skew_fine_step * np.arange(-10, 11)
+    scores = np.array([sharpness(angle) for angle in angles])
+    # the sharpness only changes once the lines move a whole pixel, so take the middle of the best angles
+    best = angles[scores >= scores.max()].mean()
+    return float(np.clip(best, -max_skew, max_skew))
+
+
+# Rotate an image about its centre so lines at angle degrees (see estimate_skew) become horizontal / vertical.
+# The corners brought in from outside the image repeat the nearest edge pixels.
+def deskew_image(imgdata, angle):
+    import cv2
+    height, width = imgdata.shape
+    rotation = cv2.getRotationMatrix2D(((width - 1) / 2.0, (height - 1) / 2.0), angle, 1.0)
+    return cv2.warpAffine(imgdata, rotation, (width, height), flags=cv2.INTER_LINEAR,
+                          borderMode=cv2.BORDER_REPLICATE)
+
+
+# Pick out the two biggest spikes in a smoothed gray level profile.
+# extrema:  indices of the local minima and maxima of the profile (in order)
+# polarity: 'max' for bright spikes (peaks), 'min' for dark spikes (dips)
+# Spikes wider than peak_width_max (distance between the extrema either side), or further than
+# peak_dist_max from both ends of the profile, are ignored.
+# Returns (spike1_pix, spike2_pix), (spike1_strength, spike2_strength), (spike1_level, spike2_level).
+# A spike that is not found is returned as pixel 0 with strength and level 0.
+#
+# This gives exactly the same answer as the original loop over the extrema, which kept two slots and
+# replaced the weaker one (slot 1 when equal) whenever a stronger valid spike came along.
+# The strengths, widths and edge distances are all computed as arrays, then only the few candidates
+# that the loop would have accepted are walked through to find which slot each winner ends up in.
+def select_spikes(profile, extrema, polarity, peak_width_max, peak_dist_max):
+    pix = [0, 0]
+    strength = [0, 0]
+    level = [0, 0]
+
+    if len(extrema) < 3:
+        return tuple(pix), tuple(strength), tuple(level)
+
+    left = profile[extrema[:-2]]
+    centre = profile[extrema[1:-1]]
+    right = profile[extrema[2:]]
+    if polarity == 'max':
+        h = (centre - left) + (centre - right)
+    elif polarity == 'min':
+        h = (left - centre) + (right - centre)
+    else:
+        raise ValueError("polarity must be 'max' or 'min', not " + repr(polarity))
+
+    centre_pix = extrema[1:-1]
+    width = extrema[2:] - extrema[:-2]
+    valid = (width < peak_width_max) & ((centre_pix < peak_dist_max) |
+                                        (centre_pix > (profile.shape[0] - peak_dist_max)))
+    h = h[valid]
+    centre_pix = centre_pix[valid]
+    if h.shape[0] == 0:
+        return tuple(pix), tuple(strength), tuple(level)
+
+    # Both slots start at 0, so a spike is only taken when it beats the second largest strength so far
+    # (including the two zeros).  Second largest of a prefix = running max of min(h[k], max(h[:k])).
+    prefix_max = np.maximum(np.maximum.accumulate(h), 0)
+    prev_max = np.concatenate(([0], prefix_max[:-1]))
+    prefix_second = np.maximum(np.maximum.accumulate(np.minimum(h, prev_max)), 0)
+    prev_second = np.concatenate(([0], prefix_second[:-1]))
+    accepted = (h > prev_second).nonzero()[0]
+
+    # Walk the accepted spikes in order, replacing the weaker slot (slot 1 when both are equal)
+    for k in accepted:
+        slot = 0 if strength[0] <= strength[1] else 1
+        strength[slot] = h[k]
+        pix[slot] = centre_pix[k]
+        level[slot] = profile[centre_pix[k]]
+
+    return tuple(pix), tuple(strength), tuple(level)
+
+
+# Pick out every spike in a smoothed gray level profile (for images with an array of marks).
+# Spikes are measured and filtered as in select_spikes, and kept if their strength is at least
+# min_fraction of the strongest one (so noise wiggles are dropped).
+# Returns arrays (pix, strength, level) ranked by strength, strongest first.
+def select_marks(profile, extrema, polarity, peak_width_max, peak_dist_max, min_fraction=0.5):
+    if len(extrema) < 3:
+        return np.zeros(0, dtype=int), np.zeros(0), np.zeros(0)
+
+    left = profile[extrema[:-2]]
+    centre = profile[extrema[1:-1]]
+    right = profile[extrema[2:]]
+    if polarity == 'max':
+        h = (centre - left) + (centre - right)
+    elif polarity == 'min':
+        h = (left - centre) + (right - centre)
+    else:
+        raise ValueError("polarity must be 'max' or 'min', not " + repr(polarity))
+
+    centre_pix = extrema[1:-1]
+    width = extrema[2:] - extrema[:-2]
+    valid = (width < peak_width_max) & ((centre_pix < peak_dist_max) |
+                                        (centre_pix > (profile.shape[0] - peak_dist_max))) & (h > 0)
+    h = h[valid]
+    centre_pix = centre_pix[valid]
+    if h.shape[0] > 0:
+        keep = h >= min_fraction * h.max()
+        h = h[keep]
+        centre_pix = centre_pix[keep]
+
+    # strongest first (stable, so equal strengths stay in position order)
+    order = np.argsort(-h, kind='stable')
+    return centre_pix[order], h[order], profile[centre_pix[order]]
+
+
+# Confidence (0 to 1) that the two spikes picked in a profile are real marks, from three cheap measures:
+#   prominence:      the weaker spike's strength over the noise of the profile (the robust spread of the raw profile
+#                    about the smoothed one), scores 1 from confidence_prominence up
+#   third_fraction:  the strength of the best other candidate as a fraction of the weaker spike, scores 1 - it
+#                    (a clear pair stands out from the rest; not used with several marks expected, use_gap False)
+#   centre_offset:   distance of the middle of the pair from the centre of the profile, as a fraction of half its
+#                    length, scores 1 - it (the marks are either side of the centre)
+# The score is the lowest of the three, 0 when a spike was not found.
+# profile_raw and profile are the raw and smoothed profiles the spikes (pix, strength) were picked from, at full
+# resolution (the pyramid path gives its coarse profiles stretched to full resolution).
+# Returns a dict of plain python types: 'score' and the three measures.
+def spike_confidence(profile_raw, profile, polarity, pix, strength, peak_width_max, peak_dist_max, use_gap=True):
+    residual = np.asarray(profile_raw, dtype=np.float64) - profile
+    # (floored, so a profile without noise still gives a finite ratio)
+    noise = max(1.4826 * float(np.median(np.abs(residual - np.median(residual)))), 1e-3)
+    weaker = float(min(strength))
+    prominence = max(weaker, 0.0) / noise
+
+    candidates = select_marks(profile, find_extrema(profile), polarity, peak_width_max, peak_dist_max, 0.0)[1]
+    third_fraction = float(candidates[2]) / weaker if use_gap and len(candidates) > 2 and weaker > 0 else 0.0
+    half = profile.shape[0] / 2.0
+    centre_offset = abs((float(pix[0]) + float(pix[1])) / 2.0 - half) / half if half else 1.0
+
+    if weaker <= 0:
+        score = 0.0
+    else:
+        score = min(min(prominence / confidence_prominence, 1.0), 1.0 - third_fraction, 1.0 - centre_offset)
+    return {'score': max(0.0, score),
+            'prominence': prominence,
+            'third_fraction': third_fraction,
+            'centre_offset': centre_offset}
+
+
+# Table of marks for a LineDetectResult, plain python types:
+# pix / pix_image (cropped / full image pixels), strength and level, ranked by strength;
+# distances: matrix of the distance in microns between every pair of marks (in the ranked order);
+# positions: the mark positions (cropped image pixels) from top / left to bottom / right,
+# spacing: the distance in microns between each neighbouring pair of those.
+def mark_table(pix, strength, level, offset, length_factor):
+    pix = np.asarray(pix, dtype=np.int64)
+    positions = np.sort(pix)
+    return {'pix': [int(v) for v in pix],
+            'pix_image': [int(v) + offset for v in pix],
+            'strength': [float(v) for v in strength],
+            'level': [float(v) for v in level],
+            'distances': (np.abs(pix[:, None] - pix[None, :]) / length_factor).tolist(),
+            'positions': [int(v) for v in positions],
+            'spacing': (np.diff(positions) / length_factor).tolist()}
+
+
+# One savgol_filter(window, order) pass (mode 'interp') on profiles of the given size, as a (size, size) matrix.
+# Inside, each output is the least squares polynomial fit of the window around it, evaluated at its centre;
+# the first and last window // 2 outputs are the fit to the first / last window points, as savgol does.
+# Built with numpy, so the default smoothing does not need scipy (same values as scipy to rounding).
+def savgol_matrix(size, window, order):
+    if size < window:
+        # as savgol_filter
+        raise ValueError("If mode is 'interp', window_length must be less than or equal to the size of x.")
+    half = window // 2
+    x = np.arange(-half, window - half, dtype=float)
+    coeffs = np.linalg.pinv(x ** np.arange(order + 1).reshape(-1, 1))[:, 0]
+    matrix = np.zeros((size, size))
+    for i in range(half, size - half):
+        matrix[i, i - half:i + half + 1] = coeffs
+    fit = np.linalg.pinv(np.vander(np.arange(window, dtype=float), order + 1))
+    matrix[:half, :window] = np.vander(np.arange(half, dtype=float), order + 1).dot(fit)
+    matrix[size - half:, size - window:] = np.vander(np.arange(window - half, window, dtype=float),
+                                                     order + 1).dot(fit)
+    return matrix
+
+
+# Build the linear operator equivalent to `passes` repeated savgol_filter(window, order) calls (mode 'interp').
+# Away from the ends every output point is the input convolved with one combined kernel, reaching
+# passes * (window // 2) points either side.  Only the first and last `reach` outputs see the polynomial
+# fit savgol uses at the ends, and they depend on at most 2 * reach + 1 input points, so those rows are
+# kept as small matrices.  Short profiles (where the two ends interact) keep the whole matrix instead.
+# Returns (kernel, left, right, full); full is None unless the profile is short.
+@functools.lru_cache(maxsize=32)
+def smoothing_operator(window, order, passes, length):
+    reach = passes * (window // 2)
+    size = 4 * reach + 1
+    if length is not None and length <= size:
+        size = length
+
+    # Push the identity through the filter passes, column j is the response to input point j
+    operator = np.eye(size)
+    matrix = savgol_matrix(size, window, order)
+    for i in range(passes):
+        operator = matrix.dot(operator)
+
+    if size == length:
+        return None, None, None, operator
+
+    kernel = operator[2 * reach, reach:3 * reach + 1][::-1].copy()
+    left = operator[:reach, :2 * reach + 1].copy()
+    right = operator[-reach:, -(2 * reach + 1):].copy()
+    return kernel, left, right, None
+
+
+# Smooth a gray level profile with `passes` savitzky-golay filters of the given window and polynomial order.
+# method 'kernel' gives the same result (to rounding) as method 'savgol', with one convolution
+# instead of a filter pass (and a new array) per repeat.
+def smooth_profile(profile, window, order, passes, method='kernel'):
+    if method == 'savgol':
+        from scipy.signal import savgol_filter
+        for i in range(passes):
+            profile = savgol_filter(profile, window, order)
+        return profile
+    if method != 'kernel':
+        raise ValueError("smoothing method must be one of " + ", ".join(sorted(smoothing_methods)) +
+                         ", not " + repr(method))
+
+    length = profile.shape[0]
+    reach = passes * (window // 2)
+    # The operator for long profiles does not depend on the length, so share one cache entry
+    kernel, left, right, full = smoothing_operator(window, order, passes,
+                                                   length if length <= 4 * reach + 1 else None)
+    if full is not None:
+        return full.dot(profile)
+
+    smoothed = np.empty(length)
+    smoothed[reach:length - reach] = np.convolve(profile, kernel, mode='valid')
+    smoothed[:reach] = left.dot(profile[:2 * reach + 1])
+    smoothed[length - reach:] = right.dot(profile[length - (2 * reach + 1):])
+    return smoothed
+
+
+# Integer sums of each row (axis=1) or each column (axis=0) of an integer image, with the bytes of accumulator used.
+# backend 'opencv' sums 8 bit images with cv2.reduce, 'numpy' (and any other image) uses int64 numpy sums over
+# chunks of rows.  None picks OpenCV for 8 bit images of at least opencv_min_pixels pixels.
+def profile_sums(imgdata, axis, chunk_rows=512, backend=None):
+    if backend is None:
+        backend = 'opencv' if imgdata.size >= opencv_min_pixels else 'numpy'
+    elif backend not in profile_backends:
+        raise ValueError("profile backend must be one of " + ", ".join(sorted(profile_backends)) +
+                         ", not " + repr(backend))
+    if backend == 'opencv' and imgdata.dtype == np.uint8 and imgdata.shape[0] < 2 ** 23:
+        # 255 * rows fits in int32
+        import cv2
+        sums = cv2.reduce(imgdata, axis, cv2.REDUCE_SUM, dtype=cv2.CV_32S).reshape(-1)
+        return sums, sums.nbytes
+    if axis == 1:
+        sums = np.empty(imgdata.shape[0], dtype=np.int64)
+        for row in range(0, imgdata.shape[0], chunk_rows):
+            sums[row:row + chunk_rows] = imgdata[row:row + chunk_rows].sum(axis=1, dtype=np.int64)
+        return sums, sums.nbytes
+    sums = np.zeros(imgdata.shape[1], dtype=np.int64)
+    for row in range(0, imgdata.shape[0], chunk_rows):
+        sums += imgdata[row:row + chunk_rows].sum(axis=0, dtype=np.int64)
+    return sums, 2 * sums.nbytes
+
+
+# Smooth several profiles of the same length at once, one per row of profiles (N, length).
+# Same values as smooth_profile on each row, the combined kernel is applied to all rows in one product.
+def smooth_profiles(profiles, window, order, passes, method='kernel'):
+    if method == 'savgol':
+        from scipy.signal import savgol_filter
+        for i in range(passes):
+            profiles = savgol_filter(profiles, window, order, axis=1)
+        return profiles
+    if method != 'kernel':
+        raise ValueError("smoothing method must be one of " + ", ".join(sorted(smoothing_methods)) +
+                         ", not " + repr(method))
+
+    length = profiles.shape[1]
+    reach = passes * (window // 2)
+    kernel, left, right, full = smoothing_operator(window, order, passes,
+                                                   length if length <= 4 * reach + 1 else None)
+    if full is not None:
+        return profiles.dot(full.T)
+
+    smoothed = np.empty(profiles.shape)
+    windows = np.lib.stride_tricks.sliding_window_view(profiles, kernel.shape[0], axis=1)
+    smoothed[:, reach:length - reach] = windows.dot(kernel[::-1])
+    smoothed[:, :reach] = profiles[:, :2 * reach + 1].dot(left.T)
+    smoothed[:, length - reach:] = profiles[:, length - (2 * reach + 1):].dot(right.T)
+    return smoothed
+
+
+# Average gray level of each row (axis=1) or each column (axis=0) of an image, as float64.
+# Gives the same values as np.average(imgdata, axis=axis), but integer images are summed into integer
+# accumulators (see profile_sums), so the pixels are never converted to float64.
+# Only the sums (one per row / column) are converted.
+# If stats (a dict) is given, stats['profile_bytes_saved'] is increased by the size of the float64
+# copy of the image region that is avoided, less the accumulators used.
+# backend chooses how the sums are made (see profile_sums).
+def average_profile(imgdata, axis, stats=None, chunk_rows=512, backend=None):
+    if imgdata.size == 0 or imgdata.dtype.kind not in 'ui':
+        return np.average(imgdata, axis=axis)
+
+    sums, accumulator_bytes = profile_sums(imgdata, axis, chunk_rows, backend)
+
+    if stats is not None:
+        stats['profile_bytes_saved'] = (stats.get('profile_bytes_saved', 0) +
+                                        imgdata.size * 8 - accumulator_bytes)
+
+    return sums / imgdata.shape[axis]
+
+
+# Profiles of an image read a strip of rows at a time (from a RowStripReader, see SEM_Image_Analysis_Loader.py),
+# so only one strip is ever in memory.
+# The first pass builds the row profile of the band of columns band_start:band_stop, and keeps the column sums
+# of each strip.  The column profile of any range of rows (the vertical crop, only known after the first pass)
+# is then the sum of the strips inside it, plus the partial strips at its ends, which are the only rows read again.
+# The profiles are the same as average_profile gives on the whole image in memory.
+class StreamedProfiles(object):
+
+    def __init__(self, reader, band_start, band_stop, strip_rows=1024, stats=None):
+        self.reader = reader
+        self.stats = stats
+        height, width = reader.shape
+        row_sums = np.zeros(height, dtype=np.int64)
+        self.strip_ranges = []
+        strip_sums = []
+        for row, strip in reader.strips(strip_rows):
+            if band_stop > band_start:
+                row_sums[row:row + strip.shape[0]] = profile_sums(strip[:, band_start:band_stop], 1)[0]
+            strip_sums.append(profile_sums(strip, 0)[0].astype(np.int64))
+            self.strip_ranges.append((row, row + strip.shape[0]))
+        self.strip_sums = np.array(strip_sums, dtype=np.int64).reshape(len(strip_sums), width)
+
+        if band_stop > band_start and height > 0:
+            self.row_profile = row_sums / float(band_stop - band_start)
+        else:
+            # empty band, same (nan) profile as average_profile
+            self.row_profile = np.average(np.empty((height, band_stop - band_start)), axis=1)
+        if stats is not None:
+            stats['streamed_rows_read'] = stats.get('streamed_rows_read', 0) + height
+
+    # Average gray level of each column over the rows start:stop
+    def column_profile(self, start, stop):
+        width = self.reader.shape[1]
+        if stop <= start:
+            return np.average(np.empty((0, width)), axis=0)
+        sums = np.zeros(width, dtype=np.int64)
+        for (strip_start, strip_stop), strip_sum in zip(self.strip_ranges, self.strip_sums):
+            if strip_stop <= start or strip_start >= stop:
+                continue
+            if start <= strip_start and strip_stop <= stop:
+                sums += strip_sum
+            else:
+                # partial strip at an end of the range, read its rows again
+                row0 = max(start, strip_start)
+                row1 = min(stop, strip_stop)
+                sums += profile_sums(self.reader.read(row0, row1), 0)[0]
+                if self.stats is not None:
+                    self.stats['streamed_rows_read'] = self.stats.get('streamed_rows_read', 0) + row1 - row0
+        return sums / float(stop - start)
+
+
+# Smoothing settings for a profile downsampled by factor: the window shrinks with the level (kept odd and
+# longer than the polynomial order), the number of passes stays the same.
+def scaled_smoothing(settings, factor):
+    window, order, passes = settings
+    window = max(int(round(window / float(factor))), order + 1)
+    if window % 2 == 0:
+        window += 1
+    return window, order, passes
+
+
+# Coarse-to-fine spike detection.
+# The spikes are found on the profiles of the cropped image downsampled by factor, with the smoothing windows,
+# peak_width_max and peak_dist_max scaled down by the factor.  Each spike found is then refined at full resolution:
+# the full resolution profile is built (and smoothed with the full resolution settings) only in a small window
+# around it, and the spike moved to the most extreme point there.
+# The image is read through a RowStripReader (see SEM_Image_Analysis_Loader.py), so when it is not already in
+# memory only the downsampled image (or a level stored in a pyramidal TIFF) and the small windows are read.
+# Positions are full resolution pixels; the strengths are those measured on the coarse profile.
+class PyramidLevel(object):
+
+    def __init__(self, reader, factor, strip_rows=1024, smoothing='kernel'):
+        self.reader = reader
+        self.factor = factor
+        self.smoothing = smoothing
+        # coarse pixel (i, j) is the block of factor x factor pixels from origin + (i, j) * factor
+        self.coarse, self.origin = reader.reduced(factor, strip_rows)
+        # refined spikes are searched for within this many full resolution pixels of the coarse position
+        self.margin = 2 * factor
+
+    # Coarse pixels lying within full resolution positions start:stop, along axis 0 (rows) or 1 (columns)
+    def coarse_range(self, start, stop, axis):
+        origin = self.origin[axis]
+        return max(0, -(-(start - origin) // self.factor)), max(0, (stop - origin) // self.factor)
+
+    # Spikes of the row profile of the band of columns band_start:band_stop
+    # Returns the spikes (as select_spikes), and the raw and smoothed coarse profiles stretched to full resolution
+    def horizontal(self, band_start, band_stop, polarity, peak_width_max, peak_dist_max):
+        col_start, col_stop = self.coarse_range(band_start, band_stop, 1)
+        return self.spikes(average_profile(self.coarse[:, col_start:col_stop], 1), 0, horizontal_smoothing,
+                           lambda start, stop: average_profile(
+                               self.reader.read_region(start, stop, band_start, band_stop), 1),
+                           polarity, peak_width_max, peak_dist_max)
+
+    # Spikes of the column profile of the rows row_start:row_stop
+    def vertical(self, row_start, row_stop, polarity, peak_width_max, peak_dist_max):
+        coarse_start, coarse_stop = self.coarse_range(row_start, row_stop, 0)
+        return self.spikes(average_profile(self.coarse[coarse_start:coarse_stop, :], 0), 1, vertical_smoothing,
+                           lambda start, stop: average_profile(
+                               self.reader.read_region(row_start, row_stop, start, stop), 0),
+                           polarity, peak_width_max, peak_dist_max)
+
+    # Find the spikes on a coarse profile along axis, then refine each at full resolution.
+    # full_profile(start, stop) returns the full resolution profile between those positions.
+    def spikes(self, coarse_raw, axis, settings, full_profile, polarity, peak_width_max, peak_dist_max):
+        factor = self.factor
+        length = self.reader.shape[axis]
+        # full resolution position of the centre of each coarse pixel
+        positions = self.origin[axis] + np.arange(coarse_raw.shape[0]) * factor + factor // 2
+
+        coarse_smoothed = smooth_profile(coarse_raw, *scaled_smoothing(settings, factor), method=self.smoothing)
+        pix, strength, level = select_spikes(coarse_smoothed, find_extrema(coarse_smoothed), polarity,
+                                             peak_width_max / float(factor), peak_dist_max / float(factor))
+
+        # kept for marks()
+        self.last = (coarse_smoothed, positions, length, settings, full_profile, polarity)
+
+        pix = list(pix)
+        level = list(level)
+        for i in range(2):
+            if strength[i] == 0:
+                # not found
+                continue
+            pix[i], level[i] = self.refine(positions[pix[i]], length, settings, full_profile, polarity)
+
+        # coarse profiles at full resolution positions, for plotting
+        if coarse_raw.shape[0] > 0:
+            full_positions = np.arange(length)
+            raw = np.interp(full_positions, positions, coarse_raw)
+            smoothed = np.interp(full_positions, positions, coarse_smoothed)
+        else:
+            raw = smoothed = np.full(length, np.nan)
+        return (tuple(pix), tuple(strength), tuple(level)), raw, smoothed
+
+    # Full resolution position and level of the spike within margin of centre
+    def refine(self, centre, length, settings, full_profile, polarity):
+        window, order, passes = settings
+        reach = passes * (window // 2)
+        start = max(0, centre - self.margin)
+        stop = min(length, centre + self.margin + 1)
+        # the profile either side of the window too, so the smoothed values in the window are not edge values
+        extended_start = max(0, start - 2 * reach)
+        extended_stop = min(length, stop + 2 * reach)
+        smoothed = smooth_profile(full_profile(extended_start, extended_stop), *settings, method=self.smoothing)
+        smoothed = smoothed[start - extended_start:stop - extended_start]
+        best = int(np.argmax(smoothed)) if polarity == 'max' else int(np.argmin(smoothed))
+        return start + best, smoothed[best]
+
+    # Every mark (see select_marks) on the profile of the last horizontal() / vertical() call, refined
+    def marks(self, peak_width_max, peak_dist_max, min_fraction=0.5):
+        coarse_smoothed, positions, length, settings, full_profile, polarity = self.last
+        pix, strength, level = select_marks(coarse_smoothed, find_extrema(coarse_smoothed), polarity,
+                                            peak_width_max / float(self.factor), peak_dist_max / float(self.factor),
+                                            min_fraction)
+        refined = [self.refine(positions[p], length, settings, full_profile, polarity) for p in pix]
+        return (np.array([r[0] for r in refined], dtype=int), strength,
+                np.array([r[1] for r in refined], dtype=float))
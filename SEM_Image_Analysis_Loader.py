@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+# Image loading for the line detectors.
+# Only the region inside the crop margins is read when possible:
+#  - uncompressed TIFFs are memory-mapped, so only the pages holding the cropped rows are touched
+#  - strip / tiled TIFFs only decode the strips / tiles that overlap the cropped region
+#  - anything else (other formats, colour, 16 bit, missing tifffile or codec) is read whole with OpenCV
+# The region is returned as a view where possible, nothing is copied down the pipeline.
+# For images too big to hold in memory, RowStripReader reads the cropped region a strip of rows at a time.
+# The tifffile package is optional, without it every image is read with OpenCV.
+# OpenCV is only imported when it is used (it is slow to import, and TIFFs read with tifffile do not need it).
+
+# Imports
+import math
+import numpy as np
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+
+# Convert crop margins to the row / column ranges kept, exactly as the slice
+# imgdata[crop_top:(height - crop_bottom), crop_left:(width - crop_right)] would.
+def crop_ranges(height, width, crop_top, crop_bottom, crop_left, crop_right):
+    top, bottom, step = slice(crop_top, height - crop_bottom).indices(height)
+    left, right, step = slice(crop_left, width - crop_right).indices(width)
+    return top, max(top, bottom), left, max(left, right)
+
+
+# True for a TIFF page this loader can read directly: 8 bit grayscale, one sample per pixel
+def is_gray8_page(page):
+    return (page.dtype == np.uint8 and page.samplesperpixel == 1 and page.imagedepth == 1 and
+            page.photometric == tifffile.PHOTOMETRIC.MINISBLACK)
+
+
+# Rows per strip / tile of a TIFF page, and the width of a segment
+def segment_shape(page):
+    if page.is_tiled:
+        return page.tilelength, page.tilewidth
+    return min(page.rowsperstrip, page.imagelength), page.imagewidth
+
+
+# Decode the region rows top:bottom, columns left:right of a strip / tiled TIFF page.
+# Only the segments overlapping the region are read and decoded.
+def decode_tiff_region(tif, page, top, bottom, left, right):
+    height = page.imagelength
+    width = page.imagewidth
+    seg_height, seg_width = segment_shape(page)
+    segs_across = -(-width // seg_width)
+
+    region = np.empty((bottom - top, right - left), dtype=np.uint8)
+    filehandle = tif.filehandle
+    for index, (offset, bytecount) in enumerate(zip(page.dataoffsets, page.databytecounts)):
+        seg_top = (index // segs_across) * seg_height
+        seg_left = (index % segs_across) * seg_width
+        if (seg_top >= bottom or seg_top + seg_height <= top or
+                seg_left >= right or seg_left + seg_width <= left):
+            continue
+        filehandle.seek(offset)
+        segment = page.decode(filehandle.read(bytecount), index)[0]
+        segment = segment.reshape(segment.shape[-3], segment.shape[-2])
+        # overlap of the segment with the region
+        row0 = max(top, seg_top)
+        row1 = min(bottom, seg_top + segment.shape[0])
+        col0 = max(left, seg_left)
+        col1 = min(right, seg_left + segment.shape[1])
+        region[row0 - top:row1 - top, col0 - left:col1 - left] = \
+            segment[row0 - seg_top:row1 - seg_top, col0 - seg_left:col1 - seg_left]
+    return region
+
+
+# Read the region rows top:bottom, columns left:right of a TIFF page without mapping or loading the rest:
+# uncompressed pages read just the bytes of those rows, strip / tiled pages decode just the overlapping segments.
+def read_page_region(tif, page, top, bottom, left, right):
+    if page.is_contiguous:
+        width = page.imagewidth
+        tif.filehandle.seek(page.dataoffsets[0] + top * width)
+        rows = np.frombuffer(tif.filehandle.read((bottom - top) * width), dtype=np.uint8)
+        return rows.reshape(bottom - top, width)[:, left:right]
+    return decode_tiff_region(tif, page, top, bottom, left, right)
+
+
+# Downsample an image by an integer factor, each output pixel the average of a factor x factor block
+# (the rows / columns left over at the bottom / right are dropped).  Powers of two are halved repeatedly,
+# which OpenCV does much faster than one area resize.
+def downsample(imgdata, factor):
+    height = imgdata.shape[0] // factor
+    width = imgdata.shape[1] // factor
+    if height == 0 or width == 0:
+        return np.zeros((height, width), dtype=imgdata.dtype)
+    import cv2
+    coarse = imgdata[:height * factor, :width * factor]
+    while factor % 2 == 0:
+        # exactly half size: the linear resize averages each 2 x 2 block
+        coarse = cv2.resize(coarse, (coarse.shape[1] // 2, coarse.shape[0] // 2), interpolation=cv2.INTER_LINEAR)
+        factor //= 2
+    if factor > 1:
+        coarse = cv2.resize(coarse, (width, height), interpolation=cv2.INTER_AREA)
+    return coarse
+
+
+# Read the region rows top:bottom, columns left:right from the first page of an 8 bit grayscale TIFF.
+# Returns (region, height, width), or None when the file cannot be read this way.
+def read_tiff_region(filename, crop_top, crop_bottom, crop_left, crop_right):
+    with tifffile.TiffFile(filename) as tif:
+        page = tif.pages[0]
+        if not is_gray8_page(page):
+            return None
+        height = page.imagelength
+        width = page.imagewidth
+        top, bottom, left, right = crop_ranges(height, width, crop_top, crop_bottom, crop_left, crop_right)
+
+        # Uncompressed and contiguous: map the file, the region is a view of the map
+        if page.is_contiguous:
+            imgdata = tifffile.memmap(filename, page=0, mode='r')
+            # (plain ndarray view of the map, so results are not memmap subclasses)
+            return np.asarray(imgdata[top:bottom, left:right]), height, width
+
+        # Strips / tiles: decode only the segments overlapping the region
+        return decode_tiff_region(tif, page, top, bottom, left, right), height, width
+
+
+# Reads the region inside the crop margins a few rows at a time, for images too big to hold in memory.
+# Only one strip of rows is held at a time: uncompressed TIFFs read just the bytes of those rows,
+# strip / tiled TIFFs decode just the segments overlapping them.  Anything else is read whole with OpenCV
+# (so is not bounded in memory) and the strips are views of it.  An image already in memory can be given
+# as imgdata instead, so the same code can run on either.
+# Rows and columns are numbered from the top left of the cropped region.
+class RowStripReader(object):
+
+    def __init__(self, filename, crop_top=0, crop_bottom=0, crop_left=0, crop_right=0, imgdata=None):
+        self.tif = None
+        self.page = None
+        self.imgdata = imgdata
+        # segments are never split between strips
+        self.segment_rows = 1
+
+        if imgdata is not None:
+            self.set_region(imgdata.shape[0], imgdata.shape[1], crop_top, crop_bottom, crop_left, crop_right)
+            return
+
+        if tifffile is not None and filename.lower().endswith(('.tif', '.tiff')):
+            try:
+                self.tif = tifffile.TiffFile(filename)
+                self.page = self.tif.pages[0]
+                if not is_gray8_page(self.page):
+                    self.close()
+                else:
+                    if not self.page.is_contiguous:
+                        self.segment_rows = segment_shape(self.page)[0]
+                    self.set_region(self.page.imagelength, self.page.imagewidth,
+                                    crop_top, crop_bottom, crop_left, crop_right)
+                    # decode one row now, so a missing codec falls back to OpenCV here rather than part way
+                    self.read(0, min(1, self.shape[0]))
+            except Exception:
+                # not a TIFF tifffile can read (e.g. missing codec), fall back to OpenCV
+                self.close()
+
+        if self.tif is None:
+            import cv2
+            self.segment_rows = 1
+            self.imgdata = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
+            if self.imgdata is None:
+                raise IOError("could not read the image " + filename)
+            self.set_region(self.imgdata.shape[0], self.imgdata.shape[1],
+                            crop_top, crop_bottom, crop_left, crop_right)
+
+    # Image size, and the rows / columns kept by the crop
+    def set_region(self, height, width, crop_top, crop_bottom, crop_left, crop_right):
+        self.img_height = height
+        self.img_width = width
+        self.top, self.bottom, self.left, self.right = crop_ranges(height, width,
+                                                                   crop_top, crop_bottom, crop_left, crop_right)
+        # shape of the cropped region
+        self.shape = (self.bottom - self.top, self.right - self.left)
+
+    # Rows start:stop of the cropped region
+    def read(self, start, stop):
+        return self.read_region(start, stop, 0, self.shape[1])
+
+    # Rows start:stop, columns col_start:col_stop of the cropped region
+    def read_region(self, start, stop, col_start, col_stop):
+        top = self.top + start
+        bottom = self.top + stop
+        left = self.left + col_start
+        right = self.left + col_stop
+        if self.imgdata is not None:
+            return self.imgdata[top:bottom, left:right]
+        if self.page.is_contiguous and col_stop - col_start < self.shape[1]:
+            # a narrow window of an uncompressed image: map the file, only the pages holding it are read
+            return np.array(tifffile.memmap(self.tif.filehandle.path, page=0, mode='r')[top:bottom, left:right])
+        return read_page_region(self.tif, self.page, top, bottom, left, right)
+
+    # The cropped region downsampled by factor (see downsample), and the position in the cropped region of the
+    # top left of its first pixel, as (image, (row, column)).
+    # A reduced resolution level stored in a pyramidal TIFF is used when there is one for this factor,
+    # otherwise the region is read a strip of rows at a time and each strip downsampled.
+    # An image given in memory is downsampled from the top left of the crop, a file from the top left of the image.
+    def reduced(self, factor, strip_rows=1024):
+        if self.imgdata is not None:
+            return downsample(self.imgdata[self.top:self.bottom, self.left:self.right], factor), (0, 0)
+
+        # whole blocks of factor x factor image pixels inside the crop (blocks are aligned to the image,
+        # as in a stored level, so the strips below start on TIFF segment boundaries)
+        top = -(-self.top // factor)
+        left = -(-self.left // factor)
+        bottom = max(top, self.bottom // factor)
+        right = max(left, self.right // factor)
+        origin = (top * factor - self.top, left * factor - self.left)
+
+        level = self.stored_level(factor)
+        if level is not None:
+            bottom = max(top, min(bottom, level.imagelength))
+            right = max(left, min(right, level.imagewidth))
+            return read_page_region(self.tif, level, top, bottom, left, right), origin
+
+        unit = factor * self.segment_rows // math.gcd(factor, self.segment_rows)
+        step = max(1, -(-strip_rows // unit)) * unit
+        coarse = np.empty((bottom - top, right - left), dtype=np.uint8)
+        row = top * factor
+        while row < bottom * factor:
+            next_row = min((row // step + 1) * step, bottom * factor)
+            strip = self.read_region(row - self.top, next_row - self.top,
+                                     origin[1], origin[1] + (right - left) * factor)
+            coarse[row // factor - top:next_row // factor - top] = downsample(strip, factor)
+            row = next_row
+        return coarse, origin
+
+    # The reduced resolution page of a pyramidal TIFF that is 1 / factor of the full size, or None
+    def stored_level(self, factor):
+        try:
+            levels = self.tif.series[0].levels
+        except (AttributeError, IndexError):
+            return None
+        for level in levels[1:]:
+            page = level.pages[0]
+            if (is_gray8_page(page) and abs(page.imagelength - self.img_height / float(factor)) < 1 and
+                    abs(page.imagewidth - self.img_width / float(factor)) < 1):
+                return page
+        return None
+
+    # Yield (first row, strip) for strips of about strip_rows rows covering the cropped region.
+    # The strip boundaries are aligned with the TIFF strips / tiles, so each is decoded once.
+    def strips(self, strip_rows=1024):
+        strip_rows = max(1, -(-strip_rows // self.segment_rows)) * self.segment_rows
+        for row in range(self.top - self.top % strip_rows, self.bottom, strip_rows):
+            start = max(row, self.top) - self.top
+            stop = min(row + strip_rows, self.bottom) - self.top
+            yield start, self.read(start, stop)
+
+    def close(self):
+        if self.tif is not None:
+            self.tif.close()
+            self.tif = None
+
+
+# Load a grayscale image, or only the region inside the crop margins.
+# Returns (imgdata, img_height, img_width), the height and width are those of the full image.
+def load_image(filename, crop_top=0, crop_bottom=0, crop_left=0, crop_right=0):
+    if tifffile is not None and filename.lower().endswith(('.tif', '.tiff')):
+        try:
+            loaded = read_tiff_region(filename, crop_top, crop_bottom, crop_left, crop_right)
+        except Exception:
+            # not a TIFF tifffile can read (e.g. missing codec), fall back to OpenCV
+            loaded = None
+        if loaded is not None:
+            return loaded
+
+    import cv2
+    imgdata = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
+    if imgdata is None:
+        raise IOError("could not read the image " + filename)
+    height, width = imgdata.shape
+    top, bottom, left, right = crop_ranges(height, width, crop_top, crop_bottom, crop_left, crop_right)
+    return imgdata[top:bottom, left:right], height, width
@@ -12,48 +12,162 @@
 # Imports
 import sys
 import os
-import cv2
-import numpy as np
 import datetime
-import matplotlib.pyplot as plt
-from scipy.signal import savgol_filter
+from SEM_Image_Analysis_Common import LineDetectResult, select_spikes, smooth_profile, smoothing_methods, \
+    horizontal_smoothing, vertical_smoothing, find_extrema, band_columns, vertical_crop_rows, StreamedProfiles, \
+    PyramidLevel, select_marks, mark_table, \
+    average_profile, StageTimer, append_json_line, estimate_skew, deskew_image, skew_min_angle, \
+    thickness_map, spike_confidence
+from SEM_Image_Analysis_Loader import load_image, RowStripReader
+
+# Output files the detector can write (the measurements are always made)
+output_types = {'numbers', 'plots', 'annotated', 'overlay'}
+# Formats the annotated image can be written as (see SEM_Image_Analysis_Annotate.py)
+annotated_formats = {'tif', 'png', 'jpg', 'webp'}
+
+# Marks looked for: bright horizontal lines, dark vertical lines
+horizontal_polarity = 'max'
+vertical_polarity = 'min'
+
+# Defaults of the measurement parameters (described in sem_image_analysis_milled_line_detect),
+# also used by the parameter sweep and stack tools
+defaults = {'img_width': 10.0,
+            'crop_top': 100,
+            'crop_bottom': 300,
+            'crop_left': 100,
+            'crop_right': 100,
+            'total_width_cols': 2000,
+            'vertical_crop_extra': 50,
+            'peak_width_max': 800,
+            'peak_dist_max': 1000,
+            'smoothing': 'kernel'}
 
 
 # Line detector function
+# Returns a LineDetectResult holding the detected spike positions and distances (see SEM_Image_Analysis_Common.py)
 def sem_image_analysis_milled_line_detect(**kwargs):
     # Default parameters
     # Can be overridden by supplying keyword args on function call
     # or you can change the default behaviour by modifying the default values here
     verbose = kwargs.get('verbose', False)
     filename = kwargs.get('filename', 'img.tif')
-    real_width = kwargs.get('img_width', 10.0)
+    real_width = kwargs.get('img_width', defaults['img_width'])
     # Initial crop params - number of pixels to crop from the edges.
-    crop_top = kwargs.get('crop_top', 100)
-    crop_bottom = kwargs.get('crop_bottom', 300)
-    crop_left = kwargs.get('crop_left', 100)
-    crop_right = kwargs.get('crop_right', 100)
+    crop_top = kwargs.get('crop_top', defaults['crop_top'])
+    crop_bottom = kwargs.get('crop_bottom', defaults['crop_bottom'])
+    crop_left = kwargs.get('crop_left', defaults['crop_left'])
+    crop_right = kwargs.get('crop_right', defaults['crop_right'])
     # Total length to average over to find the horizontal lines
-    total_width_cols = kwargs.get('total_width_cols', 2000)
+    total_width_cols = kwargs.get('total_width_cols', defaults['total_width_cols'])
     # extra pixels to cut from top and bottom of sample (so we don't get interference from the horizontal lines)
-    vertical_crop_extra = kwargs.get('vertical_crop_extra', 50)
+    vertical_crop_extra = kwargs.get('vertical_crop_extra', defaults['vertical_crop_extra'])
     # maximum width [pix] of peaks (ignores peak where dist between minima either side is less than this)
-    peak_width_max = kwargs.get('peak_width_max', 800)
+    peak_width_max = kwargs.get('peak_width_max', defaults['peak_width_max'])
     # max distance of peaks from crop lines [pix] (ignores peaks more than [pix] away from the initial crop lines)
-    peak_dist_max = kwargs.get('peak_dist_max', 1000)
+    peak_dist_max = kwargs.get('peak_dist_max', defaults['peak_dist_max'])
+    # Output files to write:  'plots' (gray level profile pdfs), 'annotated' (annotated copy of the image)
+    # and 'overlay' (the annotations as SVG and json, to draw over the original image later).
+    # Use outputs={'numbers'} to only measure the marks, this skips all rendering.
+    outputs = kwargs.get('outputs', {'plots', 'annotated'})
+    # Profile smoothing: 'kernel' (all filter passes combined into one kernel) or 'savgol' (original repeated filter)
+    smoothing = kwargs.get('smoothing', defaults['smoothing'])
+    # Prefix (path and start of the name) for the output files, by default the input filename plus a timestamp
+    output_prefix = kwargs.get('output_prefix', None)
+    # Record the wall time and allocated memory of each stage (in result.instrumentation['stages'])
+    instrument = kwargs.get('instrument', False)
+    # Set False to only record the stage times (tracing the memory slows the run down)
+    instrument_memory = kwargs.get('instrument_memory', True)
+    # Append the stage measurements to this file as json lines (also turns instrument on)
+    instrument_file = kwargs.get('instrument_file', None)
+    # Read the image a strip of rows at a time, for montages too big to hold in memory (outputs 'numbers' / 'plots')
+    streaming = kwargs.get('streaming', False)
+    # Rows per strip when streaming
+    strip_rows = kwargs.get('strip_rows', 1024)
+    # Coarse-to-fine detection: find the marks on the image downsampled by this factor (e.g. 4 or 8),
+    # then refine them at full resolution (also with streaming).  1 runs every stage at full resolution,
+    # as do images without a stored level of that size (only pyramidal TIFFs store one).
+    pyramid = kwargs.get('pyramid', 1)
+    # Also find every qualifying mark, not just the two biggest (for images with an array of lines),
+    # returned in result.horizontal_marks / result.vertical_marks with the distances between them
+    all_marks = kwargs.get('all_marks', False)
+    # Marks weaker than this fraction of the strongest one are ignored
+    mark_min_fraction = kwargs.get('mark_min_fraction', 0.5)
+    # Annotated image format: 'tif' (as the original), 'png', 'jpg' or 'webp', and the jpg / webp quality (0-100)
+    annotated_format = kwargs.get('annotated_format', 'tif')
+    annotated_quality = kwargs.get('annotated_quality', 90)
+    # Write the annotated image downscaled by this factor (e.g. 4), the full image is then never held in memory
+    preview_factor = kwargs.get('preview_factor', 1)
+    # The whole image, already decoded (e.g. by the prefetch threads of the pipelined batch), used instead of
+    # reading filename (which still names the outputs)
+    imgdata = kwargs.get('imgdata', None)
+    # Hand each output file to save_output(filename, data) as bytes instead of writing it
+    # (e.g. to the writer threads of the pipelined batch)
+    save_output = kwargs.get('save_output', None)
+    # Measure the skew of the lines (up to max_skew degrees either way) and straighten the cropped region before
+    # finding them.  The angle is returned with the result.
+    deskew = kwargs.get('deskew', False)
+    max_skew = kwargs.get('max_skew', 5.0)
+    # Also find the horizontal marks in this many adjacent bands of columns across the whole width, giving the
+    # distance between them along x (0 for only the central band of total_width_cols)
+    bands = kwargs.get('bands', 0)
+    # Flag the frame when the confidence in the marks (0 to 1, see spike_confidence) is below this, and skip the
+    # plots and annotated image for it (0 never flags)
+    min_confidence = kwargs.get('min_confidence', 0.0)
 
     # Check the file exists
-    if not os.path.isfile(filename):
+    if imgdata is None and not os.path.isfile(filename):
         print("ERROR:  The filename you entered: " + filename + " does not exist.")
         sys.exit()
 
-    # Get date today
-    x = datetime.datetime.now()
-    # Set pre-factor for output filename
-    output_filename_prefac = (filename[:-4] +
-                              x.strftime("%Y") + x.strftime("%m") +
-                              x.strftime("%d") + x.strftime("%H") +
-                              x.strftime("%M") + x.strftime("%S") +
-                              "_")
+    # Check the outputs are known
+    if not set(outputs) <= output_types:
+        print("ERROR:  Unknown outputs: " + ", ".join(sorted(set(outputs) - output_types)) +
+              "  (expected: " + ", ".join(sorted(output_types)) + ")")
+        sys.exit()
+
+    # Check the annotated image format is known
+    if annotated_format not in annotated_formats:
+        print("ERROR:  Unknown annotated image format: " + str(annotated_format) +
+              "  (expected: " + ", ".join(sorted(annotated_formats)) + ")")
+        sys.exit()
+
+    # Nothing to stream when the image is already in memory
+    if imgdata is not None:
+        streaming = False
+
+    # The full size annotated image is drawn on a copy of the whole image, which streaming avoids holding
+    if streaming and 'annotated' in outputs and preview_factor == 1:
+        print("ERROR:  The full size annotated output needs the whole image in memory, it cannot be used with "
+              "streaming (use a preview_factor above 1).")
+        sys.exit()
+
+    # Straightening the cropped region needs it in memory
+    if streaming and deskew:
+        print("ERROR:  Deskewing needs the cropped image in memory, it cannot be used with streaming.")
+        sys.exit()
+
+    # The bands are summed from the cropped image in memory
+    if streaming and bands:
+        print("ERROR:  The band thickness map needs the cropped image in memory, it cannot be used with streaming.")
+        sys.exit()
+
+    # Check the smoothing method is known
+    if smoothing not in smoothing_methods:
+        print("ERROR:  Unknown smoothing method: " + str(smoothing) +
+              "  (expected: " + ", ".join(sorted(smoothing_methods)) + ")")
+        sys.exit()
+
+    if output_prefix is not None:
+        output_filename_prefac = output_prefix
+    else:
+        # Get date today
+        x = datetime.datetime.now()
+        # Set pre-factor for output filename
+        output_filename_prefac = (filename[:-4] +
+                                  x.strftime("%Y") + x.strftime("%m") +
+                                  x.strftime("%d") + x.strftime("%H") +
+                                  x.strftime("%M") + x.strftime("%S") +
+                                  "_")
 
     if verbose:
         # Welcome message
@@ -70,12 +184,52 @@ def sem_image_analysis_milled_line_detect(**kwargs):
         print(">  Real image width read from commandline: " + str(real_width) + " microns\n")
         # print(">  Output filename prefactor: " + str(output_filename_prefac))
 
-    # Try to load the image in grayscale
-    imgdata_original = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
+    # Stage timing (does nothing unless instrument is on)
+    timer = StageTimer(instrument or instrument_file is not None, instrument_memory)
 
-    # get dims
-    img_width = imgdata_original.shape[1]
-    img_height = imgdata_original.shape[0]
+    # Try to load the image in grayscale
+    timer.start('load')
+    # The full size annotated image needs the whole image, otherwise only the region inside the crop is read.
+    # The crop is a view of the loaded image (no copy).
+    # Streaming and pyramid detection only open the image here, the rows are read as they are needed.
+    reader = None
+    if imgdata is not None:
+        imgdata_original = imgdata
+        img_height, img_width = imgdata_original.shape
+        imgdata_cropped = imgdata_original[crop_top:(img_height - crop_bottom), crop_left:(img_width - crop_right)]
+    elif 'annotated' in outputs and preview_factor == 1:
+        imgdata_original, img_height, img_width = load_image(filename)
+        imgdata_cropped = imgdata_original[crop_top:(img_height - crop_bottom), crop_left:(img_width - crop_right)]
+    elif (streaming or pyramid > 1) and not deskew and not bands:
+        reader = RowStripReader(filename, crop_top, crop_bottom, crop_left, crop_right)
+        img_height, img_width = reader.img_height, reader.img_width
+    else:
+        imgdata_cropped, img_height, img_width = load_image(filename, crop_top, crop_bottom, crop_left, crop_right)
+    # Without a stored reduced level every pixel is read and averaged into the coarse level, which is slower than
+    # detecting at full resolution, so only pyramidal TIFFs are detected coarse-to-fine
+    if pyramid > 1 and (reader is None or reader.stored_level(pyramid) is None):
+        if verbose:
+            print(">  No stored 1/" + str(pyramid) + " level in the image, detecting at full resolution")
+        pyramid = 1
+        if reader is not None and not streaming:
+            reader.close()
+            reader = None
+            imgdata_cropped, img_height, img_width = load_image(filename, crop_top, crop_bottom, crop_left,
+                                                                crop_right)
+    if reader is None:
+        cropped_height, cropped_width = imgdata_cropped.shape
+    else:
+        cropped_height, cropped_width = reader.shape
+
+    # Measure the skew on a downsampled copy, then rotate only the cropped region (the spikes are found in it)
+    skew_angle = None
+    if deskew:
+        timer.start('deskew')
+        skew_angle = estimate_skew(imgdata_cropped, max_skew)
+        if abs(skew_angle) >= skew_min_angle:
+            imgdata_cropped = deskew_image(imgdata_cropped, skew_angle)
+        if verbose:
+            print(">  Skew of the lines: " + str(round(skew_angle, 3)) + " degrees")
 
     if verbose:
         print(">  Input image width : " + str(img_width) + " Pixels")
@@ -87,368 +241,289 @@ def sem_image_analysis_milled_line_detect(**kwargs):
     if verbose:
         print(">  There are:   " + str(length_factor) + " Pixels / micron")
 
-    # -- Create an original colour copy to draw on --
-    imgdata_original_copy = cv2.cvtColor(imgdata_original, cv2.COLOR_GRAY2BGR)
-
-    # -- Do the initial user defined crop  --
-
-    # Create a copy to modify
-    imgdata_cropped = np.copy(imgdata_original)
-
-    # Crop image
-    imgdata_cropped = imgdata_cropped[crop_top:(img_height - crop_bottom), crop_left:(img_width - crop_right)]
     # Save the cropped image
     # cv2.imwrite(output_filename_prefac + "cropped.tif", imgdata_cropped)
 
-    # draw crop lines on original copy
-    cv2.line(imgdata_original_copy,
-             (0, (img_height - crop_bottom)),
-             (img_width, (img_height - crop_bottom)), (0, 0, 255), 5)
-    cv2.line(imgdata_original_copy,
-             (0, crop_top),
-             (img_width, crop_top), (0, 0, 255), 5)
-    cv2.line(imgdata_original_copy,
-             (crop_left, 0),
-             (crop_left, img_height), (0, 0, 255), 5)
-    cv2.line(imgdata_original_copy,
-             ((img_width - crop_right), 0),
-             ((img_width - crop_right), img_height), (0, 0, 255), 5)
-
-    # Draw a circle in the centre of the cropped region
-    img_centre_x = imgdata_cropped.shape[1] / 2.0
-    img_centre_y = imgdata_cropped.shape[0] / 2.0
-    cv2.circle(imgdata_original_copy,
-               (int(img_centre_x + crop_left), int(img_centre_y + crop_top)),
-               10, (0, 255, 0), 3)
-
-    # Draw line and text showing the input width set above (maybe OCR this in the future)
-    # Draw double ended arrow
-    cv2.arrowedLine(imgdata_original_copy,
-                    (0, int(img_height - 0.5 * crop_bottom)),
-                    (img_width, int(img_height - 0.5 * crop_bottom)),
-                    (255, 0, 255),
-                    6,
-                    tipLength=0.04)
-    cv2.arrowedLine(imgdata_original_copy,
-                    (img_width, int(img_height - 0.5 * crop_bottom)),
-                    (0, int(img_height - 0.5 * crop_bottom)),
-                    (255, 0, 255),
-                    6,
-                    tipLength=0.04)
-    # Write label
-    cv2.putText(imgdata_original_copy,
-                (str(real_width) + " microns"),
-                (int(img_centre_x - 100), int(img_height - 0.5 * crop_bottom - 15)),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                3,
-                (255, 0, 255),
-                10)
+    # centre of the cropped region
+    img_centre_x = cropped_width / 2.0
+
+    # Measurements of the run (returned with the result)
+    instrumentation = {}
 
     # -- find horizontal lines on sample (upper and lower edges) ---
 
     # average central total_width_cols columns
     half_total_width_cols = int(total_width_cols / 2.0)
-    avdata = np.average(
-        imgdata_cropped[:, int(img_centre_x - half_total_width_cols):int(img_centre_x + half_total_width_cols)],
-        axis=1)
-
-    # x coordinate (number 0 to height)
-    x = np.linspace(0, avdata.shape[0] - 1, num=avdata.shape[0])
-
-    # plot the average of the image columns vs x
-    fig = plt.figure(figsize=(12, 8), dpi=100)
-    plt.rcParams["font.weight"] = "bold"
-    plt.rcParams['axes.labelweight'] = 'bold'
-    # Create a new subplot from a grid of 1x1
-    ax = fig.add_subplot(111)
-    ax.plot(x, avdata, color="blue", linewidth=2, linestyle="-", label="Average gray level")
-
-    # smooth signal with savitzky-golay filter  (multiple small window filters to ensure min location correct)
-    for i in range(10):
-        avdata = savgol_filter(avdata, 9, 2)  # window size 31, polynomial order 2
-
-    # find maxima and minima
-    a = np.diff(np.sign(np.diff(avdata))).nonzero()[0] + 1  # local min+max
-    b = (np.diff(np.sign(np.diff(avdata))) > 0).nonzero()[0] + 1  # local min
-    c = (np.diff(np.sign(np.diff(avdata))) < 0).nonzero()[0] + 1  # local max
-
-    # plot the filtered signal and detected max, minima
-    ax.plot(x, avdata, color="red", linewidth=1.5, linestyle="-", label="Savitzky-Golay filter")
-
-    ax.plot(x[b], avdata[b], "o", color="green", label="min")
-    ax.plot(x[c], avdata[c], "o", color="orange", label="max")
-    plt.xlim(0, imgdata_cropped.shape[0])
-    plt.ylim(max(0, min(avdata)-10), max(avdata)+20)
-
-    # x tick labels
-    x = np.zeros(0)
-    pix = 0
-    while True:
-        x = np.append(x, [pix])
-        pix += 200
-        if pix > imgdata_cropped.shape[0]:
-            if imgdata_cropped.shape[0] - pix + 200 > 150:
-                x = np.append(x, [imgdata_cropped.shape[0]])
-            break
-    plt.xticks(x)
-    plt.title("Average gray level of each row vs pixel distance from the top", fontweight='bold', size=20)
-    plt.xlabel("Distance from the top of the image, Pixels", fontweight='bold', size=18)
-    plt.ylabel("Average gray level", fontweight='bold', size=18)
-    plt.minorticks_on()
-
-    # pick out the two biggest spikes
-    # filter broad peaks (width defined above)
-    # filter peaks beyond given cutoff (defined above) from crop lines.
-    # print(a)
-    # print(avdata[a])
-    spike1 = 0
-    spike2 = 0
-    spike1_pix = 0
-    spike2_pix = 0
-    spike1_h = 0
-    spike2_h = 0
-
-    for i in range(len(a) - 2):
-        h = (avdata[a[i + 1]] - avdata[a[i]]) + (avdata[a[i + 1]] - avdata[a[i + 2]])
-        # find current min spike and overwrite with new value if it is bigger
-        # if both the same, just use the first.
-        if spike1 == spike2:
-            if h > spike1:
-                if (a[i + 2] - a[i]) < peak_width_max:
-                    if (a[i + 1] < peak_dist_max) or (a[i + 1] > (imgdata_cropped.shape[0] - peak_dist_max)):
-                        # print(a[i+1], peak_dist_max, (imgdata_cropped.shape[0]- peak_dist_max ) )
-                        spike1 = h
-                        spike1_h = avdata[a[i + 1]]
-                        spike1_pix = a[i + 1]
-        elif spike1 == min(spike1, spike2):
-            if h > spike1:
-                if (a[i + 2] - a[i]) < peak_width_max:
-                    if (a[i + 1] < peak_dist_max) or (a[i + 1] > (imgdata_cropped.shape[0] - peak_dist_max)):
-                        # print(a[i+1], peak_dist_max, (imgdata_cropped.shape[0]- peak_dist_max ) )
-                        spike1 = h
-                        spike1_h = avdata[a[i + 1]]
-                        spike1_pix = a[i + 1]
-        elif h > spike2:
-            if (a[i + 2] - a[i]) < peak_width_max:
-                if (a[i + 1] < peak_dist_max) or (a[i + 1] > (imgdata_cropped.shape[0] - peak_dist_max)):
-                    # print(a[i+1], peak_dist_max, (imgdata_cropped.shape[0]- peak_dist_max ) )
-                    spike2 = h
-                    spike2_h = avdata[a[i + 1]]
-                    spike2_pix = a[i + 1]
-
-    # text labels
-    plt.text(spike1_pix, spike1_h + 5, 'Spike 1')
-    plt.text(spike2_pix, spike2_h + 5, 'Spike 2')
-
-    plt.legend(loc="upper center")
-    # save plot
-    plt.savefig(str(output_filename_prefac) + "sample_horizontal_edge_detect.pdf", dpi=100)
+    if pyramid > 1:
+        # spikes found on the downsampled image, then refined at full resolution (see PyramidLevel)
+        timer.start('downsample')
+        pyramid_level = PyramidLevel(reader, pyramid, strip_rows, smoothing)
+        timer.start('horizontal_spikes')
+        ((spike1_pix, spike2_pix), (spike1, spike2), (spike1_h, spike2_h)), avdata_raw, avdata = \
+            pyramid_level.horizontal(*band_columns(cropped_width, total_width_cols),
+                                     polarity=horizontal_polarity, peak_width_max=peak_width_max,
+                                     peak_dist_max=peak_dist_max)
+        timer.stop()
+    else:
+        timer.start('horizontal_profile')
+        if streaming:
+            # first pass over the strips, also keeps the column sums of each strip for the vertical profile
+            streamed = StreamedProfiles(reader, *band_columns(cropped_width, total_width_cols),
+                                        strip_rows=strip_rows, stats=instrumentation)
+            avdata = streamed.row_profile
+        else:
+            avdata = average_profile(
+                imgdata_cropped[:, int(img_centre_x - half_total_width_cols):int(img_centre_x + half_total_width_cols)],
+                1, instrumentation)
+        # keep the unfiltered signal for plotting
+        avdata_raw = avdata
+
+        timer.start('horizontal_smooth')
+        # smooth signal with savitzky-golay filter  (multiple small window filters to ensure min location correct)
+        avdata = smooth_profile(avdata, *horizontal_smoothing, method=smoothing)  # 10 passes, window 9, order 2
+
+        # find maxima and minima
+        timer.start('horizontal_spikes')
+        a = find_extrema(avdata)  # local min+max
+
+        # pick out the two biggest spikes (bright lines)
+        # filter broad peaks (width defined above)
+        # filter peaks beyond given cutoff (defined above) from crop lines.
+        (spike1_pix, spike2_pix), (spike1, spike2), (spike1_h, spike2_h) = select_spikes(
+            avdata, a, horizontal_polarity, peak_width_max, peak_dist_max)
+        timer.stop()
+
+    # every qualifying horizontal mark
+    if all_marks:
+        timer.start('horizontal_marks')
+        if pyramid > 1:
+            horizontal_marks = pyramid_level.marks(peak_width_max, peak_dist_max, mark_min_fraction)
+        else:
+            horizontal_marks = select_marks(avdata, a, horizontal_polarity, peak_width_max, peak_dist_max,
+                                            mark_min_fraction)
+        horizontal_marks = mark_table(*horizontal_marks, offset=crop_top, length_factor=length_factor)
+        timer.stop()
+    else:
+        horizontal_marks = None
 
     if verbose:
         print("Horizontal spike1 peak at ", spike1_pix)
         print("Horizontal spike2 peak at ", spike2_pix)
         print("Distance between horizontal marks: " +
               str(abs(spike2_pix - spike1_pix) / length_factor) + " microns")
-
-    # Draw green crop lines (for region considered in finding horizontal edges)
-    cv2.line(imgdata_original_copy,
-             (crop_left + int(img_centre_x - half_total_width_cols), 0),
-             (crop_left + int(img_centre_x - half_total_width_cols), img_height),
-             (0, 255, 0), 2)
-    cv2.line(imgdata_original_copy,
-             (crop_left + int(img_centre_x + half_total_width_cols), 0),
-             (crop_left + int(img_centre_x + half_total_width_cols), img_height),
-             (0, 255, 0), 2)
-
-    # Draw yellow lines over the detected horizontal lines in the image
-    cv2.line(imgdata_original_copy, (0, spike1_pix + crop_top), (img_width, spike1_pix + crop_top),
-             (0, 255, 255), 3)
-    cv2.line(imgdata_original_copy, (0, spike2_pix + crop_top), (img_width, spike2_pix + crop_top),
-             (0, 255, 255), 3)
-
-    # Draw arrow and write computed distance on the annotated image
-    # Draw double ended arrow
-    cv2.arrowedLine(imgdata_original_copy,
-                    (int(img_width * 0.75), int(spike1_pix + crop_top)),
-                    (int(img_width * 0.75), int(spike2_pix + crop_top)),
-                    (0, 255, 255),
-                    6,
-                    tipLength=0.04)
-    cv2.arrowedLine(imgdata_original_copy,
-                    (int(img_width * 0.75), int(spike2_pix + crop_top)),
-                    (int(img_width * 0.75), int(spike1_pix + crop_top)),
-                    (0, 255, 255),
-                    6,
-                    tipLength=0.04)
-    # Write label
-    cv2.putText(imgdata_original_copy,
-                (str(round(abs(spike2_pix - spike1_pix) / length_factor, 3)) + " microns"),
-                (int(img_width * 0.75 + 10), int(img_centre_y + crop_top)),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                3,
-                (0, 255, 255),
-                10)
-
-    # annotate with crop lines
-    cv2.line(imgdata_original_copy,
-             (0, (int(min(spike1_pix, spike2_pix) + vertical_crop_extra + crop_top))),
-             (img_width, (int(min(spike1_pix, spike2_pix) + vertical_crop_extra + crop_top))),
-             (0, 255, 0), 2)
-    cv2.line(imgdata_original_copy,
-             (0, (int(max(spike1_pix, spike2_pix) - vertical_crop_extra + crop_top))),
-             (img_width, (int(max(spike1_pix, spike2_pix) - vertical_crop_extra + crop_top))),
-             (0, 255, 0), 2)
+        if all_marks:
+            print("Horizontal marks found: " + str(len(horizontal_marks['pix'])) + ", spacing: " +
+                  ", ".join(str(round(v, 3)) for v in horizontal_marks['spacing']) + " microns")
+
+    # -- the horizontal marks in adjacent bands across the whole width ---
+    band_map = None
+    if bands:
+        if bands > cropped_width:
+            print("ERROR:  There are more bands (" + str(bands) + ") than columns in the cropped image (" +
+                  str(cropped_width) + ").")
+            sys.exit()
+        timer.start('thickness_map')
+        band_map = thickness_map(imgdata_cropped, bands, horizontal_polarity, peak_width_max, peak_dist_max,
+                                 length_factor, smoothing)
+        timer.stop()
+        if verbose:
+            print("Distance between horizontal marks in " + str(bands) + " bands: " +
+                  ", ".join('-' if v is None else str(round(v, 3)) for v in band_map['thickness']) + " microns")
 
     # -- crop vertically ---
 
-    # Create a copy to modify
-    imgdata_vertcropped = np.copy(imgdata_cropped)
-
-    # Crop image
-    imgdata_vertcropped = imgdata_vertcropped[int(min(spike1_pix, spike2_pix) + vertical_crop_extra):int(
-        max(spike1_pix, spike2_pix) - vertical_crop_extra), :]
+    # Crop image (a view, no copy)
+    timer.start('vertical_crop')
+    if streaming or pyramid > 1:
+        vertcrop_rows = vertical_crop_rows(cropped_height, (spike1_pix, spike2_pix), vertical_crop_extra)
+    else:
+        imgdata_vertcropped = imgdata_cropped[int(min(spike1_pix, spike2_pix) + vertical_crop_extra):int(
+            max(spike1_pix, spike2_pix) - vertical_crop_extra), :]
 
     # Save the cropped image
     # cv2.imwrite(output_filename_prefac + "vertcropped.tif", imgdata_vertcropped)
 
-    # --  average rows in the cropped image  ---
-    avdata = np.average(imgdata_vertcropped, axis=0)
-
-    fig = plt.figure(figsize=(12, 8), dpi=100)
-    # Create a new subplot from a grid of 1x1
-    ax = fig.add_subplot(111)
-
-    ax.plot(avdata, color="blue", linewidth=2, linestyle="-", label="Average gray level")
-
-    # smoothing filter
-    for i in range(10):
-        avdata = savgol_filter(avdata, 21, 2)  # window size 201, polynomial order 2
-
-    ax.plot(avdata, color="red", linewidth=1.5, linestyle="-", label="Savitzky-Golay filter")
-    # x coordinate (number 0 to width)
-    x = np.linspace(0, avdata.shape[0] - 1, num=avdata.shape[0])
-    # detect min and max
-    a = np.diff(np.sign(np.diff(avdata))).nonzero()[0] + 1  # local min+max
-    b = (np.diff(np.sign(np.diff(avdata))) > 0).nonzero()[0] + 1  # local min
-    c = (np.diff(np.sign(np.diff(avdata))) < 0).nonzero()[0] + 1  # local max
-
-    # pick out the two biggest spikes
-    # print(a)
-    # print(avdata[a])
-    vspike1 = 0
-    vspike2 = 0
-    vspike1_pix = 0
-    vspike2_pix = 0
-    vspike1_h = 0
-    vspike2_h = 0
-
-    for i in range(len(a) - 2):
-        h = (avdata[a[i]] - avdata[a[i + 1]]) + (avdata[a[i + 2]] - avdata[a[i + 1]])
-        # find current min spike and overwrite with new value if it is bigger
-        # if both the same, just use the first.
-        if vspike1 == vspike2:
-            if h > vspike1:
-                if (a[i + 2] - a[i]) < peak_width_max:
-                    if (a[i + 1] < peak_dist_max) or (a[i + 1] > (imgdata_vertcropped.shape[1] - peak_dist_max)):
-                        # print(a[i+1], peak_dist_max, (imgdata_vertcropped.shape[1]- peak_dist_max ) )
-                        vspike1 = h
-                        vspike1_pix = a[i + 1]
-                        vspike1_h = avdata[a[i + 1]]
-        elif vspike1 == min(vspike1, vspike2):
-            if h > vspike1:
-                if (a[i + 2] - a[i]) < peak_width_max:
-                    if (a[i + 1] < peak_dist_max) or (a[i + 1] > (imgdata_vertcropped.shape[1] - peak_dist_max)):
-                        # print(a[i+1], peak_dist_max, (imgdata_vertcropped.shape[1]- peak_dist_max ) )
-                        vspike1 = h
-                        vspike1_pix = a[i + 1]
-                        vspike1_h = avdata[a[i + 1]]
-        elif h > vspike2:
-            if (a[i + 2] - a[i]) < peak_width_max:
-                if (a[i + 1] < peak_dist_max) or (a[i + 1] > (imgdata_vertcropped.shape[1] - peak_dist_max)):
-                    # print(a[i+1], peak_dist_max, (imgdata_vertcropped.shape[1]- peak_dist_max ) )
-                    vspike2 = h
-                    vspike2_pix = a[i + 1]
-                    vspike2_h = avdata[a[i + 1]]
-
-    # text labels
-    if (vspike1_h - 5) < 0:
-        plt.text(vspike1_pix, 10, 'Spike 1')
-        plt.text(vspike2_pix, 10, 'Spike 2')
+    if pyramid > 1:
+        timer.start('vertical_spikes')
+        ((vspike1_pix, vspike2_pix), (vspike1, vspike2), (vspike1_h, vspike2_h)), vavdata_raw, vavdata = \
+            pyramid_level.vertical(*vertcrop_rows, polarity=vertical_polarity, peak_width_max=peak_width_max,
+                                   peak_dist_max=peak_dist_max)
+        timer.stop()
     else:
-        plt.text(vspike1_pix, vspike1_h - 5, 'Spike 1')
-        plt.text(vspike2_pix, vspike2_h - 5, 'Spike 2')
-
-    ax.plot(x[b], avdata[b], "o", color="green", label="min")
-    ax.plot(x[c], avdata[c], "o", color="orange", label="max")
-    plt.xlim(0, imgdata_vertcropped.shape[1])
-    plt.ylim(max(0, min(avdata) - 10), max(avdata) + 15)
-
-    # x tick labels
-    x = np.zeros(0)
-    pix = 0
-    while True:
-        x = np.append(x, [pix])
-        pix += 500
-        if pix > imgdata_vertcropped.shape[1]:
-            if imgdata_vertcropped.shape[1] - pix + 500 > 150:
-                x = np.append(x, [imgdata_vertcropped.shape[1]])
-            break
-    plt.xticks(x)
-
-    plt.title("Average gray level of each column vs pixel distance from the left", fontweight='bold', size=20)
-    plt.xlabel("Distance from the left of the image, Pixels", size=18)
-    plt.ylabel("Average gray level", size=18)
-    plt.minorticks_on()
-
-    plt.legend(loc="upper center")
-    plt.savefig(str(output_filename_prefac) + "sample_mark_detect.pdf", dpi=100)
+        # --  average rows in the cropped image  ---
+        timer.start('vertical_profile')
+        if streaming:
+            # second pass, only the partial strips at the ends of the vertical crop are read again
+            vavdata = streamed.column_profile(*vertcrop_rows)
+        else:
+            vavdata = average_profile(imgdata_vertcropped, 0, instrumentation)
+        # keep the unfiltered signal for plotting
+        vavdata_raw = vavdata
+
+        # smoothing filter
+        timer.start('vertical_smooth')
+        vavdata = smooth_profile(vavdata, *vertical_smoothing, method=smoothing)  # 10 passes, window 21, order 2
+
+        # detect min and max
+        timer.start('vertical_spikes')
+        va = find_extrema(vavdata)  # local min+max
+
+        # pick out the two biggest spikes (dark lines)
+        (vspike1_pix, vspike2_pix), (vspike1, vspike2), (vspike1_h, vspike2_h) = select_spikes(
+            vavdata, va, vertical_polarity, peak_width_max, peak_dist_max)
+        timer.stop()
+
+    # every qualifying vertical mark
+    if all_marks:
+        timer.start('vertical_marks')
+        if pyramid > 1:
+            vertical_marks = pyramid_level.marks(peak_width_max, peak_dist_max, mark_min_fraction)
+        else:
+            vertical_marks = select_marks(vavdata, va, vertical_polarity, peak_width_max, peak_dist_max,
+                                          mark_min_fraction)
+        vertical_marks = mark_table(*vertical_marks, offset=crop_left, length_factor=length_factor)
+        timer.stop()
+    else:
+        vertical_marks = None
+
+    # done reading the image
+    if reader is not None:
+        reader.close()
 
     if verbose:
         print("Vertical spike1 peak at ", vspike1_pix)
         print("Vertical spike2 peak at ", vspike2_pix)
         print(
             "Distance between vertical marks: " + str(abs(vspike2_pix - vspike1_pix) / length_factor) + " microns")
+        if all_marks:
+            print("Vertical marks found: " + str(len(vertical_marks['pix'])) + ", spacing: " +
+                  ", ".join(str(round(v, 3)) for v in vertical_marks['spacing']) + " microns")
+
+    # -- Confidence in the marks: is the frame worth rendering ---
+    timer.start('confidence')
+    horizontal_confidence = spike_confidence(avdata_raw, avdata, horizontal_polarity, (spike1_pix, spike2_pix),
+                                             (spike1, spike2), peak_width_max, peak_dist_max, not all_marks)
+    vertical_confidence = spike_confidence(vavdata_raw, vavdata, vertical_polarity, (vspike1_pix, vspike2_pix),
+                                           (vspike1, vspike2), peak_width_max, peak_dist_max, not all_marks)
+    confidence = {'score': min(horizontal_confidence['score'], vertical_confidence['score']),
+                  'horizontal': horizontal_confidence,
+                  'vertical': vertical_confidence}
+    flagged = confidence['score'] < min_confidence
+    timer.stop()
 
-    # Draw blue lines over the detected vertical lines in the image
-    cv2.line(imgdata_original_copy,
-             (int(min(vspike1_pix, vspike2_pix) + crop_left), 0),
-             (int(min(vspike1_pix, vspike2_pix) + crop_left), img_height),
-             (255, 100, 0),
-             3)
-
-    cv2.line(imgdata_original_copy,
-             (int(max(vspike1_pix, vspike2_pix) + crop_left), 0),
-             (int(max(vspike1_pix, vspike2_pix) + crop_left), img_height),
-             (255, 100, 0),
-             3)
-
-    # Draw arrow and write computed distance on the annotated image
-
-    # draw double ended arrow
-    cv2.arrowedLine(imgdata_original_copy,
-                    (int(min(vspike1_pix, vspike2_pix) + crop_left), int(img_height - crop_bottom - 50)),
-                    (int(max(vspike1_pix, vspike2_pix) + crop_left), int(img_height - crop_bottom - 50)),
-                    (255, 100, 0),
-                    6,
-                    tipLength=0.04)
-    cv2.arrowedLine(imgdata_original_copy,
-                    (int(max(vspike1_pix, vspike2_pix) + crop_left), int(img_height - crop_bottom - 50)),
-                    (int(min(vspike1_pix, vspike2_pix) + crop_left), int(img_height - crop_bottom - 50)),
-                    (255, 100, 0),
-                    6,
-                    tipLength=0.04)
-    # Write label
-
-    cv2.putText(imgdata_original_copy,
-                (str(round((abs(vspike2_pix - vspike1_pix) / length_factor), 3)) + " microns"),
-                (int(img_centre_x - 100), int(img_height - crop_bottom - 70)),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                3,
-                (255, 100, 0),
-                10)
-
-    # save annotated image
-    cv2.imwrite(output_filename_prefac + "annotated.tif", imgdata_original_copy)
+    if verbose:
+        print("Confidence in the marks: " + str(round(confidence['score'], 3)) +
+              ("  (below " + str(min_confidence) + ", flagged, not rendered)" if flagged else ""))
+
+    # Files written below
+    output_files = []
+
+    # -- Plot the gray level profiles --
+    if 'plots' in outputs and not flagged:
+        timer.start('plots')
+        # Only needed for plotting (reused figures on the Agg canvas, see SEM_Image_Analysis_Plots.py)
+        from SEM_Image_Analysis_Plots import profile_plot, plot_thickness_map
+
+        # plot the average of the image columns, the filtered signal and its minima and maxima vs x
+        plot = profile_plot('horizontal')
+        plot.draw(avdata_raw, avdata, (max(0, min(avdata) - 10), max(avdata) + 20), 200,
+                  "Average gray level of each row vs pixel distance from the top",
+                  "Distance from the top of the image, Pixels", "Average gray level",
+                  ((spike1_pix, spike1_h + 5), (spike2_pix, spike2_h + 5)))
+
+        # save plot
+        timer.start('savefig')
+        plot.save(str(output_filename_prefac) + "sample_horizontal_edge_detect.pdf", 100, save_output)
+        output_files.append(str(output_filename_prefac) + "sample_horizontal_edge_detect.pdf")
+        plot.release()
+        timer.start('plots')
+
+        # text labels
+        if (vspike1_h - 5) < 0:
+            label_positions = ((vspike1_pix, 10), (vspike2_pix, 10))
+        else:
+            label_positions = ((vspike1_pix, vspike1_h - 5), (vspike2_pix, vspike2_h - 5))
+
+        plot = profile_plot('vertical')
+        plot.draw(vavdata_raw, vavdata, (max(0, min(vavdata) - 10), max(vavdata) + 15), 500,
+                  "Average gray level of each column vs pixel distance from the left",
+                  "Distance from the left of the image, Pixels", "Average gray level", label_positions)
+        timer.start('savefig')
+        plot.save(str(output_filename_prefac) + "sample_mark_detect.pdf", 100, save_output)
+        output_files.append(str(output_filename_prefac) + "sample_mark_detect.pdf")
+        plot.release()
+        if band_map is not None:
+            plot_thickness_map(str(output_filename_prefac) + "sample_thickness_map.pdf", band_map, crop_left,
+                               save_output)
+            output_files.append(str(output_filename_prefac) + "sample_thickness_map.pdf")
+        timer.stop()
+
+    # -- Annotate the image, and / or write the annotations as a vector overlay --
+    if ('annotated' in outputs or 'overlay' in outputs) and not flagged:
+        timer.start('annotate')
+        # Only needed for annotating
+        from SEM_Image_Analysis_Annotate import detector_shapes, annotated_image, write_image, write_overlay
+        shapes = detector_shapes(img_width, img_height, crop_top, crop_bottom, crop_left, crop_right, cropped_width,
+                                 cropped_height, total_width_cols, vertical_crop_extra, real_width, length_factor,
+                                 (spike1_pix, spike2_pix), (vspike1_pix, vspike2_pix))
+        if 'overlay' in outputs:
+            output_files.extend(write_overlay(output_filename_prefac, shapes, img_width, img_height,
+                                               save_output))
+        if 'annotated' in outputs:
+            if preview_factor > 1:
+                # downscaled a strip at a time, the annotations are drawn at the preview scale
+                timer.start('downsample')
+                preview_reader = RowStripReader(filename, imgdata=imgdata)
+                preview = preview_reader.reduced(preview_factor, strip_rows)[0]
+                preview_reader.close()
+                timer.start('annotate')
+                imgdata_annotated = annotated_image(preview, shapes, preview_factor)
+            else:
+                # -- Create an original colour copy to draw on --
+                imgdata_annotated = annotated_image(imgdata_original, shapes)
+            # save annotated image
+            timer.start('imwrite')
+            output_files.append(write_image(output_filename_prefac + "annotated", imgdata_annotated,
+                                            annotated_format, annotated_quality, save_output))
+        timer.stop()
+
+    # Stage measurements
+    if timer.enabled:
+        instrumentation['stages'] = timer.finish()
+
+    result = LineDetectResult(filename=filename,
+                              detector='milled',
+                              img_width=img_width,
+                              img_height=img_height,
+                              real_width=real_width,
+                              length_factor=length_factor,
+                              crop_top=crop_top,
+                              crop_bottom=crop_bottom,
+                              crop_left=crop_left,
+                              crop_right=crop_right,
+                              horizontal_spike_pix=(spike1_pix, spike2_pix),
+                              horizontal_spike_strength=(spike1, spike2),
+                              horizontal_spike_level=(spike1_h, spike2_h),
+                              horizontal_distance=abs(spike2_pix - spike1_pix) / length_factor,
+                              vertical_spike_pix=(vspike1_pix, vspike2_pix),
+                              vertical_spike_strength=(vspike1, vspike2),
+                              vertical_spike_level=(vspike1_h, vspike2_h),
+                              vertical_distance=abs(vspike2_pix - vspike1_pix) / length_factor,
+                              horizontal_marks=horizontal_marks,
+                              vertical_marks=vertical_marks,
+                              skew_angle=skew_angle,
+                              thickness_map=band_map,
+                              confidence=confidence,
+                              flagged=flagged,
+                              output_files=output_files,
+                              instrumentation=instrumentation)
+
+    if instrument_file is not None:
+        append_json_line(instrument_file, {'filename': filename,
+                                           'detector': 'milled',
+                                           'instrumentation': instrumentation})
+
+    return result
 
 
 # If we are running this script interactively, call the function safely
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+# Pipelined batch runner for the milled / deposited line detectors.
+# The plain batch runner (SEM_Image_Analysis_Batch.py) takes each image from start to finish in one worker:
+# read it, analyse it, then write the plots and the annotated image, so the CPU sits idle while files are read
+# (e.g. over NFS) and the disk sits idle while images are analysed.  Here the three steps overlap, each in its own
+# pool, connected by bounded queues:
+#   - prefetch threads read and decode the next images (the file reads and the image decoders release the GIL)
+#   - compute worker processes run the detectors on the decoded images, rendering the plots and the annotated
+#     image to bytes instead of writing them
+#   - writer threads write those files
+# prefetch_depth is how many images are read ahead of the compute workers and write_depth how many rendered files
+# may wait for the writers, together they bound the memory used.  Raise them when reads or writes are slow or
+# bursty, and the thread counts when the storage serves several requests at once.
+# The results are the same as the plain batch runner's, only the order they finish in differs.
+# If a compute worker dies (e.g. a decoder crash, or killed when out of memory) the pool is broken: a new one is
+# started, and the images that were in the broken pool are each analysed again in a worker of their own (reading
+# the file themselves), so only the image that kills its worker fails.
+
+# Usage:
+# SEM_Image_Analysis_Batch.py  manifest.csv  --pipeline  [--jobs N]  [--prefetch_threads 2]  [--prefetch_depth 8]
+#                              [--writer_threads 2]  [--write_depth 16]
+
+# Imports
+import os
+import time
+import collections
+import multiprocessing
+import concurrent.futures
+import numpy as np
+
+from SEM_Image_Analysis_Batch import analyse_image, crashed_record, print_record, print_summary, print_stage_summary
+from SEM_Image_Analysis_Cache import file_hash
+from SEM_Image_Analysis_Loader import load_image
+from SEM_Image_Analysis_Store import ResultStore
+
+
+# Read and decode an image, runs in a prefetch thread.  Returns (imgdata, file hash).
+# imgdata is None when the detector should read the file itself: images to stream, and files that cannot be
+# read (analyse_image then reports why, as in the plain batch).
+def decode_image(image, hash_file=False):
+    filename = image.get('filename', '')
+    if not os.path.isfile(filename):
+        return None, None
+    sha = file_hash(filename) if hash_file else None
+    if image.get('streaming', False):
+        return None, sha
+    try:
+        # copied out of any memory map, so the file is read here and not while the image is sent to a worker
+        imgdata = np.array(load_image(filename)[0])
+    except Exception:
+        imgdata = None
+    return imgdata, sha
+
+
+# Analyse a decoded image, runs in a compute worker process.
+# Returns the status record (see analyse_image) and the output files as a list of (filename, data).
+def compute_image(image, imgdata):
+    files = []
+    params = dict(image, save_output=lambda filename, data: files.append((filename, data)))
+    if imgdata is not None:
+        params['imgdata'] = imgdata
+    return analyse_image(params), files
+
+
+# Write an output file, runs in a writer thread
+def write_file(filename, data):
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+
+# Pipelined batch runner function, takes the same images as sem_image_analysis_batch
+def sem_image_analysis_pipeline(**kwargs):
+    # Default parameters
+    verbose = kwargs.get('verbose', True)
+    # list of image entries, each a dict of detector keyword args plus 'detector' ('milled' or 'depo')
+    images = kwargs.get('images', [])
+    # number of compute worker processes (0 or None uses every core)
+    n_jobs = kwargs.get('n_jobs', 0)
+    # number of threads reading and decoding images, and the most images read ahead of the compute workers
+    # (None for twice the number of workers)
+    prefetch_threads = kwargs.get('prefetch_threads', 2)
+    prefetch_depth = kwargs.get('prefetch_depth', None)
+    # number of threads writing the output files, and the most rendered files waiting to be written
+    # (no more images are started while they are)
+    writer_threads = kwargs.get('writer_threads', 2)
+    write_depth = kwargs.get('write_depth', 16)
+    # Append the per-stage time / memory of each image to this file as json lines (None to not instrument)
+    instrument_file = kwargs.get('instrument_file', None)
+    # Results store (SQLite database) every result is appended to (None for no store),
+    # and the number of results written per transaction
+    store_filename = kwargs.get('store', None)
+    store_batch_size = kwargs.get('store_batch_size', 100)
+
+    if not n_jobs:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = max(1, min(n_jobs, len(images)))
+    if prefetch_depth is None:
+        prefetch_depth = 2 * n_jobs
+    prefetch_depth = max(1, prefetch_depth)
+
+    if instrument_file is not None:
+        images = [dict(image, instrument_file=instrument_file) for image in images]
+
+    records = []
+    store = ResultStore(store_filename, store_batch_size) if store_filename is not None else None
+    hash_file = store is not None
+
+    # An image is reported once its output files are all written
+    def finish(job):
+        records.append(job['record'])
+        if store is not None:
+            store.add(job['record'], job['image'])
+        if verbose:
+            print_record(job['record'], len(records), len(images))
+
+    # futures of each stage, mapped to the image (job) they are for
+    decoding = {}
+    computing = {}
+    writing = {}
+    # images decoded, waiting for a compute worker
+    decoded = collections.deque()
+    # images that were in a broken compute pool, waiting to be analysed again in a worker of their own
+    retry = collections.deque()
+    next_image = 0
+
+    start = time.perf_counter()
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs)
+    # start the worker processes before any thread, a process forked while a thread holds a lock (e.g. importing
+    # OpenCV) can hang
+    concurrent.futures.wait([executor.submit(int) for i in range(n_jobs)])
+    decoder = concurrent.futures.ThreadPoolExecutor(max_workers=prefetch_threads)
+    writer = concurrent.futures.ThreadPoolExecutor(max_workers=writer_threads)
+    # worker processes started from now on are spawned, not forked (see above)
+    spawn = multiprocessing.get_context('spawn')
+    try:
+        while True:
+            # read ahead while there is room in the decoded queue
+            while next_image < len(images) and len(decoding) + len(decoded) < prefetch_depth:
+                job = {'image': images[next_image], 'imgdata': None, 'file_hash': None, 'record': None, 'writes': 0}
+                decoding[decoder.submit(decode_image, job['image'], hash_file)] = job
+                next_image += 1
+            # each image to retry in a single worker pool of its own
+            while retry:
+                job = retry.popleft()
+                job['executor'] = concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=spawn)
+                computing[job['executor'].submit(compute_image, job['image'], None)] = job
+            # one image per compute worker, the rest wait decoded (so they can still be written out quickly)
+            while decoded and len(computing) < n_jobs and len(writing) < write_depth:
+                job = decoded.popleft()
+                try:
+                    computing[executor.submit(compute_image, job['image'], job['imgdata'])] = job
+                except concurrent.futures.process.BrokenProcessPool:
+                    # a worker died since the last images finished, start a new pool and try again
+                    decoded.appendleft(job)
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    executor = concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs, mp_context=spawn)
+                    continue
+                job['imgdata'] = None
+                job['executor'] = executor
+
+            if not (decoding or computing or writing):
+                break
+            done = concurrent.futures.wait(list(decoding) + list(computing) + list(writing),
+                                           return_when=concurrent.futures.FIRST_COMPLETED).done
+
+            for future in done:
+                if future in decoding:
+                    job = decoding.pop(future)
+                    job['imgdata'], job['file_hash'] = future.result()
+                    decoded.append(job)
+                elif future in computing:
+                    job = computing.pop(future)
+                    try:
+                        job['record'], files = future.result()
+                    except concurrent.futures.process.BrokenProcessPool:
+                        if job['executor'] is executor:
+                            # the shared pool: start a new one, and analyse the image again on its own
+                            executor.shutdown(wait=False, cancel_futures=True)
+                            executor = concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs, mp_context=spawn)
+                        if job['executor'] is not executor and not job.get('retried'):
+                            job['retried'] = True
+                            retry.append(job)
+                            continue
+                        job['record'], files = crashed_record(job['image']), []
+                    finally:
+                        if job['executor'] is not executor:
+                            # a broken pool, or a retry's own
+                            job['executor'].shutdown(wait=False)
+                    job['record']['file_hash'] = job['file_hash']
+                    for filename, data in files:
+                        writing[writer.submit(write_file, filename, data)] = job
+                        job['writes'] += 1
+                    if job['writes'] == 0:
+                        finish(job)
+                else:
+                    job = writing.pop(future)
+                    job['writes'] -= 1
+                    error = future.exception()
+                    if error is not None and job['record']['status'] == 'ok':
+                        job['record']['status'] = 'failed'
+                        job['record']['error'] = "could not write an output file: " + str(error)
+                    if job['writes'] == 0:
+                        finish(job)
+    finally:
+        decoder.shutdown(cancel_futures=True)
+        executor.shutdown(cancel_futures=True)
+        writer.shutdown()
+        if store is not None:
+            store.close()
+    elapsed = time.perf_counter() - start
+
+    if verbose:
+        print_summary(records, elapsed, n_jobs)
+        if instrument_file is not None:
+            print_stage_summary(records)
+
+    return records
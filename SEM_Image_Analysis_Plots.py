@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+# Plot rendering for the milled / deposited line detectors, and the stack and thickness map plots.
+# The figures are drawn with matplotlib's Agg canvas directly, without pyplot, so no figure is ever registered with
+# pyplot's figure manager (where an unclosed figure stays alive for the life of the process).
+# The gray level profile plots are the same layout for every image, so each worker process builds the two figures
+# (horizontal and vertical) once and reuses them: each plot only replaces the line data, limits, ticks and labels,
+# renders, then drops the profile data and the pixel buffer again, so memory stays flat over a long batch.
+# The bold text style is set on each figure while it is built and saved (plot_style), never in the global rcParams.
+
+# Imports
+import io
+import numpy as np
+import matplotlib
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# rcParams used while a plot is built and saved
+plot_style = {'font.weight': 'bold', 'axes.labelweight': 'bold'}
+
+# The reused profile plots of this process, by name ('horizontal', 'vertical')
+profile_plots = {}
+
+
+# A figure on its own Agg canvas (not known to pyplot, freed like any object once no longer referenced)
+def new_figure(figsize, dpi=100):
+    figure = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(figure)
+    return figure
+
+
+# Save a figure to filename, or with save_output render it to bytes and hand them to save_output(filename, data)
+# to be written later (e.g. by the writer threads of the pipelined batch)
+def save_figure(figure, filename, dpi, save_output=None):
+    with matplotlib.rc_context(plot_style):
+        if save_output is None:
+            figure.savefig(filename, dpi=dpi)
+        else:
+            buffer = io.BytesIO()
+            figure.savefig(buffer, format=filename.rsplit('.', 1)[-1], dpi=dpi)
+            save_output(filename, buffer.getvalue())
+
+
+# x ticks every step pixels from 0, plus the end of the profile if it is more than 150 pixels past the last one
+def edge_ticks(length, step):
+    ticks = list(range(0, int(length) + 1, step))
+    if length - ticks[-1] > 150:
+        ticks.append(length)
+    return ticks
+
+
+# Gray level profile plot: the raw and smoothed profile, its local minima and maxima and the two spikes
+class ProfilePlot(object):
+
+    def __init__(self):
+        with matplotlib.rc_context(plot_style):
+            self.figure = new_figure((12, 8))
+            self.axes = self.figure.add_subplot(111)
+            self.raw, = self.axes.plot([], [], color="blue", linewidth=2, linestyle="-", label="Average gray level")
+            self.smoothed, = self.axes.plot([], [], color="red", linewidth=1.5, linestyle="-",
+                                            label="Savitzky-Golay filter")
+            self.minima, = self.axes.plot([], [], "o", color="green", label="min")
+            self.maxima, = self.axes.plot([], [], "o", color="orange", label="max")
+            self.spike_labels = [self.axes.text(0, 0, 'Spike 1'), self.axes.text(0, 0, 'Spike 2')]
+
+    # Replace the plotted data.  ylim (bottom, top), ticks every tick_step pixels, spike labels at the (x, y) of
+    # label_positions, in label_size points (None for the default size) and the legend in legend_size.
+    def draw(self, profile_raw, profile, ylim, tick_step, title, xlabel, ylabel, label_positions, label_size=None,
+             legend_size=None):
+        x = np.arange(profile.shape[0], dtype=np.float64)
+        slope = np.sign(np.diff(profile))
+        minima = (np.diff(slope) > 0).nonzero()[0] + 1
+        maxima = (np.diff(slope) < 0).nonzero()[0] + 1
+
+        with matplotlib.rc_context(plot_style):
+            self.raw.set_data(x, profile_raw)
+            self.smoothed.set_data(x, profile)
+            self.minima.set_data(x[minima], profile[minima])
+            self.maxima.set_data(x[maxima], profile[maxima])
+            for text, position in zip(self.spike_labels, label_positions):
+                text.set_position(position)
+                text.set_fontsize(label_size if label_size is not None else matplotlib.rcParams['font.size'])
+                text.set_fontweight('bold')
+
+            self.axes.set_xlim(0, profile.shape[0])
+            self.axes.set_ylim(*ylim)
+            self.axes.set_xticks(edge_ticks(profile.shape[0], tick_step))
+            self.axes.minorticks_on()
+            self.axes.set_title(title, fontweight='bold', size=20)
+            self.axes.set_xlabel(xlabel, fontweight='bold', size=18)
+            self.axes.set_ylabel(ylabel, fontweight='bold', size=18)
+            self.axes.legend(loc="upper center", fontsize=legend_size)
+
+    def save(self, filename, dpi, save_output=None):
+        save_figure(self.figure, filename, dpi, save_output)
+
+    # Drop the profile data and the rendered pixels, keeping the figure for the next plot
+    def release(self):
+        for line in (self.raw, self.smoothed, self.minima, self.maxima):
+            line.set_data([], [])
+        FigureCanvasAgg(self.figure)
+
+
+# The reused profile plot of this process called name (built on first use)
+def profile_plot(name):
+    if name not in profile_plots:
+        profile_plots[name] = ProfilePlot()
+    return profile_plots[name]
+
+
+# Plot the thickness of each band (see thickness_map) against the x position of its centre in the full image
+def plot_thickness_map(plot_filename, band_map, crop_left, save_output=None):
+    centres = [crop_left + (start + stop) / 2.0 for start, stop in band_map['band_columns']]
+    thickness = [np.nan if value is None else value for value in band_map['thickness']]
+    with matplotlib.rc_context(plot_style):
+        figure = new_figure((12, 8))
+        axes = figure.add_subplot(111)
+        axes.plot(centres, thickness, 'o-', color="blue")
+        if band_map['mean_thickness'] is not None:
+            axes.axhline(band_map['mean_thickness'], color="red", linestyle="--", label="Mean")
+            axes.legend(loc="best")
+        axes.set_title("Distance between the horizontal marks vs position", fontweight='bold', size=20)
+        axes.set_xlabel("Distance from the left of the image, Pixels", fontweight='bold', size=18)
+        axes.set_ylabel("Distance between the marks, microns", fontweight='bold', size=18)
+        axes.minorticks_on()
+    save_figure(figure, plot_filename, 100, save_output)
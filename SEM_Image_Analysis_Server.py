@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+
+# Long running local analysis service for the milled / deposited line detectors.
+# Acquisition software can ask for the marks of every frame without starting a python process per image:
+# the service keeps a pool of worker processes with the detectors imported and the smoothing kernels built,
+# and answers HTTP requests on localhost (or on a Unix socket).  Requests are handled concurrently, each one is
+# analysed by the next free worker.
+#
+#   POST /analyse   json body {"filename": "/path/image.tif", "detector": "milled", "img_width": 17.0, ...}
+#                   or the image file itself as the body (Content-Type application/octet-stream or image/...),
+#                   with the detector and parameters in the query string: /analyse?detector=depo&img_width=17.0
+#   GET  /health    {"status": "ok" | "restarting", "workers": N, "requests": ..., "worker_restarts": ...}
+#
+# The reply is the status record of the batch runner (see analyse_image in SEM_Image_Analysis_Batch.py) as json:
+# {"status": "ok" | "flagged" | "failed", "error": ..., "seconds": ..., "result": {LineDetectResult.as_dict()}}.
+# A frame below the request's min_confidence is 'flagged': measured, but not worth rendering (see the detectors).
+# If a worker process dies (e.g. a crash in an image decoder, or killed when out of memory) the pool is broken: a new
+# pool is started for the next requests, and the requests that were in the broken pool are each analysed again in a
+# worker of their own, so only the request that kills its worker fails (status 500).
+# Only the measurements are made unless the request asks for other outputs (e.g. "outputs": ["plots"]).
+# A request may only set the detector, its image parameters (see image_param_types in SEM_Image_Analysis_Batch.py)
+# and the filename (or the format of an image sent as bytes); anything else is refused (status 400).
+# An output_prefix is only accepted when the service has an output folder (--output_dir), and is taken inside it.
+# The service only listens on the local machine, it can read any image the user running it can.
+
+# Usage:
+# SEM_Image_Analysis_Server.py  [--port 8765 | --socket /tmp/sem_analysis.sock]  [--jobs 4]  [--cache folder]
+#                               [--output_dir folder]
+# curl -d '{"filename": "/data/image.tif", "img_width": 17.0}' http://127.0.0.1:8765/analyse
+# curl --data-binary @image.tif "http://127.0.0.1:8765/analyse?detector=depo&img_width=17.0"
+
+# Imports
+import sys
+import os
+import json
+import stat
+import signal
+import multiprocessing
+import socket
+import argparse
+import tempfile
+import threading
+import http.client
+import http.server
+import socketserver
+import urllib.parse
+import concurrent.futures
+
+from SEM_Image_Analysis_Batch import analyse_image, convert_image_params, image_param_types, detectors, \
+    crashed_record
+
+# Outputs written when a request does not ask for any
+default_outputs = {'numbers'}
+
+# Largest image accepted in a request body (bytes)
+max_body_bytes = 2 * 1024 ** 3
+
+# Keys a request may set besides the image parameters (filename for json requests, format for an image sent as bytes)
+request_keys = {'detector', 'output_prefix'}
+
+
+# Run in each worker process when it starts: import the detectors and build the smoothing kernels,
+# so the first request a worker gets is as fast as the rest
+def start_worker():
+    # Ctrl-C stops the server, which then shuts the workers down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from SEM_Image_Analysis_Common import smoothing_operator, horizontal_smoothing, vertical_smoothing
+    for smoothing in (horizontal_smoothing, vertical_smoothing):
+        smoothing_operator(*smoothing, None)
+    # used by the detectors once imported
+    import cv2
+
+
+# Start a pool of n_jobs worker processes, and wait until they are all ready.
+# mp_context: how the workers are started (None for the default).
+def start_workers(n_jobs, mp_context=None):
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp_context,
+                                                      initializer=start_worker)
+    concurrent.futures.wait([executor.submit(int) for i in range(n_jobs)])
+    return executor
+
+
+# Replace the worker pool broken (a worker died) with a new one.  Only the first request to find it broken
+# starts the new pool, the others wait for it.
+def restart_workers(server, broken):
+    with server.restart_lock:
+        with server.lock:
+            if server.executor is not broken:
+                # already replaced
+                return
+            server.workers_state = 'restarting'
+        broken.shutdown(wait=False, cancel_futures=True)
+        # spawned, not forked: the request threads are running, a process forked while one of them holds a lock
+        # can hang
+        executor = start_workers(server.n_jobs, multiprocessing.get_context('spawn'))
+        with server.lock:
+            server.executor = executor
+            server.workers_state = 'ok'
+            server.counts['worker_restarts'] += 1
+
+
+# Run a request's task (function, args...) in a worker of its own, returns (record, HTTP status code or None).
+# The status is 500 when that worker dies too.
+def analyse_isolated(task, image):
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        return executor.submit(*task).result(), None
+    except concurrent.futures.process.BrokenProcessPool:
+        return crashed_record(image), 500
+    finally:
+        executor.shutdown()
+
+
+# The output_prefix of a request as a path inside the service's output folder output_dir: a relative name such as
+# "run1/frame_0001_" that may not lead outside it.  Raises ValueError without an output folder, or for a prefix
+# outside it.
+def output_prefix_path(output_dir, prefix):
+    if output_dir is None:
+        raise ValueError("output_prefix is not accepted, the service was started without an output folder")
+    root = os.path.realpath(output_dir)
+    folder = os.path.realpath(os.path.join(root, os.path.dirname(str(prefix))))
+    if folder != root and not folder.startswith(root + os.sep):
+        raise ValueError("output_prefix must be inside the output folder: " + str(prefix))
+    return os.path.join(folder, os.path.basename(str(prefix)))
+
+
+# Remove the Unix socket left at socket_path by a previous run.  Returns False (and leaves it) if that is not a socket.
+def remove_socket(socket_path):
+    if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+        return False
+    os.remove(socket_path)
+    return True
+
+
+# Analyse an image sent as bytes: written to a temporary file (the detectors read from a file), then removed.
+# Runs in a worker process.
+def analyse_bytes(data, suffix, image, cache_dir=None):
+    # in memory (/dev/shm) where there is one
+    temp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    handle, filename = tempfile.mkstemp(suffix=suffix, prefix='sem_request_', dir=temp_dir)
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(data)
+        record = analyse_image(dict(image, filename=filename), cache_dir)
+    finally:
+        os.remove(filename)
+    record['filename'] = ''
+    if record['result'] is not None:
+        record['result']['filename'] = ''
+    return record
+
+
+class AnalysisRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    # server.executor, server.workers_state, server.cache_dir, server.output_dir, server.counts and the locks are
+    # set up by sem_image_analysis_server
+
+    def do_GET(self):
+        if urllib.parse.urlparse(self.path).path != '/health':
+            self.send_json(404, {'status': 'failed', 'error': "unknown path " + self.path})
+            return
+        with self.server.lock:
+            counts = dict(self.server.counts)
+            state = self.server.workers_state
+        self.send_json(200 if state == 'ok' else 503, dict(counts, status=state, workers=self.server.n_jobs))
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != '/analyse':
+            self.send_json(404, {'status': 'failed', 'error': "unknown path " + self.path})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length > max_body_bytes:
+                raise ValueError("request body too large (" + str(length) + " bytes)")
+            body = self.rfile.read(length)
+            content_type = self.headers.get('Content-Type', 'application/json').split(';')[0].strip()
+            query = dict(urllib.parse.parse_qsl(url.query))
+
+            # the image itself, otherwise json parameters (whatever the client calls them, e.g. curl -d)
+            if content_type != 'application/octet-stream' and not content_type.startswith('image/'):
+                image = json.loads(body.decode() or '{}')
+                image.update(query)
+                if 'filename' not in image:
+                    raise ValueError("no filename given")
+                data = None
+            else:
+                image = query
+                data = body
+            unknown = sorted(set(image) - set(image_param_types) - request_keys -
+                             {'filename' if data is None else 'format'})
+            if unknown:
+                raise ValueError("unknown parameter(s) " + ", ".join(str(key) for key in unknown))
+            image = convert_image_params(image)
+            image.setdefault('outputs', default_outputs)
+            if 'output_prefix' in image:
+                image['output_prefix'] = output_prefix_path(self.server.output_dir, image['output_prefix'])
+            elif data is not None and set(image['outputs']) - {'numbers'}:
+                # the image is only in a temporary file
+                raise ValueError("give an output_prefix for the files written from an image sent as bytes")
+            image.setdefault('detector', 'milled')
+            if image['detector'] not in detectors:
+                raise ValueError("unknown detector '" + str(image['detector']) + "' (expected one of: " +
+                                 ", ".join(sorted(detectors)) + ")")
+        except (ValueError, TypeError, KeyError) as e:
+            self.count('bad_requests')
+            self.send_json(400, {'status': 'failed', 'error': str(e)})
+            return
+
+        if data is None:
+            task = (analyse_image, image, self.server.cache_dir)
+        else:
+            suffix = '.' + image.pop('format', content_type.split('/')[-1].replace('octet-stream', 'tif'))
+            task = (analyse_bytes, data, suffix, image, self.server.cache_dir)
+        code = None
+        for attempt in range(2):
+            with self.server.lock:
+                executor = self.server.executor
+            try:
+                future = executor.submit(*task)
+            except concurrent.futures.process.BrokenProcessPool:
+                # broken by an earlier request, try again on the new pool
+                restart_workers(self.server, executor)
+                continue
+            try:
+                record = future.result()
+            except concurrent.futures.process.BrokenProcessPool:
+                # a worker died while this request was in the pool, maybe analysing another request
+                restart_workers(self.server, executor)
+                record, code = analyse_isolated(task, image)
+            break
+        else:
+            record = crashed_record(image)
+            code = 500
+        self.count('requests')
+        if record['status'] != 'ok':
+            self.count(record['status'])
+        if code is None:
+            code = 422 if record['status'] == 'failed' else 200
+        self.send_json(code, record)
+
+    def count(self, name):
+        with self.server.lock:
+            self.server.counts[name] = self.server.counts.get(name, 0) + 1
+
+    def send_json(self, code, data):
+        reply = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    # Unix socket clients have no address
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+# Server function, runs until interrupted (or server.shutdown() is called from another thread)
+def sem_image_analysis_server(**kwargs):
+    # Default parameters
+    verbose = kwargs.get('verbose', True)
+    # Listen on localhost at this port, or on a Unix socket at this path instead
+    port = kwargs.get('port', 8765)
+    socket_path = kwargs.get('socket', None)
+    # number of worker processes (0 or None uses every core)
+    n_jobs = kwargs.get('n_jobs', 0)
+    # Result cache folder (see SEM_Image_Analysis_Cache.py), None for no cache
+    cache_dir = kwargs.get('cache_dir', None)
+    # Folder the requests' output_prefix is taken inside (None to refuse requests that give one)
+    output_dir = kwargs.get('output_dir', None)
+    # Called with the server once it is listening (e.g. to stop it from another thread)
+    on_ready = kwargs.get('on_ready', None)
+
+    if not n_jobs:
+        n_jobs = os.cpu_count() or 1
+
+    if socket_path is not None:
+        # left over from a previous run
+        if os.path.exists(socket_path) and not remove_socket(socket_path):
+            print("ERROR:  " + socket_path + " exists and is not a socket, it is not replaced.")
+            sys.exit()
+        server = ThreadingUnixHTTPServer(socket_path, AnalysisRequestHandler)
+        address = socket_path
+    else:
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', port), AnalysisRequestHandler)
+        address = "http://127.0.0.1:" + str(server.server_address[1])
+    server.verbose = verbose
+    server.n_jobs = n_jobs
+    server.cache_dir = cache_dir
+    server.output_dir = output_dir
+    server.counts = {'requests': 0, 'flagged': 0, 'failed': 0, 'bad_requests': 0, 'worker_restarts': 0}
+    server.lock = threading.Lock()
+    server.restart_lock = threading.Lock()
+    # start (and warm up) all the workers now, not on the first requests
+    server.executor = start_workers(n_jobs)
+    server.workers_state = 'ok'
+
+    if verbose:
+        print(">  Analysing images on " + address + " with " + str(n_jobs) + " worker(s) (Ctrl-C to stop)")
+        sys.stdout.flush()
+    if on_ready is not None:
+        on_ready(server)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        if verbose:
+            print("\n>  Stopped, answered " + str(server.counts['requests']) + " requests")
+    finally:
+        server.server_close()
+        server.executor.shutdown()
+        if socket_path is not None and os.path.exists(socket_path):
+            remove_socket(socket_path)
+    return server.counts
+
+
+# HTTP connection over a Unix socket
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path, timeout=600):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+# Client: ask a running service to analyse an image, returns the status record.
+# Give filename (a path the service can read) or data (the image file contents), plus detector keyword args.
+def sem_image_analysis_request(**kwargs):
+    params = dict(kwargs)
+    port = params.pop('port', 8765)
+    socket_path = params.pop('socket', None)
+    data = params.pop('data', None)
+    if 'outputs' in params:
+        params['outputs'] = sorted(params['outputs'])
+
+    if socket_path is not None:
+        connection = UnixHTTPConnection(socket_path)
+    else:
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=600)
+    try:
+        if data is None:
+            connection.request('POST', '/analyse', json.dumps(params), {'Content-Type': 'application/json'})
+        else:
+            query = {name: ",".join(value) if isinstance(value, list) else value for name, value in params.items()}
+            connection.request('POST', '/analyse?' + urllib.parse.urlencode(query), data,
+                               {'Content-Type': 'application/octet-stream'})
+        return json.loads(connection.getresponse().read().decode())
+    finally:
+        connection.close()
+
+
+# If we are running this script interactively, call the function safely
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Serve the SEM line detectors on localhost or a Unix socket.")
+    parser.add_argument('--port', type=int, default=8765, help="localhost port to listen on (default 8765)")
+    parser.add_argument('--socket', help="listen on this Unix socket instead of a port")
+    parser.add_argument('--jobs', type=int, default=0, help="number of worker processes, 0 uses every core (default)")
+    parser.add_argument('--cache', help="result cache folder, images already analysed are not analysed again")
+    parser.add_argument('--output_dir', help="folder the output_prefix of the requests is taken inside "
+                                             "(without it requests may not give an output_prefix)")
+    parser.add_argument('--quiet', action='store_true', help="do not log each request")
+    args = parser.parse_args()
+
+    sem_image_analysis_server(port=args.port,
+                              socket=args.socket,
+                              n_jobs=args.jobs,
+                              cache_dir=args.cache,
+                              output_dir=args.output_dir,
+                              verbose=not args.quiet)
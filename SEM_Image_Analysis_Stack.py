@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+
+# Line detection on a stack of frames: a multi-page TIFF, or a list of same-sized frames (arrays or image files),
+# e.g. a time series of the same fiducial marks.
+# Every frame gets the same crop and parameters as the milled / deposited line detectors, and the same positions
+# the detector would give on that frame on its own.  The result is one LineDetectResult per frame (with its frame
+# number), plus the separation of the marks over time.
+#
+# All frames are held as one (N, H, W) array.  The row profiles of the central band of every frame are taken in
+# one pass over the stack into an (N, H) array, and smoothed together; the column profiles (each frame has its own
+# vertical crop) likewise into an (N, W) array.  Only the spike selection is done frame by frame.
+# OpenCV's row / column reduction run frame by frame over the stack is faster than numpy's sum over the
+# (N, H, W) array in one call (about 2-4x on 100 frames of 1600x1200), so the pass is a loop over frame views.
+#
+# Outputs:  'numbers'      csv table of the positions and distances of every frame
+#           'plots'        the separation of the marks vs frame number
+#           'frame_plots'  the smoothed row and column profiles of every frame, with the marks (one file per frame)
+
+# Usage:
+# SEM_Image_Analysis_Stack.py  stack.tif  --detector milled  --img_width 17.0  [--crop_top 400 ...]  [--frame_plots]
+# SEM_Image_Analysis_Stack.py  frame_000.tif frame_001.tif ...  --detector depo  --img_width 17.0
+
+# Imports
+import sys
+import os
+import csv
+import argparse
+import datetime
+import numpy as np
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+from SEM_Image_Analysis_Common import LineDetectResult, smooth_profiles, smoothing_methods, horizontal_smoothing, \
+    vertical_smoothing, find_extrema, select_spikes, band_columns, vertical_crop_rows, average_profile
+from SEM_Image_Analysis_Loader import load_image, crop_ranges, is_gray8_page
+import SEM_Image_Analysis_Milled_Line_Detect
+import SEM_Image_Analysis_Depo_Line_Detect
+
+# Detector modules (for the polarity of the marks, and the defaults of the parameters)
+detector_modules = {'milled': SEM_Image_Analysis_Milled_Line_Detect,
+                    'depo': SEM_Image_Analysis_Depo_Line_Detect}
+
+# Known output types
+output_types = {'numbers', 'plots', 'frame_plots'}
+
+
+# Read every page of a multi-page image file as one (N, H, W) uint8 array, returns (stack, height, width).
+# TIFFs are read with tifffile (all pages into one array), other files / codecs tifffile lacks with OpenCV.
+def read_pages(filename):
+    if tifffile is not None and filename.lower().endswith(('.tif', '.tiff')):
+        try:
+            with tifffile.TiffFile(filename) as tif:
+                pages = tif.pages
+                if all(is_gray8_page(page) for page in pages) and len({page.shape for page in pages}) == 1:
+                    stack = tif.asarray(key=slice(None))
+                    stack = stack.reshape((len(pages),) + pages[0].shape)
+                    return stack, stack.shape[1], stack.shape[2]
+        except Exception:
+            # not a TIFF tifffile can read (e.g. missing codec), fall back to OpenCV
+            pass
+
+    import cv2
+    ok, pages = cv2.imreadmulti(filename, flags=cv2.IMREAD_GRAYSCALE)
+    if not ok or len(pages) == 0:
+        raise IOError("could not read the image " + filename)
+    if len({page.shape for page in pages}) != 1:
+        raise ValueError("the pages of " + filename + " are not all the same size")
+    stack = np.stack(pages)
+    return stack, stack.shape[1], stack.shape[2]
+
+
+# Cropped (N, H, W) stack from a multi-page file, or a list of frames (arrays, or image files read one by one
+# inside the crop).  Returns (stack, img_height, img_width, names), the image size before the crop and a name
+# per frame.
+def load_stack(filename=None, frames=None, crop_top=0, crop_bottom=0, crop_left=0, crop_right=0):
+    if frames is None:
+        stack, img_height, img_width = read_pages(filename)
+        top, bottom, left, right = crop_ranges(img_height, img_width, crop_top, crop_bottom, crop_left, crop_right)
+        names = [filename] * stack.shape[0]
+        return stack[:, top:bottom, left:right], img_height, img_width, names
+
+    cropped = []
+    sizes = set()
+    names = []
+    for i, frame in enumerate(frames):
+        if isinstance(frame, np.ndarray):
+            img_height, img_width = frame.shape
+            top, bottom, left, right = crop_ranges(img_height, img_width, crop_top, crop_bottom, crop_left, crop_right)
+            cropped.append(frame[top:bottom, left:right])
+            names.append(filename if filename is not None else "frame " + str(i))
+        else:
+            imgdata, img_height, img_width = load_image(frame, crop_top, crop_bottom, crop_left, crop_right)
+            cropped.append(imgdata)
+            names.append(frame)
+        sizes.add((img_height, img_width))
+    if len(sizes) != 1:
+        raise ValueError("the frames are not all the same size: " +
+                         ", ".join(str(w) + "x" + str(h) for h, w in sorted(sizes)))
+    return np.stack(cropped), img_height, img_width, names
+
+
+# Average profiles of every frame of a (N, H, W) stack, as an (N, length) array.
+# axis=1 averages each row of the columns start:stop, axis=0 each column of the rows rows[i] of frame i.
+# The frames are summed with OpenCV whatever their size (see profile_sums): its import pays off over a stack.
+def stack_profiles(stack, axis, start=None, stop=None, rows=None):
+    if axis == 1:
+        return np.array([average_profile(frame[:, start:stop], 1, backend='opencv')
+                         for frame in stack]).reshape(stack.shape[0], -1)
+    return np.array([average_profile(frame[row_start:row_stop, :], 0, backend='opencv')
+                     for frame, (row_start, row_stop) in zip(stack, rows)]).reshape(stack.shape[0], -1)
+
+
+# Stack function
+def sem_image_analysis_stack(**kwargs):
+    # Default parameters
+    verbose = kwargs.get('verbose', True)
+    # Multi-page image file, or (with frames) the name to report for frames given as arrays
+    filename = kwargs.get('filename', None)
+    # List of same-sized frames, arrays or image filenames (instead of a multi-page file)
+    frames = kwargs.get('frames', None)
+    detector = kwargs.get('detector', 'milled')
+    # The detector's defaults (see defaults in the detector modules; an unknown detector is reported below)
+    defaults = detector_modules.get(detector, SEM_Image_Analysis_Milled_Line_Detect).defaults
+    real_width = kwargs.get('img_width', defaults['img_width'])
+    # Initial crop, the same for every frame
+    crop_top = kwargs.get('crop_top', defaults['crop_top'])
+    crop_bottom = kwargs.get('crop_bottom', defaults['crop_bottom'])
+    crop_left = kwargs.get('crop_left', defaults['crop_left'])
+    crop_right = kwargs.get('crop_right', defaults['crop_right'])
+    # Detector parameters, as the detectors
+    total_width_cols = kwargs.get('total_width_cols', defaults['total_width_cols'])
+    vertical_crop_extra = kwargs.get('vertical_crop_extra', defaults['vertical_crop_extra'])
+    peak_width_max = kwargs.get('peak_width_max', defaults['peak_width_max'])
+    peak_dist_max = kwargs.get('peak_dist_max', defaults['peak_dist_max'])
+    smoothing = kwargs.get('smoothing', defaults['smoothing'])
+    # Files to write, any of 'numbers', 'plots', 'frame_plots'
+    outputs = kwargs.get('outputs', {'numbers', 'plots'})
+    output_prefix = kwargs.get('output_prefix', None)
+
+    # Check the inputs
+    if frames is None and (filename is None or not os.path.isfile(filename)):
+        print("ERROR:  The filename you entered: " + str(filename) + " does not exist.")
+        sys.exit()
+    for frame in frames or []:
+        if not isinstance(frame, np.ndarray) and not os.path.isfile(frame):
+            print("ERROR:  The frame filename you entered: " + str(frame) + " does not exist.")
+            sys.exit()
+    if detector not in detector_modules:
+        print("ERROR:  Unknown detector: " + str(detector) +
+              "  (expected: " + ", ".join(sorted(detector_modules)) + ")")
+        sys.exit()
+    if smoothing not in smoothing_methods:
+        print("ERROR:  Unknown smoothing method: " + str(smoothing) +
+              "  (expected: " + ", ".join(sorted(smoothing_methods)) + ")")
+        sys.exit()
+    if not set(outputs) <= output_types:
+        print("ERROR:  Unknown outputs: " + ", ".join(sorted(set(outputs) - output_types)) +
+              "  (expected: " + ", ".join(sorted(output_types)) + ")")
+        sys.exit()
+
+    if output_prefix is None:
+        x = datetime.datetime.now()
+        base = filename if filename is not None else frames[0] if not isinstance(frames[0], np.ndarray) else 'stack.tif'
+        output_prefix = os.path.splitext(base)[0] + "_stack_" + x.strftime("%Y%m%d%H%M%S") + "_"
+
+    try:
+        stack, img_height, img_width, names = load_stack(filename, frames, crop_top, crop_bottom,
+                                                         crop_left, crop_right)
+    except (IOError, ValueError) as e:
+        print("ERROR:  " + str(e))
+        sys.exit()
+    n_frames, cropped_height, cropped_width = stack.shape
+    length_factor = img_width / real_width  # pixels/ um
+    module = detector_modules[detector]
+
+    if verbose:
+        print(">  " + str(n_frames) + " frames of " + str(img_width) + "x" + str(img_height) +
+              " pixels, cropped to " + str(cropped_width) + "x" + str(cropped_height))
+
+    # Horizontal marks: row profiles of the central band of every frame, smoothed together
+    band_start, band_stop = band_columns(cropped_width, total_width_cols)
+    h_profiles = smooth_profiles(stack_profiles(stack, 1, band_start, band_stop), *horizontal_smoothing,
+                                 method=smoothing)
+    h_spikes = [select_spikes(profile, find_extrema(profile), module.horizontal_polarity, peak_width_max,
+                              peak_dist_max) for profile in h_profiles]
+
+    # Vertical marks: column profiles of the rows between each frame's horizontal marks
+    rows = [vertical_crop_rows(cropped_height, pix, vertical_crop_extra) for pix, strength, level in h_spikes]
+    v_profiles = smooth_profiles(stack_profiles(stack, 0, rows=rows), *vertical_smoothing, method=smoothing)
+    v_spikes = [select_spikes(profile, find_extrema(profile), module.vertical_polarity, peak_width_max,
+                              peak_dist_max) for profile in v_profiles]
+
+    results = []
+    for i in range(n_frames):
+        h_pix, h_strength, h_level = h_spikes[i]
+        v_pix, v_strength, v_level = v_spikes[i]
+        results.append(LineDetectResult(filename=names[i],
+                                        detector=detector,
+                                        img_width=img_width,
+                                        img_height=img_height,
+                                        real_width=real_width,
+                                        length_factor=length_factor,
+                                        crop_top=crop_top,
+                                        crop_bottom=crop_bottom,
+                                        crop_left=crop_left,
+                                        crop_right=crop_right,
+                                        horizontal_spike_pix=tuple(h_pix),
+                                        horizontal_spike_strength=tuple(h_strength),
+                                        horizontal_spike_level=tuple(h_level),
+                                        horizontal_distance=abs(h_pix[1] - h_pix[0]) / length_factor,
+                                        vertical_spike_pix=tuple(v_pix),
+                                        vertical_spike_strength=tuple(v_strength),
+                                        vertical_spike_level=tuple(v_level),
+                                        vertical_distance=abs(v_pix[1] - v_pix[0]) / length_factor,
+                                        frame=i))
+
+    if 'numbers' in outputs:
+        write_separation(output_prefix + "separation.csv", results)
+    if 'plots' in outputs:
+        plot_separation(output_prefix + "separation.pdf", results)
+    if 'frame_plots' in outputs:
+        for i, result in enumerate(results):
+            plot_frame(output_prefix + "frame_" + str(i).zfill(len(str(n_frames - 1))) + "_profiles.pdf",
+                       result, h_profiles[i], v_profiles[i])
+
+    if verbose:
+        print_separation(results)
+    return results
+
+
+# Horizontal and vertical separation (microns) of every frame, as two arrays
+def separation(results):
+    return (np.array([result.horizontal_distance for result in results]),
+            np.array([result.vertical_distance for result in results]))
+
+
+# Write the positions and distances of every frame as csv, one row per frame
+def write_separation(csv_filename, results):
+    with open(csv_filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['frame', 'filename',
+                         'horizontal_spike_pix_image_1', 'horizontal_spike_pix_image_2', 'horizontal_distance',
+                         'vertical_spike_pix_image_1', 'vertical_spike_pix_image_2', 'vertical_distance'])
+        for result in results:
+            writer.writerow([result.frame, result.filename] +
+                            list(result.horizontal_spike_pix_image) + [result.horizontal_distance] +
+                            list(result.vertical_spike_pix_image) + [result.vertical_distance])
+
+
+# Plot the separation of the marks vs frame number
+def plot_separation(plot_filename, results):
+    from SEM_Image_Analysis_Plots import new_figure
+
+    horizontal, vertical = separation(results)
+    fig = new_figure((12, 8))
+    axes = fig.add_subplot(111)
+    axes.plot(horizontal, 'o-', label='Horizontal marks')
+    axes.plot(vertical, 's-', label='Vertical marks')
+    axes.set_title("Separation of the marks vs frame", fontweight='bold', size=20)
+    axes.set_xlabel("Frame", fontweight='bold', size=18)
+    axes.set_ylabel("Separation, microns", fontweight='bold', size=18)
+    axes.minorticks_on()
+    axes.legend(loc="best")
+    fig.savefig(plot_filename, dpi=100)
+
+
+# Plot the smoothed row and column profiles of one frame, with its marks
+def plot_frame(plot_filename, result, h_profile, v_profile):
+    from SEM_Image_Analysis_Plots import new_figure
+
+    fig = new_figure((12, 10))
+    h_axes, v_axes = fig.subplots(2, 1)
+    h_axes.plot(h_profile, 'b-')
+    h_axes.plot(result.horizontal_spike_pix, result.horizontal_spike_level, 'ro')
+    h_axes.set_title("Frame " + str(result.frame) + ": average gray level of each row", fontweight='bold')
+    h_axes.set_xlabel("Distance from the top of the image, Pixels")
+    v_axes.plot(v_profile, 'b-')
+    v_axes.plot(result.vertical_spike_pix, result.vertical_spike_level, 'ro')
+    v_axes.set_title("Average gray level of each column", fontweight='bold')
+    v_axes.set_xlabel("Distance from the left of the image, Pixels")
+    fig.tight_layout()
+    fig.savefig(plot_filename, dpi=100)
+
+
+# Print the separation of every frame, and its spread over the stack
+def print_separation(results):
+    print("  frame   horizontal [um]   vertical [um]")
+    for result in results:
+        print(str(result.frame).rjust(7) + "   " + str(round(result.horizontal_distance, 4)).rjust(15) + "   " +
+              str(round(result.vertical_distance, 4)).rjust(13))
+    for axis, distances in zip(['horizontal', 'vertical'], separation(results)):
+        print(">  " + axis.capitalize() + " separation: mean " + str(round(float(distances.mean()), 4)) +
+              " microns, standard deviation " + str(round(float(distances.std()), 4)) +
+              ", drift over the stack " + str(round(float(distances[-1] - distances[0]), 4)))
+
+
+# If we are running this script interactively, call the function safely
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Run a SEM line detector on every frame of a stack.")
+    parser.add_argument('filenames', nargs='+', help="multi-page image, or several same-sized frames")
+    parser.add_argument('--detector', choices=sorted(detector_modules), default='milled',
+                        help="detector to use (default milled)")
+    parser.add_argument('--img_width', type=float, help="real image width in microns")
+    for param in ['crop_top', 'crop_bottom', 'crop_left', 'crop_right', 'total_width_cols', 'vertical_crop_extra',
+                  'peak_width_max', 'peak_dist_max']:
+        parser.add_argument('--' + param, type=int)
+    parser.add_argument('--smoothing', choices=sorted(smoothing_methods))
+    parser.add_argument('--no_plots', action='store_true', help="do not plot the separation vs frame")
+    parser.add_argument('--frame_plots', action='store_true', help="plot the profiles of every frame")
+    parser.add_argument('--output_prefix', help="prefix of the output files")
+    args = parser.parse_args()
+
+    # parameters not given are the detector's defaults
+    params = {param: getattr(args, param) for param in ['img_width', 'crop_top', 'crop_bottom', 'crop_left',
+                                                        'crop_right', 'total_width_cols', 'vertical_crop_extra',
+                                                        'peak_width_max', 'peak_dist_max', 'smoothing',
+                                                        'output_prefix']
+              if getattr(args, param) is not None}
+    stack_outputs = {'numbers'}
+    if not args.no_plots:
+        stack_outputs.add('plots')
+    if args.frame_plots:
+        stack_outputs.add('frame_plots')
+    if len(args.filenames) == 1:
+        params['filename'] = args.filenames[0]
+    else:
+        params['frames'] = args.filenames
+
+    sem_image_analysis_stack(detector=args.detector,
+                             outputs=stack_outputs,
+                             **params)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+# Append-only results store for the line detectors, in an SQLite database.
+# Each analysis (from the batch runner or the folder watcher) adds one row: the image path and content hash,
+# the detector and all its parameters, the spike positions, the distances and the timing.
+# Rows are written in batches (one transaction per batch_size results) and are never updated, so thousands of
+# results can be queried later without re-running the images or parsing logs, e.g.
+#    sqlite3 results.db "select filename, horizontal_distance, vertical_distance from results where status = 'ok'"
+#
+# The database uses write-ahead logging, so several processes (e.g. a batch and a watcher) can append to the same
+# file at once: writers wait for each other (up to timeout seconds) and readers are never blocked.
+
+# Usage:
+# SEM_Image_Analysis_Store.py  results.db  [--filename "%image_01%"]  [--detector milled]  [--limit 20]
+
+# Imports
+import sys
+import os
+import json
+import time
+import sqlite3
+import argparse
+
+from SEM_Image_Analysis_Cache import normalise_param
+
+# Columns of the results table (after the id), in order
+store_columns = [('time', 'TEXT'),
+                 ('filename', 'TEXT'),
+                 ('file_hash', 'TEXT'),
+                 ('detector', 'TEXT'),
+                 ('status', 'TEXT'),
+                 ('error', 'TEXT'),
+                 ('params', 'TEXT'),
+                 ('horizontal_spike_pix_1', 'INTEGER'),
+                 ('horizontal_spike_pix_2', 'INTEGER'),
+                 ('horizontal_distance', 'REAL'),
+                 ('vertical_spike_pix_1', 'INTEGER'),
+                 ('vertical_spike_pix_2', 'INTEGER'),
+                 ('vertical_distance', 'REAL'),
+                 ('seconds', 'REAL'),
+                 ('cached', 'INTEGER'),
+                 ('stages', 'TEXT'),
+                 ('result', 'TEXT')]
+
+# Image entry keys that are not detector parameters
+ignored_params = {'filename', 'detector', 'verbose', 'output_prefix', 'instrument_file'}
+
+
+class ResultStore(object):
+
+    def __init__(self, db_filename, batch_size=100, timeout=60.0):
+        self.db_filename = db_filename
+        self.batch_size = batch_size
+        self.pending = []
+        self.connection = sqlite3.connect(db_filename, timeout=timeout, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.execute_write("CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY, " +
+                           ", ".join(name + " " + column_type for name, column_type in store_columns) + ")",
+                           "CREATE INDEX IF NOT EXISTS results_filename ON results (filename)",
+                           "CREATE INDEX IF NOT EXISTS results_file_hash ON results (file_hash)")
+
+    # Run statements in one write transaction (taken at the start, so concurrent writers queue instead of failing)
+    def execute_write(self, *statements, **kwargs):
+        rows = kwargs.get('rows', None)
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            for statement in statements:
+                if rows is None:
+                    self.connection.execute(statement)
+                else:
+                    self.connection.executemany(statement, rows)
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+
+    # Add the status record of one image (as returned by analyse_image in SEM_Image_Analysis_Batch.py),
+    # with the image entry it was analysed with.  Written once batch_size records are waiting.
+    def add(self, record, image=None):
+        result = record.get('result') or {}
+        params = {name: normalise_param(value) for name, value in (image or {}).items() if name not in ignored_params}
+        h_pix = result.get('horizontal_spike_pix_image', (None, None))
+        v_pix = result.get('vertical_spike_pix_image', (None, None))
+        self.pending.append((time.strftime("%Y-%m-%d %H:%M:%S"),
+                             os.path.abspath(record['filename']) if record['filename'] else record['filename'],
+                             record.get('file_hash'),
+                             record['detector'],
+                             record['status'],
+                             record['error'],
+                             json.dumps(params, sort_keys=True),
+                             h_pix[0], h_pix[1], result.get('horizontal_distance'),
+                             v_pix[0], v_pix[1], result.get('vertical_distance'),
+                             record['seconds'],
+                             int(bool(record.get('cached'))),
+                             json.dumps(result.get('instrumentation', {}).get('stages', {})),
+                             json.dumps(result) if result else None))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    # Write the waiting records in one transaction
+    def flush(self):
+        if not self.pending:
+            return
+        self.execute_write("INSERT INTO results (" + ", ".join(name for name, column_type in store_columns) +
+                           ") VALUES (" + ", ".join("?" for column in store_columns) + ")", rows=self.pending)
+        self.pending = []
+
+    # Rows matching an SQL condition (e.g. "detector = ? and status = 'ok'"), newest first, as dicts
+    def query(self, where='1', args=(), limit=None):
+        sql = "SELECT * FROM results WHERE " + where + " ORDER BY id DESC"
+        if limit is not None:
+            sql += " LIMIT " + str(int(limit))
+        cursor = self.connection.execute(sql, args)
+        names = [column[0] for column in cursor.description]
+        return [dict(zip(names, row)) for row in cursor]
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# If we are running this script interactively, call the function safely
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="List results from a SEM line detector results store.")
+    parser.add_argument('db', help="results database")
+    parser.add_argument('--filename', help="only images whose path matches this SQL LIKE pattern, e.g. %%image_01%%")
+    parser.add_argument('--detector', help="only results of this detector")
+    parser.add_argument('--limit', type=int, default=20, help="number of results to list, newest first (default 20)")
+    args = parser.parse_args()
+
+    conditions = []
+    condition_args = []
+    if args.filename is not None:
+        conditions.append("filename LIKE ?")
+        condition_args.append(args.filename)
+    if args.detector is not None:
+        conditions.append("detector = ?")
+        condition_args.append(args.detector)
+
+    if not os.path.isfile(args.db):
+        print("ERROR:  The results database you entered: " + args.db + " does not exist.")
+        sys.exit()
+    with ResultStore(args.db) as store:
+        for row in store.query(" AND ".join(conditions) or '1', condition_args, args.limit):
+            line = (row['time'] + "  " + row['status'].upper().ljust(7) + " " + row['detector'].ljust(7) +
+                    row['filename'])
+            if row['horizontal_distance'] is not None:
+                line += ("\n      horizontal: " + str(round(row['horizontal_distance'], 3)) + " microns" +
+                         "   vertical: " + str(round(row['vertical_distance'], 3)) + " microns" +
+                         "   (" + str(round(row['seconds'], 2)) + " s)")
+            if row['status'] != 'ok':
+                line += "\n      " + row['error']
+            print(line)
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+# Parameter sweep for the milled / deposited line detectors.
+# Runs the detector on one image for every combination of a grid of total_width_cols, peak_width_max,
+# peak_dist_max and vertical_crop_extra values, and returns a table of the detected positions and distances
+# per combination.  Useful to check how sensitive a measurement is to the parameters, or to tune them.
+#
+# The image is loaded and cropped once.  The band row profiles for every total_width_cols come from one set of
+# cumulative column sums, and the smoothed profiles (and their extrema) are kept and reused by every
+# combination that needs them, so each extra combination only costs the spike selection.
+# The positions are exactly those the detector gives when called with the same parameters.
+
+# Usage:
+# SEM_Image_Analysis_Sweep.py  image.tif  --detector milled  --img_width 17.0  [--crop_top 400 ...]
+#                              --total_width_cols 1000,1500,2000  --peak_width_max 400,800  [--csv sweep.csv]
+
+# Imports
+import sys
+import os
+import csv
+import argparse
+import itertools
+import numpy as np
+
+from SEM_Image_Analysis_Common import smooth_profile, smoothing_methods, horizontal_smoothing, vertical_smoothing, \
+    find_extrema, select_spikes, band_columns, vertical_crop_rows, column_integral, band_profile, average_profile
+from SEM_Image_Analysis_Loader import load_image
+import SEM_Image_Analysis_Milled_Line_Detect
+import SEM_Image_Analysis_Depo_Line_Detect
+
+# Detector modules (for the polarity of the marks, and the defaults of the parameters)
+detector_modules = {'milled': SEM_Image_Analysis_Milled_Line_Detect,
+                    'depo': SEM_Image_Analysis_Depo_Line_Detect}
+
+# Parameters that can be swept, in the order of the table columns
+sweep_params = ['total_width_cols', 'peak_width_max', 'peak_dist_max', 'vertical_crop_extra']
+
+
+# One image prepared for repeated detection with different parameters.
+# Profiles and spikes are computed on first use and kept, keyed by the parameters they depend on.
+class ParameterSweep(object):
+
+    # Parameters not given (None) are the detector's defaults
+    def __init__(self, filename, detector='milled', img_width=None, crop_top=None, crop_bottom=None,
+                 crop_left=None, crop_right=None, smoothing=None):
+        defaults = detector_modules[detector].defaults
+        img_width = defaults['img_width'] if img_width is None else img_width
+        crop_top = defaults['crop_top'] if crop_top is None else crop_top
+        crop_bottom = defaults['crop_bottom'] if crop_bottom is None else crop_bottom
+        crop_left = defaults['crop_left'] if crop_left is None else crop_left
+        crop_right = defaults['crop_right'] if crop_right is None else crop_right
+        smoothing = defaults['smoothing'] if smoothing is None else smoothing
+
+        self.filename = filename
+        self.detector = detector
+        self.crop_top = crop_top
+        self.crop_left = crop_left
+        self.smoothing = smoothing
+        self.horizontal_polarity = detector_modules[detector].horizontal_polarity
+        self.vertical_polarity = detector_modules[detector].vertical_polarity
+
+        self.imgdata, img_height, self.img_width = load_image(filename, crop_top, crop_bottom, crop_left, crop_right)
+        self.length_factor = self.img_width / img_width  # pixels/ um
+        # built on first use (not needed if only one band width is swept)
+        self.integral = None
+
+        self.horizontal_profiles = {}
+        self.horizontal_spikes = {}
+        self.vertical_profiles = {}
+        self.vertical_spikes = {}
+
+    # Smoothed row profile of the central band of total_width_cols columns, and its extrema
+    def horizontal_profile(self, total_width_cols):
+        start, stop = band_columns(self.imgdata.shape[1], total_width_cols)
+        if (start, stop) not in self.horizontal_profiles:
+            if stop == start or len(self.horizontal_profiles) == 0:
+                # first band (no need for the integral if it is the only one), or empty (nan, as the detector)
+                profile = average_profile(self.imgdata[:, start:stop], 1)
+            else:
+                if self.integral is None:
+                    self.integral = column_integral(self.imgdata)
+                profile = band_profile(self.integral, start, stop)
+            profile = smooth_profile(profile, *horizontal_smoothing, method=self.smoothing)
+            self.horizontal_profiles[(start, stop)] = (profile, find_extrema(profile))
+        return self.horizontal_profiles[(start, stop)]
+
+    # Smoothed column profile of the rows start:stop, and its extrema
+    def vertical_profile(self, rows):
+        if rows not in self.vertical_profiles:
+            profile = average_profile(self.imgdata[rows[0]:rows[1], :], 0)
+            profile = smooth_profile(profile, *vertical_smoothing, method=self.smoothing)
+            self.vertical_profiles[rows] = (profile, find_extrema(profile))
+        return self.vertical_profiles[rows]
+
+    # Detect the marks for one parameter combination, returns one row of the table (a dict)
+    def evaluate(self, total_width_cols, peak_width_max, peak_dist_max, vertical_crop_extra):
+        key = (band_columns(self.imgdata.shape[1], total_width_cols), peak_width_max, peak_dist_max)
+        if key not in self.horizontal_spikes:
+            profile, extrema = self.horizontal_profile(total_width_cols)
+            self.horizontal_spikes[key] = select_spikes(profile, extrema, self.horizontal_polarity,
+                                                        peak_width_max, peak_dist_max)
+        h_pix, h_strength, h_level = self.horizontal_spikes[key]
+
+        rows = vertical_crop_rows(self.imgdata.shape[0], h_pix, vertical_crop_extra)
+        key = (rows, peak_width_max, peak_dist_max)
+        if key not in self.vertical_spikes:
+            profile, extrema = self.vertical_profile(rows)
+            self.vertical_spikes[key] = select_spikes(profile, extrema, self.vertical_polarity,
+                                                      peak_width_max, peak_dist_max)
+        v_pix, v_strength, v_level = self.vertical_spikes[key]
+
+        return {'total_width_cols': total_width_cols,
+                'peak_width_max': peak_width_max,
+                'peak_dist_max': peak_dist_max,
+                'vertical_crop_extra': vertical_crop_extra,
+                'horizontal_spike_pix': [int(v) for v in h_pix],
+                'horizontal_spike_pix_image': [int(v) + self.crop_top for v in h_pix],
+                'horizontal_spike_strength': [float(v) for v in h_strength],
+                'horizontal_distance': abs(int(h_pix[1]) - int(h_pix[0])) / self.length_factor,
+                'vertical_spike_pix': [int(v) for v in v_pix],
+                'vertical_spike_pix_image': [int(v) + self.crop_left for v in v_pix],
+                'vertical_spike_strength': [float(v) for v in v_strength],
+                'vertical_distance': abs(int(v_pix[1]) - int(v_pix[0])) / self.length_factor}
+
+    # Evaluate every combination of the grid {param: [values]}, params not in the grid use the defaults.
+    # Returns the table, one row per combination.
+    def run(self, grid):
+        defaults = detector_modules[self.detector].defaults
+        values = [grid.get(param, [defaults[param]]) for param in sweep_params]
+        return [self.evaluate(*combination) for combination in itertools.product(*values)]
+
+
+# Sweep function
+def sem_image_analysis_sweep(**kwargs):
+    # Default parameters
+    verbose = kwargs.get('verbose', True)
+    filename = kwargs.get('filename', 'img.tif')
+    detector = kwargs.get('detector', 'milled')
+    # The detector's defaults (see defaults in the detector modules; an unknown detector is reported below)
+    defaults = detector_modules.get(detector, SEM_Image_Analysis_Milled_Line_Detect).defaults
+    img_width = kwargs.get('img_width', defaults['img_width'])
+    crop_top = kwargs.get('crop_top', defaults['crop_top'])
+    crop_bottom = kwargs.get('crop_bottom', defaults['crop_bottom'])
+    crop_left = kwargs.get('crop_left', defaults['crop_left'])
+    crop_right = kwargs.get('crop_right', defaults['crop_right'])
+    smoothing = kwargs.get('smoothing', defaults['smoothing'])
+    # Values to try for each swept parameter, e.g. {'total_width_cols': [1000, 2000], 'peak_width_max': [400, 800]}
+    grid = kwargs.get('grid', {})
+    # Write the table to this csv file (None to not write)
+    csv_filename = kwargs.get('csv', None)
+
+    # Check the inputs
+    if not os.path.isfile(filename):
+        print("ERROR:  The filename you entered: " + filename + " does not exist.")
+        sys.exit()
+    if detector not in detector_modules:
+        print("ERROR:  Unknown detector: " + str(detector) +
+              "  (expected: " + ", ".join(sorted(detector_modules)) + ")")
+        sys.exit()
+    if smoothing not in smoothing_methods:
+        print("ERROR:  Unknown smoothing method: " + str(smoothing) +
+              "  (expected: " + ", ".join(sorted(smoothing_methods)) + ")")
+        sys.exit()
+    if not set(grid) <= set(sweep_params):
+        print("ERROR:  Unknown sweep parameters: " + ", ".join(sorted(set(grid) - set(sweep_params))) +
+              "  (expected: " + ", ".join(sweep_params) + ")")
+        sys.exit()
+
+    sweep = ParameterSweep(filename, detector, img_width, crop_top, crop_bottom, crop_left, crop_right, smoothing)
+    table = sweep.run(grid)
+
+    if csv_filename is not None:
+        write_table(csv_filename, table)
+    if verbose:
+        print_table(table)
+    return table
+
+
+# Write the table as csv, one row per combination (pairs of values are split into _1 / _2 columns)
+def write_table(csv_filename, table):
+    with open(csv_filename, 'w', newline='') as f:
+        writer = None
+        for row in table:
+            flat = {}
+            for key, value in row.items():
+                if isinstance(value, list):
+                    flat[key + '_1'] = value[0]
+                    flat[key + '_2'] = value[1]
+                else:
+                    flat[key] = value
+            if writer is None:
+                writer = csv.DictWriter(f, fieldnames=list(flat))
+                writer.writeheader()
+            writer.writerow(flat)
+
+
+# Print the table, and the spread of the distances over the combinations
+def print_table(table):
+    print("  ".join(param.rjust(19) for param in sweep_params) + "   horizontal [um]   vertical [um]")
+    for row in table:
+        print("  ".join(str(row[param]).rjust(19) for param in sweep_params) + "   " +
+              str(round(row['horizontal_distance'], 4)).rjust(15) + "   " +
+              str(round(row['vertical_distance'], 4)).rjust(13))
+    for axis in ['horizontal', 'vertical']:
+        distances = np.array([row[axis + '_distance'] for row in table])
+        print(">  " + axis.capitalize() + " distance: median " + str(round(float(np.median(distances)), 4)) +
+              " microns, range " + str(round(float(distances.min()), 4)) + " - " +
+              str(round(float(distances.max()), 4)) + " over " + str(len(table)) + " combinations")
+
+
+# If we are running this script interactively, call the function safely
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Run a SEM line detector over a grid of parameters on one image.")
+    parser.add_argument('filename', help="image to analyse")
+    parser.add_argument('--detector', choices=sorted(detector_modules), default='milled',
+                        help="detector to use (default milled)")
+    parser.add_argument('--img_width', type=float, help="real image width in microns")
+    for param in ['crop_top', 'crop_bottom', 'crop_left', 'crop_right']:
+        parser.add_argument('--' + param, type=int)
+    parser.add_argument('--smoothing', choices=sorted(smoothing_methods))
+    for param in sweep_params:
+        parser.add_argument('--' + param, help="comma separated values of " + param + " to try")
+    parser.add_argument('--csv', help="write the table to this csv file")
+    args = parser.parse_args()
+
+    # parameters not given are the detector's defaults
+    params = {param: getattr(args, param) for param in ['img_width', 'crop_top', 'crop_bottom', 'crop_left',
+                                                        'crop_right', 'smoothing']
+              if getattr(args, param) is not None}
+    sweep_grid = {param: [int(value) for value in getattr(args, param).split(',')]
+                  for param in sweep_params if getattr(args, param) is not None}
+
+    sem_image_analysis_sweep(filename=args.filename,
+                             detector=args.detector,
+                             grid=sweep_grid,
+                             csv=args.csv,
+                             **params)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+
+# This Script watches a folder for new images (e.g. written by the microscope during a session),
+# and runs the milled / deposited line detector on each image as soon as it has been completely written.
+# The results are printed and appended to a results file (one json record per line) and / or an SQLite
+# results store (see SEM_Image_Analysis_Store.py) as they arrive.
+#
+# Parameters for the images in a folder are read from a file called sem_params.json in that folder
+# (or any folder above it, up to the watched folder), e.g.
+#    {"detector": "milled", "img_width": 17.0, "crop_top": 400, "crop_bottom": 500, "total_width_cols": 1500}
+# Commandline parameters are used for anything not set in a sem_params.json file.
+#
+# On Linux new files are found with inotify, otherwise (or with --poll, e.g. for some network shares)
+# the folder is scanned every poll interval.
+# A file is only analysed once its size and modification time have not changed for the settle time.
+
+# Usage:
+# SEM_Image_Analysis_Watch.py  folder  [--results results.jsonl]  [--store results.db]
+#                              [--detector milled]  [--img_width 17.0 ...]
+
+# Imports
+import sys
+import os
+import json
+import re
+import time
+import fnmatch
+import struct
+import select
+import argparse
+import ctypes
+import ctypes.util
+
+from SEM_Image_Analysis_Batch import analyse_image, convert_image_params, image_param_types, detectors
+from SEM_Image_Analysis_Store import ResultStore
+
+# Name of the per-folder parameter file
+params_filename = 'sem_params.json'
+
+# Names of the files the detectors write next to the image: the image name, the date and time (YYYYmmddHHMMSS),
+# then the plots, the annotated image (or preview) in any of the image formats and the overlay
+output_file_name = re.compile(r'\d{14}_(sample_horizontal_edge_detect\.(pdf|jpg)|sample_mark_detect\.(pdf|jpg)|'
+                              r'sample_thickness_map\.pdf|annotated\.(tif|png|jpg|webp)|overlay\.(svg|json))$')
+
+# inotify event flags (from <sys/inotify.h>)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_ISDIR = 0x40000000
+IN_Q_OVERFLOW = 0x00004000
+
+
+# Minimal inotify wrapper (Linux only), using ctypes so no extra package is needed.
+# Watches a folder and all folders below it, and reports the paths of files that were written or moved in.
+class InotifyWatcher(object):
+
+    def __init__(self, folder):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.libc = libc
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.watches = {}
+        self.overflowed = False
+        for dirpath, dirnames, filenames in os.walk(folder):
+            self.add_watch(dirpath)
+
+    def add_watch(self, folder):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed for " + folder)
+        self.watches[wd] = folder
+
+    # Wait up to timeout seconds for events, return the paths of new / rewritten files
+    def read_paths(self, timeout):
+        paths = []
+        readable = select.select([self.fd], [], [], timeout)[0]
+        if not readable:
+            return paths
+        data = os.read(self.fd, 65536)
+        offset = 0
+        while offset + 16 <= len(data):
+            wd, mask, cookie, name_len = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + name_len].rstrip(b'\0')
+            offset += 16 + name_len
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, the caller should rescan the folder
+                self.overflowed = True
+                continue
+            if wd not in self.watches:
+                continue
+            path = os.path.join(self.watches[wd], os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_watch(path)
+                    # files may already be in the new folder
+                    for dirpath, dirnames, filenames in os.walk(path):
+                        paths.extend(os.path.join(dirpath, filename) for filename in filenames)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                paths.append(path)
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+# List the image files below a folder
+def scan_folder(folder, pattern):
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(folder):
+        paths.extend(os.path.join(dirpath, filename) for filename in filenames
+                     if is_input_image(filename, pattern))
+    return paths
+
+
+# True for images to analyse, skipping the files the detectors write themselves
+def is_input_image(filename, pattern):
+    filename = os.path.basename(filename)
+    if output_file_name.search(filename) or filename.startswith('.'):
+        return False
+    return fnmatch.fnmatch(filename.lower(), pattern.lower())
+
+
+# Parameters for an image: the defaults, updated by each sem_params.json from the watched folder down
+def folder_params(folder, image_filename, defaults):
+    params = dict(defaults)
+    folders = []
+    current = os.path.dirname(os.path.abspath(image_filename))
+    root = os.path.abspath(folder)
+    while True:
+        folders.append(current)
+        if current == root or os.path.dirname(current) == current:
+            break
+        current = os.path.dirname(current)
+    for current in reversed(folders):
+        params_file = os.path.join(current, params_filename)
+        if os.path.isfile(params_file):
+            with open(params_file) as f:
+                params.update(convert_image_params(json.load(f)))
+    params['filename'] = image_filename
+    return params
+
+
+# True once the file has stopped changing, i.e. the same (size, mtime) for settle_time seconds
+def is_settled(path, pending, settle_time):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        # deleted / renamed before we got to it
+        pending.pop(path, None)
+        return False
+    signature = (stat.st_size, stat.st_mtime)
+    now = time.time()
+    if path not in pending or pending[path][0] != signature:
+        pending[path] = (signature, now)
+        return False
+    return stat.st_size > 0 and now - pending[path][1] >= settle_time
+
+
+# Watch folder function
+def sem_image_analysis_watch(**kwargs):
+    # Default parameters
+    verbose = kwargs.get('verbose', True)
+    folder = kwargs.get('folder', '.')
+    # Only files matching this pattern are analysed
+    pattern = kwargs.get('pattern', '*.tif')
+    # Results file, one json record per line is appended per image (None to only print)
+    results_filename = kwargs.get('results', None)
+    # Results store (SQLite database), one row is added per image (None for no store)
+    store_filename = kwargs.get('store', None)
+    # Parameters used for anything not set in a sem_params.json file
+    defaults = kwargs.get('defaults', {})
+    # Seconds a file must be unchanged before it is analysed
+    settle_time = kwargs.get('settle_time', 1.0)
+    # Seconds between folder scans when polling
+    poll_interval = kwargs.get('poll_interval', 2.0)
+    # Use inotify when available (Linux), otherwise poll
+    use_inotify = kwargs.get('use_inotify', sys.platform.startswith('linux'))
+    # Also analyse the images already in the folder when the watch starts
+    existing = kwargs.get('existing', False)
+    # Stop after this many images (None to run until interrupted)
+    max_images = kwargs.get('max_images', None)
+
+    if not os.path.isdir(folder):
+        print("ERROR:  The folder you entered: " + folder + " does not exist.")
+        sys.exit()
+
+    # each result is written as soon as it arrives
+    store = ResultStore(store_filename, batch_size=1) if store_filename is not None else None
+
+    watcher = None
+    if use_inotify:
+        try:
+            watcher = InotifyWatcher(folder)
+        except (OSError, AttributeError, TypeError) as e:
+            if verbose:
+                print(">  inotify not available (" + str(e) + "), polling every " + str(poll_interval) + " s")
+
+    # files seen, and files waiting to settle -> ((size, mtime), time first seen with that signature)
+    done = set()
+    pending = {}
+    if existing:
+        pending.update((path, (None, 0.0)) for path in scan_folder(folder, pattern))
+    else:
+        done.update(scan_folder(folder, pattern))
+
+    if verbose:
+        print(">  Watching " + os.path.abspath(folder) + " for " + pattern + " (Ctrl-C to stop)")
+
+    records = []
+    last_scan = time.time()
+    try:
+        while max_images is None or len(records) < max_images:
+            # Find new files (wake up more often while files are settling)
+            timeout = min(settle_time, poll_interval) if pending else poll_interval
+            if watcher is not None:
+                for path in watcher.read_paths(timeout):
+                    if is_input_image(path, pattern):
+                        # a rewritten file is analysed again
+                        done.discard(path)
+                        pending.setdefault(path, (None, 0.0))
+                if watcher.overflowed:
+                    watcher.overflowed = False
+                    for path in scan_folder(folder, pattern):
+                        if path not in done:
+                            pending.setdefault(path, (None, 0.0))
+            else:
+                time.sleep(timeout)
+                if time.time() - last_scan >= poll_interval:
+                    last_scan = time.time()
+                    for path in scan_folder(folder, pattern):
+                        if path not in done:
+                            pending.setdefault(path, (None, 0.0))
+
+            # Analyse the files that have finished being written
+            for path in sorted(pending):
+                if not is_settled(path, pending, settle_time):
+                    continue
+                del pending[path]
+                done.add(path)
+
+                image = folder_params(folder, path, defaults)
+                record = analyse_image(image, hash_file=store is not None)
+                records.append(record)
+                if verbose:
+                    print_watch_record(record)
+                if results_filename is not None:
+                    with open(results_filename, 'a') as f:
+                        f.write(json.dumps(record) + "\n")
+                if store is not None:
+                    store.add(record, image)
+                if max_images is not None and len(records) >= max_images:
+                    break
+    except KeyboardInterrupt:
+        if verbose:
+            print("\n>  Stopped watching, analysed " + str(len(records)) + " images")
+    finally:
+        if watcher is not None:
+            watcher.close()
+        if store is not None:
+            store.close()
+
+    return records
+
+
+# Print the outcome for one image
+def print_watch_record(record):
+    line = time.strftime("%H:%M:%S") + "  " + record['status'].upper().ljust(7) + " " + record['filename']
+    if record['result'] is not None:
+        line += ("\n      horizontal: " + str(round(record['result']['horizontal_distance'], 3)) + " microns" +
+                 "   vertical: " + str(round(record['result']['vertical_distance'], 3)) + " microns")
+    if record['status'] != 'ok':
+        line += "\n      " + record['error']
+    print(line)
+    sys.stdout.flush()
+
+
+# If we are running this script interactively, call the function safely
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Analyse images as they are written to a folder.")
+    parser.add_argument('folder', help="folder to watch (including the folders below it)")
+    parser.add_argument('--pattern', default='*.tif', help="filename pattern of the images (default *.tif)")
+    parser.add_argument('--results', help="append a json record per image to this file")
+    parser.add_argument('--store', help="append a row per image to this SQLite results store")
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help="seconds a file must be unchanged before it is analysed (default 1)")
+    parser.add_argument('--poll', action='store_true', help="poll the folder instead of using inotify")
+    parser.add_argument('--interval', type=float, default=2.0, help="seconds between polls (default 2)")
+    parser.add_argument('--existing', action='store_true', help="also analyse the images already there")
+    parser.add_argument('--detector', choices=sorted(detectors),
+                        help="detector for folders whose sem_params.json does not set one (default milled)")
+    for param, param_type in image_param_types.items():
+        parser.add_argument('--' + param, type=param_type,
+                            help="default " + param + " for folders that do not set one")
+    args = parser.parse_args()
+
+    cli_params = {param: getattr(args, param) for param in image_param_types if getattr(args, param) is not None}
+    if args.detector is not None:
+        cli_params['detector'] = args.detector
+
+    sem_image_analysis_watch(folder=args.folder,
+                             pattern=args.pattern,
+                             results=args.results,
+                             store=args.store,
+                             defaults=cli_params,
+                             settle_time=args.settle,
+                             poll_interval=args.interval,
+                             use_inotify=not args.poll,
+                             existing=args.existing)